@@ -1,25 +1,119 @@
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+import functools
+import logging
+import os
+import time
+from urllib.parse import parse_qs
+from flask import Flask, Response, request, abort, jsonify
+from linebot import WebhookHandler
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage,
-    FollowEvent, UnfollowEvent
+    FollowEvent, UnfollowEvent, PostbackEvent
 )
 from config import Config
 from models import db, User
+from services.alerts import set_alert
+from services.catalog import StockCatalog, parse_query
+from services.fanout import set_watch
+from services.ingest import EventIngestor
+from services.startup import Startup
+from utils import metrics
+from utils.cache import TTLCache
+from utils.http import create_line_bot_api
 
 app = Flask(__name__)
 app.config.from_object(Config)
 db.init_app(app)
 
-# Initialize LINE Bot API
-line_bot_api = LineBotApi(app.config['LINE_CHANNEL_ACCESS_TOKEN'])
+# Initialize LINE Bot API (on the shared pooled HTTP transport, see utils.http)
+line_bot_api = create_line_bot_api(app.config)
 handler = WebhookHandler(app.config['LINE_CHANNEL_SECRET'])
 
+# Users known to be active: lets handle_message skip the DB entirely on a hit
+active_users = TTLCache(
+    maxsize=app.config['ACTIVE_USER_CACHE_SIZE'],
+    ttl=app.config['ACTIVE_USER_CACHE_TTL'],
+)
+
+# Subscriber state changes are queued and written in batches off the request path
+ingestor = EventIngestor.from_config(app, active_cache=active_users)
+
+# Precomputed /api/stocks pages (rebuilt when stocks change)
+stock_catalog = StockCatalog.from_config(app.config)
+
+# Metrics (Prometheus text format at /metrics)
+WEBHOOK_SECONDS = metrics.histogram('webhook_request_seconds', "Webhook request time", ['status'])
+EVENT_SECONDS = metrics.histogram('webhook_event_seconds', "Webhook handler time per LINE event type", ['type'])
+metrics.gauge('active_user_cache_size', "Entries in the active-user cache",
+              callback=lambda: active_users.stats()['size'])
+metrics.counter('active_user_cache_requests_total', "Active-user cache lookups by result", ['result'],
+                callback=lambda: {(result,): active_users.stats()[result] for result in ('hits', 'misses')})
+metrics.counter('active_user_cache_evictions_total', "Active-user cache LRU evictions",
+                callback=lambda: active_users.stats()['evictions'])
+metrics.gauge('webhook_queue_depth', "Subscriber state changes waiting to be written",
+              callback=lambda: ingestor.queue.qsize())
+
+def _db_pool_stats():
+    # Per-process SQLAlchemy pool; saturated when checked_out reaches size + max overflow
+    with app.app_context():
+        pool = db.engine.pool
+    if not hasattr(pool, 'checkedout'):
+        return {}
+    return {
+        ('checked_out',): pool.checkedout(),
+        ('idle',): pool.checkedin(),
+        ('overflow',): max(pool.overflow(), 0),
+        ('size',): pool.size(),
+    }
+
+metrics.gauge('db_pool_connections', "DB connection pool state (checked_out, idle, overflow, size)", ['state'],
+              callback=_db_pool_stats)
+
+def timed_event(func):
+    """
+    Record handler time per event type (the histogram count doubles as the event count).
+    """
+    @functools.wraps(func)
+    def wrapper(event):
+        with EVENT_SECONDS.time(type=event.type):
+            return func(event)
+    return wrapper
+
 @app.route("/health", methods=['GET'])
 def health():
     return "OK", 200
 
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route("/api/stocks", methods=['GET'])
+def api_stocks():
+    """
+    Read-only gift list: ?upcoming=true&meeting_from=YYYY-MM-DD&meeting_to=YYYY-MM-DD
+    &gift_year=2026&limit=50&cursor=<next_cursor from the previous page>
+    """
+    try:
+        query = parse_query(request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    page = stock_catalog.page(query)
+    headers = {
+        'ETag': page.etag,
+        'Cache-Control': f"public, max-age={app.config['API_CACHE_MAX_AGE']}",
+    }
+    if _etag_matches(request.headers.get('If-None-Match'), page.etag):
+        return Response(status=304, headers=headers)
+    return Response(page.body, content_type='application/json; charset=utf-8', headers=headers)
+
+def _etag_matches(header, etag):
+    # If-None-Match uses weak comparison, so W/"x" matches "x"
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or f"W/{etag}" in tags
+
 @app.route("/webhook", methods=['POST'])
 def webhook():
     # get X-Line-Signature header value
@@ -27,30 +121,35 @@ def webhook():
 
     # get request body as text
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    # Full body only at DEBUG; INFO gets a truncated preview
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug("Request body: " + body)
+    else:
+        app.logger.info(f"Request body ({len(body)} bytes): {body[:app.config['WEBHOOK_LOG_BODY_CHARS']]}")
 
     # handle webhook body
+    start = time.perf_counter()
+    status = 'error'
     try:
         handler.handle(body, signature)
+        status = 'ok'
     except InvalidSignatureError:
+        status = 'invalid_signature'
         app.logger.info("Invalid signature. Please check your channel access token/channel secret.")
         abort(400)
+    finally:
+        WEBHOOK_SECONDS.observe(time.perf_counter() - start, status=status)
 
     return 'OK'
 
 @handler.add(FollowEvent)
+@timed_event
 def handle_follow(event):
     line_user_id = event.source.user_id
     
-    # Upsert User
-    user = User.query.filter_by(line_user_id=line_user_id).first()
-    if user:
-        user.is_active = True
-    else:
-        user = User(line_user_id=line_user_id, is_active=True)
-        db.session.add(user)
-    
-    db.session.commit()
+    # Upsert User (batched by the ingestor)
+    active_users.discard(line_user_id)
+    ingestor.submit(line_user_id, True)
     
     welcome_msg = (
         "歡迎加入股東會紀念品戰情室！🎉\n"
@@ -64,55 +163,80 @@ def handle_follow(event):
     )
 
 @handler.add(UnfollowEvent)
+@timed_event
 def handle_unfollow(event):
     line_user_id = event.source.user_id
-    user = User.query.filter_by(line_user_id=line_user_id).first()
-    if user:
-        user.is_active = False
-        db.session.commit()
+    active_users.discard(line_user_id)
+    ingestor.submit(line_user_id, False)
 
 @handler.add(MessageEvent)
+@timed_event
 def handle_message(event):
     # System Identity: Not a chatbot, but we use this chance to ensure user is in DB.
     line_user_id = event.source.user_id
     
-    # Check if user exists, if not add them (Self-healing for existing followers)
-    user = User.query.filter_by(line_user_id=line_user_id).first()
-    if not user:
-        user = User(line_user_id=line_user_id, is_active=True)
-        db.session.add(user)
-        db.session.commit()
-        app.logger.info(f"Auto-registered existing user: {line_user_id}")
-    elif not user.is_active:
-        user.is_active = True
-        db.session.commit()
+    # Follower reconciliation keeps users in sync instead (SELF_HEAL_ON_MESSAGE=false)
+    if not app.config['SELF_HEAL_ON_MESSAGE']:
+        return
+
+    # Known active (cache hit): nothing to do, no DB access
+    if not line_user_id or line_user_id in active_users:
+        return
+
+    # Add or re-activate the user if needed (Self-healing for existing followers)
+    # The batched upsert skips users that are already active.
+    ingestor.submit(line_user_id, True)
 
     # Optional: Reply to acknowledge (or keep silent)
     # line_bot_api.reply_message(event.reply_token, TextSendMessage(text="收到訊息！您的訂閱狀態已確認正常。✅"))
     return
 
+@handler.add(PostbackEvent)
+@timed_event
+def handle_postback(event):
+    # Watchlist / keyword alert setup from rich menu / Flex buttons (or LIFF sending postbacks):
+    # data = "action=watch&stock_id=2330", "action=unwatch&stock_id=2330",
+    #        "action=alert&keyword=咖啡" or "action=unalert&keyword=咖啡"
+    params = parse_qs(event.postback.data or '')
+    action = params.get('action', [''])[0]
+    line_user_id = event.source.user_id
+
+    if action in ('watch', 'unwatch'):
+        stock_id = params.get('stock_id', [''])[0].strip()
+        if not stock_id.isalnum() or len(stock_id) > 10:
+            return
+        set_watch(line_user_id, stock_id, watching=action == 'watch')
+        text = f"已追蹤 {stock_id} ✅" if action == 'watch' else f"已取消追蹤 {stock_id}"
+    elif action in ('alert', 'unalert'):
+        keyword = params.get('keyword', [''])[0]
+        if not set_alert(line_user_id, keyword, enabled=action == 'alert'):
+            return
+        text = f"已設定關鍵字提醒「{keyword.strip()}」✅" if action == 'alert' else f"已取消關鍵字提醒「{keyword.strip()}」"
+    else:
+        return
+
+    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=text))
+
 # Initialize Scheduler
-# Note: In production with multiple workers, this might run multiple times.
-# For Render free tier/standard with 1 worker, this is acceptable.
-scheduler = None
-if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+# Scheduled runs go through the jobs table, so even with multiple gunicorn workers
+# each run executes once. Set SCHEDULER_EMBEDDED=false when `worker.py` runs it instead.
+# Boot work (init_db, DB pool warm-up, scheduler start) runs in the background so
+# /health and /webhook can answer before APScheduler and the scraper are imported.
+startup = Startup(app, line_bot_api=line_bot_api)
+startup.start(
     # Avoid double run in debug mode reloader
-    from services.scheduler import SchedulerService
-    scheduler = SchedulerService(app)
-    scheduler.start()
+    start_scheduler=app.config['SCHEDULER_EMBEDDED'] and (not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true')
+)
 
 # --- 超級修復版秘密通道 ---
-from services.scheduler import SchedulerService
-from models import db  # 記得引入 db 來建立表格
 import traceback
 
 @app.route('/secret-trigger')
 def manual_trigger():
     try:
-        # 0. 確保資料庫表格存在 (這步最關鍵！)
-        with app.app_context():
-            db.create_all()
-            print("資料庫表格檢查/建立完成。")
+        # 0. 確保資料庫表格存在 (開機時已在背景建立，這裡等它完成)
+        if not startup.wait(timeout=60):
+            raise RuntimeError(f"資料庫尚未就緒: {startup.error}")
 
         # 0.5 Special Debug: Force Add Test User
         if request.args.get('add_test_user') == 'true':
@@ -124,12 +248,12 @@ def manual_trigger():
                 db.session.commit()
                 print(f"Debug: Added test user {test_uid}")
 
-        # 1. 建立服務
-        service = SchedulerService(app)
+        # 1. 取得服務 (整個程序共用同一個)
+        service = startup.scheduler()
         
-        # 2. 強制執行爬蟲
+        # 2. 強制執行爬蟲 (?force=true 忽略快取，強制重新解析)
         print("手動觸發：開始爬蟲...")
-        service.scrape_job()
+        service.scrape_job(force=request.args.get('force') == 'true')
         
         # Check DB count after scrape
         from models import Stock, User
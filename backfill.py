@@ -0,0 +1,60 @@
+"""
+Historical backfill: load past gift seasons into stock_history.
+
+    python backfill.py 2016-2025                 # fetch season pages (HISTOCK_SEASON_URL)
+    python backfill.py 2019 2021 --snapshots     # re-parse stored season snapshots instead
+    python backfill.py 2016-2025 --force         # reload seasons already done
+
+Seasons are fetched and parsed in parallel (BACKFILL_WORKERS) and loaded one
+transaction each; progress is kept in backfill_checkpoints, so rerunning an
+interrupted backfill only loads the seasons that are not done yet.
+"""
+import argparse
+import logging
+import os
+import sys
+
+# A one-off command: never start the scheduler here
+os.environ['SCHEDULER_EMBEDDED'] = 'false'
+
+from app import app, startup
+from services.backfill import HistoryBackfill
+
+
+def parse_years(values):
+    years = []
+    for value in values:
+        first, _, last = value.partition('-')
+        years.extend(range(int(first), int(last or first) + 1))
+    return years
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('years', nargs='+', help="gift years or ranges, e.g. 2016-2025 2012")
+    parser.add_argument('--snapshots', action='store_true', help="parse stored season snapshots, no HTTP")
+    parser.add_argument('--force', action='store_true', help="reload seasons already done")
+    parser.add_argument('--workers', type=int, help="parallel fetch/parse workers (default BACKFILL_WORKERS)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if not startup.wait():
+        logging.error(f"Database not ready: {startup.error}")
+        return 1
+
+    with app.app_context():
+        backfill = HistoryBackfill.from_config(app.config, from_snapshots=args.snapshots)
+        if args.workers:
+            backfill.workers = args.workers
+        summary = backfill.run(parse_years(args.years), force=args.force)
+
+    for year, error in sorted(summary['failed'].items()):
+        print(f"{year}: FAILED {error}")
+    print(f"loaded {len(summary['loaded'])} seasons, skipped {len(summary['skipped'])}, "
+          f"failed {len(summary['failed'])}")
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""
+Flex report rendering benchmark (no DB, no LINE API).
+
+    python -m benchmarks.bench_flex
+
+For 20 / 200 / 2,000 stocks: cold render time, cached render time, and the
+resulting message / bubble counts and largest payload sizes.
+"""
+import json
+import time
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+from utils import flex
+
+SIZES = (20, 200, 2000)
+REPEAT = 20
+
+
+def make_stocks(n):
+    base = date(2026, 5, 1)
+    return [
+        SimpleNamespace(
+            stock_id=str(1101 + i),
+            name=f"測試股份{i}",
+            gift_name=f"紀念品 {i} 號（咖啡禮盒／禮券）",
+            meeting_date=base + timedelta(days=i % 60),
+            last_buy_date=base + timedelta(days=i % 60 - 30),
+        )
+        for i in range(n)
+    ]
+
+
+def bench(n):
+    stocks = make_stocks(n)
+    flex._memory_cache.clear()
+
+    start = time.perf_counter()
+    messages = flex.create_stock_report(stocks)
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        flex.create_stock_report(stocks)
+    warm = (time.perf_counter() - start) / REPEAT
+
+    bubbles = []
+    for message in messages:
+        contents = message.as_json_dict()['contents']
+        bubbles.extend(contents['contents'] if contents['type'] == 'carousel' else [contents])
+
+    return {
+        'stocks': n,
+        'cold_ms': round(cold * 1000, 2),
+        'cached_ms': round(warm * 1000, 3),
+        'messages': len(messages),
+        'bubbles': len(bubbles),
+        'max_message_bytes': max(len(json.dumps(m.as_json_dict())) for m in messages),
+        'max_bubble_bytes': max(len(json.dumps(b)) for b in bubbles),
+    }
+
+
+def main():
+    for n in SIZES:
+        print(bench(n))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Cold start profile: what `import app` loads and how soon /health answers.
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --top 30
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter (SQLite stand-in,
+dummy LINE credentials) and prints the slowest top-level imports, then times
+import + first /health and /webhook-signature-check requests. Exits 1 if a module
+that should load lazily (APScheduler, bs4, the scraper) is imported at startup.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Must not be on the import path of app.py; they load with the scheduler in the background
+LAZY_MODULES = ('apscheduler', 'bs4', 'services.scheduler', 'services.scraper', 'services.dispatcher',
+                'services.delivery', 'services.reminders', 'services.followers')
+
+# Time to first responses, measured inside a fresh interpreter
+FIRST_REQUEST_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+health = client.get('/health').status_code
+health_at = time.perf_counter()
+webhook = client.post('/webhook', data='{"events": []}', headers={'X-Line-Signature': 'x'}).status_code
+webhook_at = time.perf_counter()
+print(json.dumps({
+    'import_ms': round((imported - start) * 1000, 1),
+    'first_health_ms': round((health_at - start) * 1000, 1),
+    'first_webhook_ms': round((webhook_at - start) * 1000, 1),
+    'health_status': health,
+    'webhook_status': webhook,
+}))
+"""
+
+
+def child_env(database_url):
+    env = dict(os.environ)
+    env.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'bench')
+    env.setdefault('LINE_CHANNEL_SECRET', 'bench')
+    env['DATABASE_URL'] = database_url
+    env['PYTHONPATH'] = ROOT
+    return env
+
+
+def import_profile(env):
+    """
+    [(cumulative_us, self_us, module, depth)] from -X importtime.
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(cumulative_us), int(self_us), name.strip(), depth))
+    return rows
+
+
+def first_request(env):
+    proc = subprocess.run(
+        [sys.executable, '-c', FIRST_REQUEST_SCRIPT],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top', type=int, default=15, help="slowest top-level imports to show")
+    parser.add_argument('--database-url', help="default: a temporary SQLite file")
+    args = parser.parse_args(argv)
+
+    tmp_db = None
+    database_url = args.database_url
+    if not database_url:
+        tmp_db = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        database_url = f"sqlite:///{tmp_db.name}"
+    env = child_env(database_url)
+
+    try:
+        rows = import_profile(env)
+        timings = first_request(env)
+    finally:
+        if tmp_db:
+            os.unlink(tmp_db.name)
+
+    total = next((cumulative for cumulative, _, name, _ in rows if name == 'app'), None)
+    print(f"import app: {total / 1000:.1f} ms cumulative" if total else "import app: not found")
+    top_level = sorted((r for r in rows if r[3] == 1), reverse=True)[:args.top]
+    for cumulative, self_us, name, _ in top_level:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+    print(json.dumps(timings))
+
+    loaded = {name for _, _, name, _ in rows}
+    eager = [m for m in LAZY_MODULES if m in loaded]
+    for module in eager:
+        print(f"EAGER IMPORT {module}")
+    return 1 if eager else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,393 @@
+"""
+Webhook load test: signed LINE events against /webhook, latency and throughput.
+
+    python -m benchmarks.bench_webhook                      # gunicorn + SQLite stand-in, 20s
+    python -m benchmarks.bench_webhook --database-url postgresql://localhost/stockgift_bench
+    python -m benchmarks.bench_webhook --mix follow=2,unfollow=1,message=7 --batch 5 --concurrency 32
+    python -m benchmarks.bench_webhook --gunicorn-workers 2 --gunicorn-threads 8 --save-baseline
+    python -m benchmarks.bench_webhook --url http://127.0.0.1:8000 --channel-secret ...
+
+Unless --url is given, `gunicorn app:app` is started with LINE_API_ENDPOINT pointed
+at benchmarks.fake_line, so reply_message is answered locally (--line-latency).
+Every request carries --batch events drawn from --mix and is signed like LINE does
+(X-Line-Signature = base64 HMAC-SHA256 of the body with the channel secret).
+Reports client-side p50/p95/p99 latency, requests and events per second, status
+counts and DB connection use: the app's pool gauges sampled from /metrics and,
+on Postgres, server connections against max_connections. Exit status is 1 if,
+against the saved baseline for the same settings, more requests failed, or p95
+or throughput regressed relative to benchmarks.calibrate (measured on both
+machines, so a baseline from another machine still applies).
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+import requests
+from sqlalchemy import create_engine, text
+
+from benchmarks.calibrate import calibrate
+from benchmarks.fake_line import FakeLineServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'webhook_baseline.json')
+
+DEFAULT_MIX = 'follow=1,unfollow=1,message=8'
+DEFAULT_TOLERANCE = 0.25
+EVENT_KINDS = ('follow', 'unfollow', 'message')
+
+# Lines read from /metrics while the load runs
+METRIC_RE = re.compile(r'^(db_pool_connections\{state="(\w+)"\}|webhook_queue_depth) ([0-9.e+-]+)$', re.MULTILINE)
+
+
+def parse_mix(value):
+    """
+    'follow=1,unfollow=1,message=8' -> ([kind], [weight]).
+    """
+    kinds, weights = [], []
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in EVENT_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown event type {kind!r} (use {', '.join(EVENT_KINDS)})")
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+def sign(channel_secret, body):
+    digest = hmac.new(channel_secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+class EventFactory:
+    """
+    LINE webhook payloads with events drawn from the mix, for a pool of `users` user ids
+    (so follows, unfollows and messages hit the same users). Thread-safe.
+    """
+
+    def __init__(self, mix, users=10000, seed=0):
+        self.kinds, self.weights = mix
+        self.users = users
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def body(self, batch):
+        with self._lock:
+            picks = [
+                (kind, self._rng.randrange(self.users))
+                for kind in self._rng.choices(self.kinds, self.weights, k=batch)
+            ]
+        now = int(time.time() * 1000)
+        events = [self._event(kind, user, now) for kind, user in picks]
+        payload = {'destination': 'U' + '0' * 32, 'events': events}
+        return json.dumps(payload, separators=(',', ':')).encode('utf-8'), Counter(kind for kind, _ in picks)
+
+    def _event(self, kind, user, now):
+        event = {
+            'type': kind,
+            'mode': 'active',
+            'timestamp': now,
+            'source': {'type': 'user', 'userId': f"U{user:032x}"},
+            'webhookEventId': uuid.uuid4().hex.upper()[:26],
+            'deliveryContext': {'isRedelivery': False},
+        }
+        if kind != 'unfollow':
+            event['replyToken'] = uuid.uuid4().hex
+        if kind == 'follow':
+            event['follow'] = {'isUnblocked': False}
+        elif kind == 'message':
+            event['message'] = {'type': 'text', 'id': str(uuid.uuid4().int)[:18], 'text': "紀念品", 'quoteToken': 'q'}
+        return event
+
+
+class MetricsSampler:
+    """
+    Polls /metrics and keeps the peak DB pool use and webhook queue depth.
+    With several gunicorn workers each sample comes from whichever worker answers.
+    """
+
+    def __init__(self, url, database_url=None, interval=0.5):
+        self.url = url
+        self.interval = interval
+        self.peak = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._engine = None
+        if database_url and database_url.startswith('postgres'):
+            self._engine = create_engine(database_url.replace('postgres://', 'postgresql://', 1), pool_size=1)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='metrics-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if self._engine is not None:
+            with self._engine.connect() as conn:
+                self.peak['pg_max_connections'] = int(conn.execute(text("SHOW max_connections")).scalar())
+            self._engine.dispose()
+        return self.peak
+
+    def _run(self):
+        session = requests.Session()
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            try:
+                body = session.get(f"{self.url}/metrics", timeout=2).text
+                for name, state, value in METRIC_RE.findall(body):
+                    self._record(f"pool_{state}" if state else 'webhook_queue_depth', float(value))
+            except requests.RequestException:
+                pass
+            if self._engine is not None:
+                try:
+                    with self._engine.connect() as conn:
+                        self._record('pg_connections', conn.execute(text(
+                            "SELECT count(*) FROM pg_stat_activity WHERE datname = current_database()"
+                        )).scalar())
+                except Exception:
+                    pass
+
+    def _record(self, key, value):
+        self.peak[key] = max(self.peak.get(key, 0), value)
+
+
+def run_load(url, channel_secret, factory, batch, concurrency, duration, rate=None):
+    """
+    Closed loop: `concurrency` clients post signed batches until `duration` is up
+    (optionally paced to `rate` requests per second overall).
+    Returns (latencies in seconds, status counts, event counts, elapsed seconds).
+    """
+    latencies = []
+    statuses = Counter()
+    events = Counter()
+    lock = threading.Lock()
+    start = time.perf_counter()
+    deadline = start + duration
+    interval = concurrency / rate if rate else 0
+
+    def client():
+        session = requests.Session()
+        next_at = time.perf_counter()
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                return
+            if interval:
+                if next_at > now:
+                    time.sleep(next_at - now)
+                next_at += interval
+            body, kinds = factory.body(batch)
+            headers = {'Content-Type': 'application/json', 'X-Line-Signature': sign(channel_secret, body)}
+            sent = time.perf_counter()
+            try:
+                status = session.post(f"{url}/webhook", data=body, headers=headers, timeout=30).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - sent
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+                if status == 200:
+                    events.update(kinds)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, events, time.perf_counter() - start
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def start_gunicorn(port, env, workers, threads, log):
+    command = [
+        sys.executable, '-m', 'gunicorn', 'app:app',
+        '--bind', f"127.0.0.1:{port}",
+        '--workers', str(workers),
+        '--threads', str(threads),
+        '--log-level', 'warning',
+    ]
+    proc = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {proc.returncode}, see {log.name}")
+        try:
+            if requests.get(f"{url}/health", timeout=1).status_code == 200:
+                return proc, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f"gunicorn did not answer /health within 30s, see {log.name}")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def prepare_database(database_url, line_endpoint):
+    """
+    Create the tables up front so the first requests don't race the app's boot.
+    """
+    from benchmarks.run import make_app
+    from models import init_db
+
+    app = make_app(database_url, line_endpoint)
+    with app.app_context():
+        init_db()
+
+
+def stage_name(args, database_url):
+    mix = ','.join(f"{k}={w:g}" for k, w in zip(*args.mix))
+    target = 'external' if args.url else (database_url or '').split(':')[0]
+    return (f"webhook:{target}:{mix}:batch={args.batch}:c={args.concurrency}"
+            f":w={args.gunicorn_workers}x{args.gunicorn_threads}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"event weights (default {DEFAULT_MIX})")
+    parser.add_argument('--batch', type=int, default=1, help="events per webhook request")
+    parser.add_argument('--concurrency', type=int, default=16, help="concurrent clients")
+    parser.add_argument('--duration', type=float, default=20, help="seconds of load")
+    parser.add_argument('--rate', type=float, help="target requests per second (default: as fast as possible)")
+    parser.add_argument('--users', type=int, default=10000, help="distinct user ids in the events")
+    parser.add_argument('--url', help="an already running app (default: start gunicorn)")
+    parser.add_argument('--channel-secret', default=os.environ.get('LINE_CHANNEL_SECRET') or 'bench-secret')
+    parser.add_argument('--database-url', help="for the spawned app (default: a temporary SQLite file)")
+    parser.add_argument('--gunicorn-workers', type=int, default=1)
+    parser.add_argument('--gunicorn-threads', type=int, default=1)
+    parser.add_argument('--line-latency', type=float, default=0.02, help="fake LINE API latency (s)")
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    calibration = calibrate()
+    fake = proc = tmp_db = log = None
+    database_url = args.database_url
+    url = args.url
+    try:
+        if not url:
+            fake = FakeLineServer(latency=args.line_latency).start()
+            if not database_url:
+                tmp_db = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+                database_url = f"sqlite:///{tmp_db.name}"
+            prepare_database(database_url, fake.url)
+            env = dict(os.environ)
+            env.update(
+                PYTHONPATH=ROOT,
+                DATABASE_URL=database_url,
+                LINE_CHANNEL_SECRET=args.channel_secret,
+                LINE_CHANNEL_ACCESS_TOKEN='bench',
+                LINE_API_ENDPOINT=fake.url,
+                SCHEDULER_EMBEDDED='false',
+                INIT_DB_ON_BOOT='false',
+            )
+            log = tempfile.NamedTemporaryFile(prefix='bench_webhook_', suffix='.log', delete=False)
+            proc, url = start_gunicorn(free_port(), env, args.gunicorn_workers, args.gunicorn_threads, log)
+
+        factory = EventFactory(args.mix, users=args.users)
+        sampler = MetricsSampler(url, database_url).start()
+        latencies, statuses, events, elapsed = run_load(
+            url, args.channel_secret, factory, args.batch, args.concurrency, args.duration, args.rate)
+        db_peak = sampler.stop()
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=30)
+        if fake:
+            fake.stop()
+        if tmp_db:
+            os.unlink(tmp_db.name)
+
+    ok = statuses.get(200, 0)
+    row = {
+        'stage': stage_name(args, database_url),
+        'requests': len(latencies),
+        'events': sum(events.values()),
+        'seconds': round(elapsed, 2),
+        'requests_per_second': round(ok / elapsed, 1),
+        'events_per_second': round(sum(events.values()) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        'max_ms': round(max(latencies) * 1000, 1) if latencies else None,
+        'status': {str(k): v for k, v in statuses.items()},
+        'db': db_peak,
+        'calibration_seconds': calibration,
+    }
+    if fake:
+        row['line'] = fake.stats()
+    pool_limit = db_peak.get('pool_size', 0) + db_peak.get('pool_overflow', 0)
+    if db_peak.get('pool_checked_out') and pool_limit:
+        row['db']['pool_saturation'] = round(db_peak['pool_checked_out'] / pool_limit, 2)
+    if db_peak.get('pg_connections') and db_peak.get('pg_max_connections'):
+        row['db']['pg_saturation'] = round(db_peak['pg_connections'] / db_peak['pg_max_connections'], 2)
+    print(json.dumps(row, ensure_ascii=False))
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+    if args.save_baseline:
+        baseline[row['stage']] = row
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baseline, f, indent=2, ensure_ascii=False, sort_keys=True)
+        print(f"Baseline saved to {BASELINE_PATH}")
+        return 0
+
+    base = baseline.get(row['stage'])
+    if not base:
+        return 0
+    regressions = []
+    failed = row['requests'] - statuses.get(200, 0)
+    base_failed = base['requests'] - base['status'].get('200', 0)
+    if failed > base_failed:
+        regressions.append(f"failed requests {base_failed} -> {failed}")
+    base_calibration = base.get('calibration_seconds')
+    if not base_calibration:
+        print("Baseline has no calibration; latency not compared (re-record with --save-baseline).")
+    else:
+        # In calibration units, i.e. relative to each machine's speed
+        scale = base_calibration / calibration
+        p95 = row['p95_ms'] * scale
+        throughput = row['requests_per_second'] / scale
+        if p95 > base['p95_ms'] * (1 + args.tolerance):
+            regressions.append(f"p95 {base['p95_ms']}ms -> {p95:.1f}ms (calibrated; measured {row['p95_ms']}ms)")
+        if throughput < base['requests_per_second'] * (1 - args.tolerance):
+            regressions.append(f"throughput {base['requests_per_second']} -> {throughput:.1f} req/s "
+                               f"(calibrated; measured {row['requests_per_second']})")
+    for regression in regressions:
+        print(f"REGRESSION {row['stage']}: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
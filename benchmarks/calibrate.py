@@ -0,0 +1,64 @@
+"""
+Machine speed reference for the benchmark gates.
+
+Wall times are only compared as ratios to calibrate(): a fixed workload in the
+same mix as the suites (stdlib HTML tokenizing, SQLite inserts and queries,
+JSON encoding), so a baseline recorded on one machine still gates runs on a
+slower or busier one. It uses no application code, so optimizing the app
+never moves the reference.
+
+    python -m benchmarks.calibrate
+"""
+import json
+import sqlite3
+import time
+from html.parser import HTMLParser
+
+from benchmarks.synth import make_histock_html
+
+ROWS = 2000
+REPEAT = 5
+
+
+class _CellCollector(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            self.rows.append([])
+
+    def handle_data(self, data):
+        if self.rows and data.strip():
+            self.rows[-1].append(data.strip())
+
+
+def _workload(html):
+    collector = _CellCollector()
+    collector.feed(html)
+    rows = [row for row in collector.rows if len(row) >= 2]
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE t (id TEXT PRIMARY KEY, name TEXT, gift TEXT)")
+    conn.executemany("INSERT INTO t VALUES (?, ?, ?)", ((str(i), row[0], row[-2]) for i, row in enumerate(rows)))
+    conn.execute("SELECT gift, COUNT(*) FROM t GROUP BY gift").fetchall()
+    conn.close()
+    json.dumps(rows, ensure_ascii=False)
+
+
+def calibrate(repeat=REPEAT):
+    """
+    Best-of-`repeat` seconds for the reference workload on this machine.
+    """
+    html = make_histock_html(ROWS, seed=0)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _workload(html)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return round(best, 5)
+
+
+if __name__ == '__main__':
+    print(json.dumps({'calibration_seconds': calibrate()}))
@@ -0,0 +1,156 @@
+"""
+Local stand-in for the LINE Messaging API: records calls (and request bytes of accepted
+sends) and can inject latency and 429s.
+Sends (POST) are throttled; reads answer with fixed data: follower insight reports
+`followers` (None = not ready), the message quota is unlimited, audience uploads
+create group 1 and narrowcasts succeed immediately. DELETEs are counted under
+'DELETE <path>'. The follower-ids API pages through U{i:032d} for i in range(followers).
+
+    server = FakeLineServer(latency=0.02, rate_429=0.05).start()
+    api = LineBotApi('token', endpoint=server.url)
+    ...
+    server.stop(); print(server.stats())
+"""
+import json
+import random
+from urllib.parse import parse_qs
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeLineServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, rate_429=0.0, retry_after=0.05, seed=0,
+                 followers=None):
+        self.latency = latency
+        self.followers = followers
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.errors = {}              # path -> HTTP status to answer sends with (e.g. 400)
+        self.calls = Counter()        # path -> accepted calls
+        self.throttled = Counter()    # path -> 429 responses
+        self.recipients = 0
+        self.bytes = 0                # request body bytes of accepted sends
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.throttled.clear()
+            self.recipients = 0
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': dict(self.calls),
+                'throttled': dict(self.throttled),
+                'recipients': self.recipients,
+                'bytes': self.bytes,
+            }
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}') if length else {}
+                if server.latency:
+                    time.sleep(server.latency)
+
+                path = self.path.split('?')[0]
+                if path in server.errors:
+                    self._reply(server.errors[path], {'message': 'Injected error'})
+                    return
+                with server._lock:
+                    throttle = server.rate_429 and server._rng.random() < server.rate_429
+                    if throttle:
+                        server.throttled[path] += 1
+                    else:
+                        server.calls[path] += 1
+                        server.bytes += length
+                        if path.endswith('/multicast'):
+                            server.recipients += len(body.get('to', []))
+                        elif path.endswith('/broadcast'):
+                            server.recipients += server.followers or 0
+                        elif path.endswith('/audienceGroup/upload'):
+                            server.recipients += len(body.get('audiences', []))
+
+                if throttle:
+                    self._reply(429, {'message': 'Too Many Requests'}, {'Retry-After': str(server.retry_after)})
+                elif path.endswith('/audienceGroup/upload') and self.command == 'POST':
+                    self._reply(200, {'audienceGroupId': 1, 'type': 'UPLOAD'})
+                else:
+                    self._reply(200, {})
+
+            do_PUT = do_POST
+
+            def do_DELETE(self):
+                with server._lock:
+                    server.calls[f"DELETE {self.path.split('?')[0]}"] += 1
+                self._reply(200, {})
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                with server._lock:
+                    server.calls[path] += 1
+                if path.endswith('/insight/followers'):
+                    if server.followers is None:
+                        self._reply(200, {'status': 'unready'})
+                    else:
+                        self._reply(200, {'status': 'ready', 'followers': server.followers,
+                                          'targetedReaches': server.followers, 'blocks': 0})
+                elif path.endswith('/message/quota'):
+                    self._reply(200, {'type': 'none'})
+                elif path.endswith('/message/quota/consumption'):
+                    self._reply(200, {'totalUsage': 0})
+                elif path.endswith('/progress/narrowcast'):
+                    self._reply(200, {'phase': 'succeeded'})
+                elif path.endswith('/followers/ids'):
+                    query = parse_qs(self.path.partition('?')[2])
+                    start = int(query.get('start', ['0'])[0])
+                    end = min(start + int(query.get('limit', ['300'])[0]), server.followers or 0)
+                    page = {'userIds': [f"U{i:032d}" for i in range(start, end)]}
+                    if end < (server.followers or 0):
+                        page['next'] = str(end)
+                    self._reply(200, page)
+                else:
+                    self._reply(200, {})
+
+            def _reply(self, status, payload, headers=None):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('X-Line-Request-Id', 'fake')
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
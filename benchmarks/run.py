@@ -0,0 +1,299 @@
+"""
+Offline benchmark suite: scrape parsing, save_stocks and broadcast_job at scale.
+
+    python -m benchmarks.run                      # SQLite stand-in, compare with baselines
+    python -m benchmarks.run --quick              # smaller sizes
+    python -m benchmarks.run --save-baseline      # record current results as the baseline
+    python -m benchmarks.run --database-url postgresql://localhost/stockgift_bench
+
+    python -m benchmarks.run --gate-time          # also fail on (calibrated) slowdowns
+
+No live site or LINE API is used: pages come from benchmarks.synth and LINE calls
+go to benchmarks.fake_line (with injected latency and 429s). Every stage reports
+wall time, throughput, peak Python memory (tracemalloc) and DB round trips.
+Parse stages are timed in a separate untraced run; DB stages run once, traced,
+so their times include tracing overhead.
+
+Exit status is 1 if a stage regressed on a machine-independent counter: DB round
+trips, or LINE calls, recipients and request bytes. Wall times are compared only
+as ratios to benchmarks.calibrate, measured on both machines; a slower ratio is
+reported, and fails the run only with --gate-time, as it stays noisy on shared machines.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from flask import Flask
+from sqlalchemy import event
+
+from benchmarks.calibrate import calibrate
+from benchmarks.fake_line import FakeLineServer
+from benchmarks.synth import make_histock_html
+from config import Config
+from models import db, init_db, User, DeliveryLedger, DeliveryRun, Watermark
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+SIZES = (100, 1000, 5000, 20000)
+QUICK_SIZES = (100, 1000)
+USER_COUNTS = (1000, 10000)
+QUICK_USER_COUNTS = (1000,)
+
+# Calibrated time more than this fraction above the baseline's (and by more than MIN_DELTA
+# calibrated seconds) is reported as slower
+DEFAULT_TOLERANCE = 0.5
+MIN_DELTA = 0.05
+
+# Baseline entry holding the calibration of the machine that recorded it
+CALIBRATION_KEY = '_calibration'
+
+
+class RoundTrips:
+    """
+    Counts statements sent to the DB (an executemany counts once).
+    """
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args, **kwargs):
+        self.count += 1
+
+
+def measure(name, fn, items, round_trips, repeatable=False):
+    """
+    repeatable: fn has no side effects, so time it untraced and trace a second call.
+    """
+    if repeatable:
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+
+    round_trips.count = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    if not repeatable:
+        seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    row = {
+        'stage': name,
+        'items': items,
+        'seconds': round(seconds, 4),
+        'per_second': round(items / seconds, 1) if seconds else None,
+        'peak_kb': round(peak / 1024, 1),
+        'round_trips': round_trips.count,
+    }
+    print(json.dumps(row, ensure_ascii=False))
+    return row, result
+
+
+def make_app(database_url, line_endpoint):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=database_url,
+        LINE_CHANNEL_ACCESS_TOKEN='bench',
+        LINE_API_ENDPOINT=line_endpoint,
+        LINE_MULTICAST_RATE=1000,
+        LINE_MULTICAST_WORKERS=16,
+        # broadcast:N stays a multicast measurement; broadcast:auto:N lets the planner choose
+        DELIVERY_STRATEGY='multicast',
+    )
+    db.init_app(app)
+    return app
+
+
+def bench_parse(sizes, round_trips):
+    from services.scraper import ScraperService
+
+    rows = []
+    for size in sizes:
+        html = make_histock_html(size, seed=size)
+        for backend in ('bs4', 'stream'):
+            scraper = ScraperService(parser_backend=backend)
+            row, _ = measure(f"parse:{backend}:{size}", lambda: scraper.parse_histock(html), size, round_trips,
+                             repeatable=True)
+            rows.append(row)
+    return rows
+
+
+def bench_save(app, sizes, round_trips):
+    from services.scraper import ScraperService
+
+    rows = []
+    scraper = ScraperService()
+    with app.app_context():
+        for size in sizes:
+            db.drop_all()
+            init_db()
+            parsed = scraper.parse_histock(make_histock_html(size, seed=size))
+
+            row, _ = measure(f"save:insert:{size}", lambda: scraper.save_stocks(parsed), size, round_trips)
+            rows.append(row)
+
+            # Second pass: ~10% of rows changed, the rest must be detected as unchanged
+            rng = random.Random(size)
+            for item in parsed:
+                if rng.random() < 0.1:
+                    item['gift_name'] = item['gift_name'] + " (更新)"
+            row, _ = measure(f"save:update:{size}", lambda: scraper.save_stocks(parsed), size, round_trips)
+            rows.append(row)
+    return rows
+
+
+def bench_broadcast(app, user_counts, round_trips, fake):
+    from services.scheduler import SchedulerService
+
+    rows = []
+    service = SchedulerService(app)
+    with app.app_context():
+        for n_users in user_counts:
+            db.drop_all()
+            init_db()
+            db.session.execute(User.__table__.insert(), [
+                {'line_user_id': f"U{i:032d}", 'is_active': i % 10 != 0} for i in range(n_users)
+            ])
+            today = date.today()
+            stocks = [
+                {
+                    'stock_id': str(1101 + i), 'name': f"測試{i}", 'gift_name': "咖啡禮盒",
+                    'meeting_date': today + timedelta(days=30 + i), 'last_buy_date': today + timedelta(days=5 + i),
+                    'gift_year': today.year,
+                }
+                for i in range(50)
+            ]
+            db.session.commit()
+            service.scraper.save_stocks(stocks)
+
+            for strategy in ('multicast', 'auto'):
+                # Same report again: forget the previous delivery so it is not skipped
+                # (and the broadcast watermark, so the same stocks count as changed)
+                DeliveryLedger.query.delete()
+                DeliveryRun.query.delete()
+                Watermark.query.delete()
+                db.session.commit()
+                service.planner.strategy = strategy
+                service.planner._reach_cache.clear()
+                # LINE's follower count matches the active users, so auto can broadcast
+                fake.followers = n_users - (n_users + 9) // 10
+                fake.reset()
+                stage = f"broadcast:{n_users}" if strategy == 'multicast' else f"broadcast:auto:{n_users}"
+                row, _ = measure(stage, service.broadcast_job, n_users, round_trips)
+                line = fake.stats()
+                print(json.dumps({'stage': row['stage'], 'line': line}))
+                row['line'] = line
+                rows.append(row)
+    return rows
+
+
+def compare(results, baseline, tolerance, calibration):
+    """
+    (regressions, slower): counter increases, and stages whose calibrated time grew.
+    """
+    regressions = []
+    slower = []
+    base_calibration = (baseline.get(CALIBRATION_KEY) or {}).get('seconds')
+    for stage, row in results.items():
+        base = baseline.get(stage)
+        if not base:
+            continue
+        if row['round_trips'] > base['round_trips']:
+            regressions.append(f"{stage}: round trips {base['round_trips']} -> {row['round_trips']}")
+        if 'line' in row and 'line' in base:
+            for name, value, base_value in _line_counters(row['line'], base['line']):
+                if value > base_value:
+                    regressions.append(f"{stage}: LINE {name} {base_value} -> {value}")
+
+        if base_calibration:
+            relative = row['seconds'] / calibration
+            base_relative = base['seconds'] / base_calibration
+            if relative - base_relative > MIN_DELTA and relative > base_relative * (1 + tolerance):
+                slower.append(f"{stage}: {base_relative:.2f} -> {relative:.2f} calibration units "
+                              f"({base['seconds']}s -> {row['seconds']}s)")
+    if not base_calibration:
+        print("Baseline has no calibration; times not compared (re-record with --save-baseline).")
+    return regressions, slower
+
+
+def _line_counters(line, base):
+    # Accepted calls per path, recipients and request bytes (429s depend on timing, so not gated)
+    for path, count in line.get('calls', {}).items():
+        yield f"calls {path}", count, base.get('calls', {}).get(path, 0)
+    yield 'recipients', line.get('recipients', 0), base.get('recipients', 0)
+    if 'bytes' in base:
+        yield 'bytes', line.get('bytes', 0), base['bytes']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help="smaller sizes")
+    parser.add_argument('--database-url', help="default: a temporary SQLite file")
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--gate-time', action='store_true', help="fail on calibrated slowdowns too")
+    parser.add_argument('--line-latency', type=float, default=0.02, help="fake LINE API latency (s)")
+    parser.add_argument('--line-429-rate', type=float, default=0.02, help="fraction of LINE calls answered 429")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    tmp_db = None
+    database_url = args.database_url
+    if not database_url:
+        tmp_db = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        database_url = f"sqlite:///{tmp_db.name}"
+
+    fake = FakeLineServer(latency=args.line_latency, rate_429=args.line_429_rate).start()
+    app = make_app(database_url, fake.url)
+    with app.app_context():
+        round_trips = RoundTrips(db.engine)
+
+    sizes = QUICK_SIZES if args.quick else SIZES
+    user_counts = QUICK_USER_COUNTS if args.quick else USER_COUNTS
+    # Before and after the suite; the faster one is the least disturbed
+    calibration = calibrate()
+    try:
+        rows = bench_parse(sizes, round_trips)
+        rows += bench_save(app, sizes, round_trips)
+        rows += bench_broadcast(app, user_counts, round_trips, fake)
+    finally:
+        fake.stop()
+        if tmp_db:
+            os.unlink(tmp_db.name)
+    calibration = min(calibration, calibrate())
+    print(json.dumps({'calibration_seconds': calibration}))
+
+    results = {row['stage']: row for row in rows}
+    if args.save_baseline:
+        results[CALIBRATION_KEY] = {'seconds': calibration}
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False, sort_keys=True)
+        print(f"Saved baseline to {BASELINE_PATH}")
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        print("No baseline yet; run with --save-baseline.")
+        return 0
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+    regressions, slower = compare(results, baseline, args.tolerance, calibration)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    for line in slower:
+        print(f"{'REGRESSION' if args.gate_time else 'SLOWER'} {line}")
+    return 1 if regressions or (slower and args.gate_time) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
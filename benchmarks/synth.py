@@ -0,0 +1,51 @@
+"""
+Synthetic HiStock gift.aspx pages for offline parser / persistence benchmarks.
+"""
+import random
+from datetime import date, timedelta
+
+
+def make_histock_html(n_rows, seed=0, gift_year=2026):
+    """
+    A gift.aspx-like page with n_rows stocks: a decoy table first, then the gift
+    table with mixed date formats (MM/DD, ROC YYY/MM/DD, '-' / empty) and
+    cross-year rows (last buy date in December, meeting in January).
+    """
+    rng = random.Random(seed)
+    roc_year = gift_year - 1911
+
+    out = [
+        "<html><head><title>", str(gift_year), "股東會紀念品</title>",
+        "<script>var t = '<table><tr><td>x</td></tr></table>';</script></head><body>",
+        "<table class='nav'><tr><td>首頁</td><td>個股</td></tr><tr><td>a</td><td>b</td></tr></table>",
+        "<table class='gvTB'><tr><th>代號名稱</th><th>最後買進日</th><th>股東會日期</th>",
+        "<th>股價</th><th>股東會紀念品</th><th>開會性質</th></tr>",
+    ]
+    for i in range(n_rows):
+        stock_id = f"{1101 + i % 8899:04d}"
+        meeting = date(gift_year, 1, 1) + timedelta(days=rng.randint(0, 364))
+
+        kind = rng.random()
+        if kind < 0.05:
+            # Cross-year: buy in December of the previous year, meeting in January
+            meeting = date(gift_year, 1, rng.randint(5, 28))
+            last_buy = f"12/{rng.randint(1, 28):02d}"
+        else:
+            buy = meeting - timedelta(days=rng.randint(20, 60))
+            last_buy = f"{buy.month:02d}/{buy.day:02d}"
+
+        if rng.random() < 0.3:
+            meeting_str = f"{roc_year}/{meeting.month:02d}/{meeting.day:02d}"
+        else:
+            meeting_str = f"{meeting.month:02d}/{meeting.day:02d}"
+        if rng.random() < 0.03:
+            last_buy = rng.choice(["-", ""])
+
+        gift = rng.choice(["咖啡禮盒", "7-11禮券 50元", "環保餐具組", "洗碗精 &amp; 海綿", "毛巾", "未定"])
+        out.append(
+            f"<tr><td><a href='/stock/{stock_id}'>{stock_id}</a>測試{i}</td><td>{last_buy}</td>"
+            f"<td>{meeting_str}</td><td>{rng.randint(10, 900)}.{rng.randint(0, 99):02d}</td>"
+            f"<td>{gift}</td><td>常會</td></tr>"
+        )
+    out.append("</table><table><tr><td>footer</td></tr></table></body></html>")
+    return "".join(out)
@@ -13,3 +13,85 @@ class Config:
     # LINE Bot settings
     LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
     LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET')
+    # Override for local stand-ins (benchmarks/fake_line.py); default is the real API
+    LINE_API_ENDPOINT = os.environ.get('LINE_API_ENDPOINT', 'https://api.line.me')
+
+    # Shared outbound HTTP transport (utils.http): pooled connections per host,
+    # retries with backoff for idempotent requests, concurrent requests per host
+    HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 16))
+    HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+    HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.5))
+    HTTP_MAX_PER_HOST = int(os.environ.get('HTTP_MAX_PER_HOST', 8))
+
+    # Scraper HTML parser backend: 'stream' (fast, stdlib tokenizer) or 'bs4' (full tree)
+    SCRAPER_PARSER = os.environ.get('SCRAPER_PARSER', 'stream')
+
+    # Historical backfill (backfill.py): past seasons' gift pages, {year} is the gift year
+    HISTOCK_SEASON_URL = os.environ.get('HISTOCK_SEASON_URL', 'https://histock.tw/stock/gift.aspx?year={year}')
+    BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', 4))
+
+    # LINE multicast dispatcher
+    LINE_MULTICAST_WORKERS = int(os.environ.get('LINE_MULTICAST_WORKERS', 8))
+    LINE_MULTICAST_RATE = float(os.environ.get('LINE_MULTICAST_RATE', 50))  # requests per second
+    LINE_MULTICAST_MAX_RETRIES = int(os.environ.get('LINE_MULTICAST_MAX_RETRIES', 5))
+
+    # Delivery planner: 'auto' picks broadcast / narrowcast / multicast per send, or force one
+    DELIVERY_STRATEGY = os.environ.get('DELIVERY_STRATEGY', 'auto')
+    # Broadcast only if LINE's follower reach is within this fraction of our active users
+    BROADCAST_MATCH_TOLERANCE = float(os.environ.get('BROADCAST_MATCH_TOLERANCE', 0.02))
+    # Audiences at least this large go out as one narrowcast to an uploaded audience
+    NARROWCAST_MIN_AUDIENCE = int(os.environ.get('NARROWCAST_MIN_AUDIENCE', 5000))
+    NARROWCAST_PROGRESS_TIMEOUT = int(os.environ.get('NARROWCAST_PROGRESS_TIMEOUT', 300))
+
+    # Webhook ingestion: follow/unfollow state is queued and flushed in batches
+    WEBHOOK_FLUSH_INTERVAL = float(os.environ.get('WEBHOOK_FLUSH_INTERVAL', 1.0))  # seconds
+    WEBHOOK_FLUSH_BATCH = int(os.environ.get('WEBHOOK_FLUSH_BATCH', 500))
+    # A failed flush is retried with backoff this many times before going user by user
+    WEBHOOK_FLUSH_RETRIES = int(os.environ.get('WEBHOOK_FLUSH_RETRIES', 3))
+    WEBHOOK_LOG_BODY_CHARS = int(os.environ.get('WEBHOOK_LOG_BODY_CHARS', 200))
+
+    # Known-active subscriber cache for the message fast path
+    ACTIVE_USER_CACHE_SIZE = int(os.environ.get('ACTIVE_USER_CACHE_SIZE', 10000))
+    ACTIVE_USER_CACHE_TTL = int(os.environ.get('ACTIVE_USER_CACHE_TTL', 3600))  # seconds
+    # Upsert message senders as active users; can be turned off once reconciliation runs
+    SELF_HEAL_ON_MESSAGE = os.environ.get('SELF_HEAL_ON_MESSAGE', 'true').lower() == 'true'
+
+    # Follower reconciliation (daily, 04:00 Asia/Taipei): sync users.is_active with LINE's
+    # follower ids. The follower-ids API needs a verified or premium account; FOLLOWER_IDS_FILE
+    # (one user id per line) stands in for it.
+    FOLLOWER_RECONCILE_ENABLED = os.environ.get('FOLLOWER_RECONCILE_ENABLED', 'false').lower() == 'true'
+    FOLLOWER_IDS_FILE = os.environ.get('FOLLOWER_IDS_FILE')
+    FOLLOWER_STAGING_BATCH = int(os.environ.get('FOLLOWER_STAGING_BATCH', 5000))
+    # Refuse to deactivate more than this fraction of active users in one run
+    FOLLOWER_MAX_DEACTIVATE_RATIO = float(os.environ.get('FOLLOWER_MAX_DEACTIVATE_RATIO', 0.2))
+
+    # /api/stocks: browser/CDN cache lifetime, and how often a process checks the DB
+    # for stock changes made elsewhere (e.g. by worker.py)
+    API_CACHE_MAX_AGE = int(os.environ.get('API_CACHE_MAX_AGE', 60))
+    API_VERSION_CHECK_SECONDS = int(os.environ.get('API_VERSION_CHECK_SECONDS', 30))
+    # Cached Flex reports (rendered_reports) unused for this many days are pruned by the scrape job
+    RENDERED_REPORT_MAX_AGE_DAYS = int(os.environ.get('RENDERED_REPORT_MAX_AGE_DAYS', 30))
+
+    # Scheduler: 'true' runs it inside the web process too (safe with any number of
+    # gunicorn workers thanks to the jobs table); set 'false' when a worker process runs it
+    SCHEDULER_EMBEDDED = os.environ.get('SCHEDULER_EMBEDDED', 'true').lower() == 'true'
+    # Create missing tables once per process at boot (in the background, see services.startup)
+    INIT_DB_ON_BOOT = os.environ.get('INIT_DB_ON_BOOT', 'true').lower() == 'true'
+    JOB_POLL_SECONDS = int(os.environ.get('JOB_POLL_SECONDS', 30))
+    JOB_MISFIRE_GRACE_SECONDS = int(os.environ.get('JOB_MISFIRE_GRACE_SECONDS', 3600))
+    # A run still 'running' after the lease is presumed lost (worker died); keep it shorter
+    # than the grace time so the run can still be retried
+    JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 1200))
+    # Failed or lost runs are retried after the delay, up to this many attempts, within the grace time
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+    JOB_RETRY_DELAY_SECONDS = int(os.environ.get('JOB_RETRY_DELAY_SECONDS', 60))
+
+    # "Last buy date is tomorrow" reminders, sent at REMINDER_HOUR (Asia/Taipei)
+    REMINDERS_ENABLED = os.environ.get('REMINDERS_ENABLED', 'true').lower() == 'true'
+    REMINDER_DAYS_BEFORE = int(os.environ.get('REMINDER_DAYS_BEFORE', 1))
+    REMINDER_HOUR = int(os.environ.get('REMINDER_HOUR', 9))
+    # The in-memory wheel holds reminders due within the horizon and is reloaded every refresh
+    REMINDER_HORIZON_SECONDS = int(os.environ.get('REMINDER_HORIZON_SECONDS', 86400))
+    REMINDER_REFRESH_SECONDS = int(os.environ.get('REMINDER_REFRESH_SECONDS', 600))
+    # worker.py serves /metrics on this port when set (0 = off)
+    WORKER_METRICS_PORT = int(os.environ.get('WORKER_METRICS_PORT', 0))
@@ -1,10 +1,49 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, inspect, text
 from datetime import datetime
+import zlib
 
 # Initialize SQLAlchemy with pool_pre_ping=True so that it handles
 # dropped connections found in some cloud environments (like Render/Neon) gracefully.
 db = SQLAlchemy(engine_options={"pool_pre_ping": True})
 
+# Arbitrary constant identifying init_db's advisory lock
+INIT_DB_LOCK_KEY = 72210001
+
+
+def dialect_insert(model):
+    """
+    INSERT construct with on_conflict_do_update/do_nothing for the bound dialect
+    (Postgres in production, SQLite for local runs).
+    """
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
+
+
+def init_db():
+    """
+    Create missing tables, plus nullable columns and indexes added to models after their
+    table already existed (create_all alone skips those). Must run inside an app context.
+    Safe to run from several processes booting at once.
+    """
+    with db.engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            # Serialize concurrent boots (e.g. gunicorn workers) so CREATE TABLE doesn't race
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': INIT_DB_LOCK_KEY})
+        db.metadata.create_all(conn)
+        inspector = inspect(conn)
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(conn.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
 class User(db.Model):
     __tablename__ = 'users'
     
@@ -13,9 +52,78 @@ class User(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # Partial index backing the keyset scan over active subscribers
+        db.Index(
+            'ix_users_active_line_user_id', 'line_user_id',
+            postgresql_where=is_active.is_(True),
+            sqlite_where=is_active.is_(True),
+        ),
+    )
+
     def __repr__(self):
         return f'<User {self.line_user_id}>'
 
+class FollowerStaging(db.Model):
+    """
+    LINE follower ids streamed in by one reconciliation run (services.followers),
+    diffed against users and then deleted. run_id keeps overlapping runs apart.
+    """
+    __tablename__ = 'follower_staging'
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    run_id = db.Column(db.String(32), nullable=False)
+    line_user_id = db.Column(db.String(50), nullable=False)
+
+    __table_args__ = (
+        # Backs the EXISTS / NOT EXISTS probes of the set difference
+        db.Index('ix_follower_staging_run_id_line_user_id', 'run_id', 'line_user_id'),
+    )
+
+    def __repr__(self):
+        return f'<FollowerStaging {self.run_id} {self.line_user_id}>'
+
+class Subscription(db.Model):
+    """
+    Per-user stock watchlist. Users with any subscription get a report filtered
+    to their stocks; users without one get the full report.
+    stock_id is not a foreign key so users can follow a ticker before it is scraped.
+    """
+    __tablename__ = 'subscriptions'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    stock_id = db.Column(db.String(10), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Inverted index: stock -> subscribers
+        db.Index('ix_subscriptions_stock_id_user_id', 'stock_id', 'user_id'),
+    )
+
+    def __repr__(self):
+        return f'<Subscription {self.user_id} {self.stock_id}>'
+
+class KeywordAlert(db.Model):
+    """
+    Gift keyword a user wants alerts for (e.g. "咖啡"). Rows are deactivated, not deleted,
+    so KeywordMatcher can sync changes incrementally by updated_at.
+    """
+    __tablename__ = 'keyword_alerts'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    keyword = db.Column(db.String(50), nullable=False)
+    is_active = db.Column(db.Boolean, nullable=False, default=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'keyword', name='uq_keyword_alerts_user_id_keyword'),
+        db.Index('ix_keyword_alerts_updated_at', 'updated_at'),
+    )
+
+    def __repr__(self):
+        return f'<KeywordAlert {self.user_id} {self.keyword}>'
+
 class Stock(db.Model):
     __tablename__ = 'stocks'
     
@@ -26,7 +134,256 @@ class Stock(db.Model):
     vote_start_date = db.Column(db.Date)
     last_buy_date = db.Column(db.Date)
     gift_year = db.Column(db.Integer)
+    # {field: source name} for the values last written (services.sources.merge_results)
+    field_sources = db.Column(db.JSON)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
         return f'<Stock {self.stock_id} {self.name}>'
+
+class StockHistory(db.Model):
+    """
+    One row per stock per gift season, bulk-loaded by services.backfill.
+    On Postgres the table is list-partitioned by gift_year (one partition per
+    season, created on load), so a season is reloaded or dropped as a unit.
+    """
+    __tablename__ = 'stock_history'
+
+    stock_id = db.Column(db.String(10), primary_key=True)
+    gift_year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    gift_name = db.Column(db.String(200))
+    meeting_date = db.Column(db.Date, nullable=False)
+    vote_start_date = db.Column(db.Date)
+    last_buy_date = db.Column(db.Date)
+    loaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Per-season listings by date (the primary key serves per-stock history)
+        db.Index('ix_stock_history_gift_year_meeting_date', 'gift_year', 'meeting_date'),
+        {'postgresql_partition_by': 'LIST (gift_year)'},
+    )
+
+    def __repr__(self):
+        return f'<StockHistory {self.stock_id} {self.gift_year}>'
+
+# Rows for seasons without their own partition yet land here
+event.listen(
+    StockHistory.__table__, 'after_create',
+    DDL("CREATE TABLE IF NOT EXISTS stock_history_default PARTITION OF stock_history DEFAULT")
+    .execute_if(dialect='postgresql'),
+)
+
+class BackfillCheckpoint(db.Model):
+    """
+    Progress of the historical backfill, one row per gift season. A season is
+    'done' only in the transaction that loaded its rows, so a rerun skips exactly
+    the seasons already loaded.
+    """
+    __tablename__ = 'backfill_checkpoints'
+
+    gift_year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    status = db.Column(db.String(20), nullable=False)  # 'running' / 'done' / 'failed'
+    source = db.Column(db.String(20))  # 'live' / 'snapshot'
+    content_hash = db.Column(db.String(64))
+    rows = db.Column(db.Integer)
+    error = db.Column(db.Text)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<BackfillCheckpoint {self.gift_year} {self.status}>'
+
+class StockEvent(db.Model):
+    """
+    Append-only change log written by ScraperService.save_stocks.
+    changes: {field: [old, new]} (dates as ISO strings).
+    """
+    __tablename__ = 'stock_events'
+
+    id = db.Column(db.Integer, primary_key=True)
+    stock_id = db.Column(db.String(10), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # 'new' / 'updated'
+    changes = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        # "What changed since the last broadcast": range on created_at, stock_id from the index
+        db.Index('ix_stock_events_created_at_stock_id', 'created_at', 'stock_id', 'kind'),
+    )
+
+    def __repr__(self):
+        return f'<StockEvent {self.stock_id} {self.kind} {self.created_at}>'
+
+class PageSnapshot(db.Model):
+    """
+    Raw scraped pages, zlib-compressed. Lives in Postgres because Render's disk is ephemeral.
+    Used for conditional fetches (ETag / Last-Modified / content hash) and for re-parsing
+    old pages after a parser fix without hitting the site again. applied_at is set once
+    the page's rows were saved; only then may a 304 or an equal hash skip the page.
+    """
+    __tablename__ = 'page_snapshots'
+
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(50), nullable=False)
+    url = db.Column(db.String(500), nullable=False)
+    etag = db.Column(db.String(200))
+    last_modified = db.Column(db.String(100))
+    encoding = db.Column(db.String(50))
+    content_hash = db.Column(db.String(64), nullable=False)
+    body = db.Column(db.LargeBinary, nullable=False)
+    fetched_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    applied_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_page_snapshots_source_fetched_at', 'source', 'fetched_at'),
+    )
+
+    @property
+    def html(self):
+        return zlib.decompress(self.body).decode(self.encoding or 'utf-8', errors='replace')
+
+    @classmethod
+    def latest(cls, source):
+        return cls.query.filter_by(source=source).order_by(cls.fetched_at.desc(), cls.id.desc()).first()
+
+    def __repr__(self):
+        return f'<PageSnapshot {self.source} {self.fetched_at} {self.content_hash[:8]}>'
+
+class DeliveryLedger(db.Model):
+    """
+    One row per multicast chunk attempt. A chunk covers the sorted user-id range
+    [first_user_id, last_user_id]; 'sent' ranges are skipped when a job is resumed.
+    """
+    __tablename__ = 'delivery_ledger'
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_key = db.Column(db.String(100), nullable=False)
+    first_user_id = db.Column(db.String(50), nullable=False)
+    last_user_id = db.Column(db.String(50), nullable=False)
+    user_count = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False)  # 'sent' / 'failed'
+    attempts = db.Column(db.Integer, default=1)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_delivery_ledger_job_key_status', 'job_key', 'status'),
+    )
+
+    def __repr__(self):
+        return f'<DeliveryLedger {self.job_key} {self.first_user_id}..{self.last_user_id} {self.status}>'
+
+class DeliveryRun(db.Model):
+    """
+    One row per report delivery: the strategy DeliveryPlanner picked (and why),
+    how many API calls it took and how long delivery ran.
+    """
+    __tablename__ = 'delivery_runs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_key = db.Column(db.String(100), nullable=False)
+    strategy = db.Column(db.String(20), nullable=False)  # 'broadcast' / 'narrowcast' / 'multicast' / 'none'
+    reason = db.Column(db.String(200))
+    audience_size = db.Column(db.Integer, nullable=False)
+    api_calls = db.Column(db.Integer, default=0)
+    # 'running' / 'sent' / 'accepted' (narrowcast still in progress) / 'partial' / 'failed' / 'skipped'
+    status = db.Column(db.String(20), nullable=False)
+    request_id = db.Column(db.String(64))  # broadcast / narrowcast X-Line-Request-Id
+    audience_group_id = db.Column(db.BigInteger)  # Narrowcast audience, cleared once deleted on LINE
+    error = db.Column(db.Text)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    seconds = db.Column(db.Float)
+
+    __table_args__ = (
+        db.Index('ix_delivery_runs_job_key_status', 'job_key', 'status'),
+    )
+
+    def __repr__(self):
+        return f'<DeliveryRun {self.job_key} {self.strategy} {self.status}>'
+
+class Reminder(db.Model):
+    """
+    Due queue of "last buy date is tomorrow" reminders, one per (stock, last buy date),
+    kept in step with stocks by ScraperService.save_stocks (services.reminders).
+    sent_at is set by the process that claims the row.
+    """
+    __tablename__ = 'reminders'
+
+    id = db.Column(db.Integer, primary_key=True)
+    stock_id = db.Column(db.String(10), nullable=False)
+    last_buy_date = db.Column(db.Date, nullable=False)
+    due_at = db.Column(db.DateTime, nullable=False)  # UTC
+    sent_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('stock_id', 'last_buy_date', name='uq_reminders_stock_id_last_buy_date'),
+        # Only unsent rows are indexed, so loading what is due stays a short range scan
+        db.Index(
+            'ix_reminders_due_at_unsent', 'due_at',
+            postgresql_where=db.text('sent_at IS NULL'),
+            sqlite_where=db.text('sent_at IS NULL'),
+        ),
+    )
+
+    def __repr__(self):
+        return f'<Reminder {self.stock_id} {self.last_buy_date} {self.due_at}>'
+
+class RenderedReport(db.Model):
+    """
+    Serialized Flex payloads keyed by a content hash of the reported stocks (utils.flex.report_key).
+    Rows not used for a while are pruned (utils.flex.prune_rendered_reports).
+    """
+    __tablename__ = 'rendered_reports'
+
+    report_key = db.Column(db.String(64), primary_key=True)
+    payload = db.Column(db.Text, nullable=False)  # JSON list of message dicts
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime)  # Refreshed at most once a day by cache hits
+
+    def __repr__(self):
+        return f'<RenderedReport {self.report_key[:8]}>'
+
+class Watermark(db.Model):
+    """
+    Named progress markers, e.g. 'broadcast': stock events up to this time have been
+    delivered. Set only after the work they describe has succeeded.
+    """
+    __tablename__ = 'watermarks'
+
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.DateTime, nullable=False)  # UTC
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Watermark {self.name} {self.value}>'
+
+class Job(db.Model):
+    """
+    Scheduled job runs. (kind, run_at) is unique, so every process may enqueue the
+    same cron fire time and only one row exists; workers claim rows with
+    FOR UPDATE SKIP LOCKED, so each run executes once.
+    """
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    run_at = db.Column(db.DateTime, nullable=False)  # Scheduled fire time (UTC)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending/running/done/failed/missed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    claimed_by = db.Column(db.String(100))
+    started_at = db.Column(db.DateTime)
+    lease_expires_at = db.Column(db.DateTime)  # Pushed forward by the running worker's heartbeat
+    finished_at = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'run_at', name='uq_jobs_kind_run_at'),
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    def __repr__(self):
+        return f'<Job {self.kind} {self.run_at} {self.status}>'
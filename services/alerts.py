@@ -0,0 +1,91 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from models import db, User, KeywordAlert
+from utils.aho import KeywordAutomaton
+
+logger = logging.getLogger(__name__)
+
+MAX_KEYWORD_LENGTH = 50
+
+
+def normalize_keyword(keyword):
+    return (keyword or '').strip().lower()
+
+
+class KeywordMatcher:
+    """
+    Matches gift names against every registered keyword in one pass
+    (Aho-Corasick, see utils.aho). sync() applies only keyword_alerts rows
+    changed since the previous sync, so the automaton is updated incrementally.
+    """
+
+    def __init__(self):
+        self.automaton = KeywordAutomaton()
+        self.subscribers = defaultdict(set)  # keyword -> {line_user_id}
+        self._synced_at = None
+
+    def sync(self):
+        """
+        Pull keyword changes since the last sync. Must run inside an app context.
+        """
+        query = db.session.query(KeywordAlert.keyword, KeywordAlert.is_active, KeywordAlert.updated_at, User.line_user_id) \
+            .join(User, User.id == KeywordAlert.user_id)
+        if self._synced_at is not None:
+            # >= so rows sharing the watermark timestamp are not missed (re-applying is harmless)
+            query = query.filter(KeywordAlert.updated_at >= self._synced_at)
+
+        changed = 0
+        for keyword, is_active, updated_at, line_user_id in query.order_by(KeywordAlert.updated_at):
+            users = self.subscribers[keyword]
+            if is_active:
+                users.add(line_user_id)
+                self.automaton.add(keyword)
+            else:
+                users.discard(line_user_id)
+                if not users:
+                    del self.subscribers[keyword]
+                    self.automaton.remove(keyword)
+            self._synced_at = updated_at
+            changed += 1
+
+        if changed:
+            logger.info(f"Keyword matcher synced {changed} changes ({len(self.automaton)} keywords).")
+
+    def match(self, stocks):
+        """
+        {line_user_id: {stock_id, ...}} for stocks whose gift_name contains a user's keyword.
+        """
+        matches = defaultdict(set)
+        if not len(self.automaton):
+            return matches
+        for stock in stocks:
+            for keyword in self.automaton.search(normalize_keyword(stock.gift_name)):
+                for line_user_id in self.subscribers.get(keyword, ()):
+                    matches[line_user_id].add(stock.stock_id)
+        return matches
+
+
+def set_alert(line_user_id, keyword, enabled):
+    """
+    Register or deactivate a gift keyword for a user (creating the user if needed).
+    """
+    keyword = normalize_keyword(keyword)
+    if not keyword or len(keyword) > MAX_KEYWORD_LENGTH:
+        return False
+
+    user = User.query.filter_by(line_user_id=line_user_id).first()
+    if not user:
+        user = User(line_user_id=line_user_id, is_active=True)
+        db.session.add(user)
+        db.session.flush()
+
+    alert = KeywordAlert.query.filter_by(user_id=user.id, keyword=keyword).first()
+    if alert:
+        alert.is_active = enabled
+        alert.updated_at = datetime.utcnow()
+    elif enabled:
+        db.session.add(KeywordAlert(user_id=user.id, keyword=keyword))
+    db.session.commit()
+    return True
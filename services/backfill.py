@@ -0,0 +1,225 @@
+import csv
+import hashlib
+import io
+import logging
+import re
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from sqlalchemy import text
+
+from models import db, BackfillCheckpoint, PageSnapshot, StockHistory
+from services.scraper import REQUEST_HEADERS, ScraperService
+from utils.http import get_client
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FIELDS = ('stock_id', 'gift_year', 'name', 'gift_name', 'meeting_date', 'vote_start_date', 'last_buy_date')
+
+# Rows per multi-row INSERT when COPY is not available (SQLite)
+INSERT_BATCH_SIZE = 1000
+
+# Seconds per season page request
+FETCH_TIMEOUT = 30
+
+# Season named in a page title: '2026' or ROC '115年'
+TITLE_RE = re.compile(r'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+YEAR_RE = re.compile(r'(20\d{2})')
+ROC_YEAR_RE = re.compile(r'(1\d{2})\s*年')
+
+# response: the live HTTP response (None when parsed from a stored snapshot)
+SeasonPage = namedtuple('SeasonPage', ['year', 'url', 'rows', 'response'])
+
+
+def snapshot_source(year):
+    """
+    PageSnapshot.source for a season page.
+    """
+    return f"histock:{year}"
+
+
+def page_gift_year(html):
+    """
+    Gift season named in the page <title>, or None.
+    """
+    match = TITLE_RE.search(html[:4096])
+    if not match:
+        return None
+    title = match.group(1)
+    year = YEAR_RE.search(title)
+    if year:
+        return int(year.group(1))
+    roc_year = ROC_YEAR_RE.search(title)
+    return int(roc_year.group(1)) + 1911 if roc_year else None
+
+
+class HistoryBackfill:
+    """
+    Loads past gift seasons into stock_history.
+
+    Season pages are fetched (or read from stored snapshots) and parsed in a
+    thread pool; the calling thread loads each season as it completes: its rows
+    are replaced with one COPY (multi-row INSERTs on SQLite) and its
+    backfill_checkpoints row is marked 'done' in the same transaction. A rerun
+    skips seasons already done, so an interrupted backfill resumes where it
+    stopped. Must run inside an app context.
+    """
+
+    def __init__(self, url_template, workers=4, from_snapshots=False, scraper=None):
+        self.url_template = url_template
+        self.workers = workers
+        self.from_snapshots = from_snapshots
+        self.scraper = scraper or ScraperService()
+
+    @classmethod
+    def from_config(cls, config, from_snapshots=False):
+        return cls(
+            config['HISTOCK_SEASON_URL'],
+            workers=config['BACKFILL_WORKERS'],
+            from_snapshots=from_snapshots,
+        )
+
+    def run(self, years, force=False):
+        """
+        Backfill the given gift years. force: reload seasons already done.
+        Returns {'skipped': [year], 'loaded': {year: rows}, 'failed': {year: error}}.
+        """
+        years = sorted(set(years))
+        done = set()
+        if not force:
+            done = {
+                year for (year,) in db.session.query(BackfillCheckpoint.gift_year).filter(
+                    BackfillCheckpoint.gift_year.in_(years), BackfillCheckpoint.status == 'done'
+                )
+            }
+        pending = [year for year in years if year not in done]
+        summary = {'skipped': sorted(done), 'loaded': {}, 'failed': {}}
+        if done:
+            logger.info(f"Backfill: seasons {sorted(done)} already loaded, skipping.")
+        if not pending:
+            return summary
+
+        # Snapshots are read here; worker threads only do HTTP and parsing
+        html = {}
+        if self.from_snapshots:
+            for year in pending:
+                snapshot = PageSnapshot.latest(snapshot_source(year))
+                html[year] = snapshot.html if snapshot else None
+
+        for year in pending:
+            self._checkpoint(year, status='running', started_at=datetime.utcnow(), error=None)
+        db.session.commit()
+
+        start = time.perf_counter()
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='backfill')
+        try:
+            futures = {pool.submit(self._fetch_and_parse, year, html.get(year)): year for year in pending}
+            for future in as_completed(futures):
+                year = futures[future]
+                try:
+                    summary['loaded'][year] = self._load(future.result())
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Backfill {year} failed: {e}")
+                    self._checkpoint(year, status='failed', error=str(e), finished_at=datetime.utcnow())
+                    db.session.commit()
+                    summary['failed'][year] = str(e)
+        finally:
+            # On interrupt, seasons not loaded stay 'running' and are redone next time
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        logger.info(
+            f"Backfill: {len(summary['loaded'])} seasons ({sum(summary['loaded'].values())} rows) loaded, "
+            f"{len(summary['failed'])} failed in {time.perf_counter() - start:.1f}s."
+        )
+        return summary
+
+    def _fetch_and_parse(self, year, html=None):
+        # Runs in the pool: no DB access
+        url = self.url_template.format(year=year)
+        response = None
+        if html is None:
+            if self.from_snapshots:
+                raise RuntimeError(f"No stored snapshot for {snapshot_source(year)}")
+            logger.info(f"Fetching {url}...")
+            response = get_client().get(url, headers=REQUEST_HEADERS, timeout=FETCH_TIMEOUT)
+            response.raise_for_status()
+            html = response.text
+        # e.g. an archive URL that redirects to the current season
+        title_year = page_gift_year(html)
+        if title_year is not None and title_year != year:
+            raise RuntimeError(f"Page {url} lists the {title_year} season, not {year}")
+        return SeasonPage(year, url, self.scraper.parse_histock(html, gift_year=year), response)
+
+    def _load(self, page):
+        start = time.perf_counter()
+        content_hash = None
+        if page.response is not None:
+            # Keep the raw page so the season can be re-parsed offline later
+            content_hash = hashlib.sha256(page.response.content).hexdigest()
+            latest = PageSnapshot.latest(snapshot_source(page.year))
+            if not latest or latest.content_hash != content_hash:
+                self.scraper._store_snapshot(snapshot_source(page.year), page.url, page.response, content_hash)
+
+        # Valid rows only, one per stock (last wins)
+        rows = {}
+        for row in page.rows:
+            if self.scraper.validate_data(row):
+                rows[row['stock_id']] = dict(row, gift_year=page.year)
+        rows = list(rows.values())
+
+        # Replace the season and mark it done in one transaction
+        db.session.query(StockHistory).filter(StockHistory.gift_year == page.year) \
+            .delete(synchronize_session=False)
+        if db.engine.dialect.name == 'postgresql':
+            self._copy(page.year, rows)
+        else:
+            now = datetime.utcnow()
+            for i in range(0, len(rows), INSERT_BATCH_SIZE):
+                db.session.execute(StockHistory.__table__.insert(), [
+                    dict({field: row.get(field) for field in HISTORY_FIELDS}, loaded_at=now)
+                    for row in rows[i:i + INSERT_BATCH_SIZE]
+                ])
+        self._checkpoint(
+            page.year, status='done', rows=len(rows), error=None, finished_at=datetime.utcnow(),
+            source='live' if page.response is not None else 'snapshot', content_hash=content_hash,
+        )
+        db.session.commit()
+        logger.info(f"Backfill {page.year}: {len(rows)} rows loaded in {time.perf_counter() - start:.2f}s.")
+        return len(rows)
+
+    def _copy(self, year, rows):
+        # One partition per season (rows of seasons without one would land in the default)
+        db.session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS stock_history_{int(year)} "
+            f"PARTITION OF stock_history FOR VALUES IN ({int(year)})"
+        ))
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        now = datetime.utcnow().isoformat()
+        for row in rows:
+            # Empty unquoted CSV fields are NULL
+            writer.writerow([_csv_value(row.get(field)) for field in HISTORY_FIELDS] + [now])
+        buffer.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            f"COPY stock_history ({', '.join(HISTORY_FIELDS)}, loaded_at) FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+
+    def _checkpoint(self, year, **values):
+        checkpoint = db.session.get(BackfillCheckpoint, year)
+        if checkpoint is None:
+            checkpoint = BackfillCheckpoint(gift_year=year)
+            db.session.add(checkpoint)
+        for key, value in values.items():
+            setattr(checkpoint, key, value)
+        return checkpoint
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    return value.isoformat() if hasattr(value, 'isoformat') else value
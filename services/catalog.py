@@ -0,0 +1,215 @@
+import base64
+import bisect
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import date
+
+from sqlalchemy import func
+from models import db, Stock, StockEvent
+
+logger = logging.getLogger(__name__)
+
+API_FIELDS = ('stock_id', 'name', 'gift_name', 'meeting_date', 'vote_start_date', 'last_buy_date', 'gift_year')
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+# Rendered pages kept: (version, today, CatalogQuery) -> CatalogPage
+_PAGE_CACHE_SIZE = 256
+
+# Bumped by invalidate(); catalogs in this process rebuild on their next request
+_generation = 0
+_generation_lock = threading.Lock()
+
+CatalogPage = namedtuple('CatalogPage', ['body', 'etag'])
+_Snapshot = namedtuple('_Snapshot', ['generation', 'version', 'stocks', 'items', 'keys'])
+CatalogQuery = namedtuple('CatalogQuery', ['upcoming', 'meeting_from', 'meeting_to', 'gift_year', 'cursor', 'limit'])
+
+
+def invalidate():
+    """
+    Drop cached API responses in this process (save_stocks calls it after commit).
+    Other processes notice the change on their next version check.
+    """
+    global _generation
+    with _generation_lock:
+        _generation += 1
+
+
+def parse_query(args):
+    """
+    Request args -> CatalogQuery. Raises ValueError on bad input.
+    upcoming=true, meeting_from / meeting_to (YYYY-MM-DD), gift_year, cursor, limit.
+    """
+    upcoming = args.get('upcoming', 'false').lower()
+    if upcoming not in ('true', 'false', '1', '0'):
+        raise ValueError("upcoming must be true or false")
+
+    gift_year = args.get('gift_year')
+    limit = args.get('limit', DEFAULT_LIMIT)
+    try:
+        gift_year = int(gift_year) if gift_year else None
+        limit = int(limit)
+    except ValueError:
+        raise ValueError("gift_year and limit must be integers")
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+
+    return CatalogQuery(
+        upcoming=upcoming in ('true', '1'),
+        meeting_from=_parse_iso_date(args.get('meeting_from'), 'meeting_from'),
+        meeting_to=_parse_iso_date(args.get('meeting_to'), 'meeting_to'),
+        gift_year=gift_year,
+        cursor=_decode_cursor(args.get('cursor')),
+        limit=limit,
+    )
+
+
+class StockCatalog:
+    """
+    Read-only view of the stocks table for /api/stocks.
+    All stocks are loaded once per data version, sorted by (meeting_date, stock_id),
+    and pages are filtered and serialized from that snapshot and cached with their ETag,
+    so repeat requests cost a dict lookup. The snapshot is rebuilt after invalidate()
+    or when the latest stock_events id changes (checked at most every
+    version_check_seconds, the only DB access between changes).
+    """
+
+    def __init__(self, version_check_seconds=30):
+        self.version_check_seconds = version_check_seconds
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._pages = OrderedDict()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(version_check_seconds=config['API_VERSION_CHECK_SECONDS'])
+
+    def page(self, query, today=None):
+        """
+        CatalogPage for the query. Must be called inside an app context.
+        """
+        today = today or date.today()
+        snapshot = self._current()
+        # today matters for upcoming=true, so it is part of the key
+        key = (snapshot.version, today if query.upcoming else None, query)
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+                return page
+
+        page = self._render(snapshot, query, today)
+        with self._lock:
+            self._pages[key] = page
+            while len(self._pages) > _PAGE_CACHE_SIZE:
+                self._pages.popitem(last=False)
+        return page
+
+    def _current(self):
+        snapshot = self._snapshot
+        if self._fresh(snapshot, _generation):
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            generation = _generation
+            if self._fresh(snapshot, generation):
+                return snapshot
+
+            version = db.session.query(func.max(StockEvent.id)).scalar() or 0
+            self._checked_at = time.monotonic()
+            if snapshot and snapshot.version == version:
+                self._snapshot = snapshot._replace(generation=generation)
+                return self._snapshot
+
+            # Plain rows, not ORM objects: the snapshot outlives the session
+            stocks = db.session.query(*[getattr(Stock, field) for field in API_FIELDS]) \
+                .order_by(Stock.meeting_date, Stock.stock_id) \
+                .all()
+            self._snapshot = snapshot = _Snapshot(
+                generation=generation,
+                version=version,
+                stocks=stocks,
+                items=[{field: _json_value(getattr(s, field)) for field in API_FIELDS} for s in stocks],
+                keys=[(s.meeting_date, s.stock_id) for s in stocks],
+            )
+            self._pages.clear()
+            logger.info(f"Stock catalog loaded: {len(stocks)} stocks (version {version}).")
+            return snapshot
+
+    def _fresh(self, snapshot, generation):
+        return (
+            snapshot is not None
+            and snapshot.generation == generation
+            and time.monotonic() - self._checked_at < self.version_check_seconds
+        )
+
+    def _render(self, snapshot, query, today):
+        stocks, keys = snapshot.stocks, snapshot.keys
+
+        # Keyset: resume strictly after the cursor, and skip straight to meeting_from
+        start = 0
+        if query.cursor:
+            start = bisect.bisect_right(keys, query.cursor)
+        if query.meeting_from:
+            start = max(start, bisect.bisect_left(keys, (query.meeting_from, '')))
+
+        data = []
+        last = None
+        next_cursor = None
+        for i in range(start, len(stocks)):
+            stock = stocks[i]
+            if query.meeting_to and stock.meeting_date > query.meeting_to:
+                break
+            if query.gift_year is not None and stock.gift_year != query.gift_year:
+                continue
+            if query.upcoming and (stock.last_buy_date is None or stock.last_buy_date < today):
+                continue
+            if len(data) == query.limit:
+                # More rows match: the next page starts after the last one returned
+                next_cursor = _encode_cursor(keys[last])
+                break
+            data.append(snapshot.items[i])
+            last = i
+
+        body = json.dumps(
+            # Content only, so a page keeps its ETag when other stocks change
+            {'data': data, 'next_cursor': next_cursor},
+            ensure_ascii=False, separators=(',', ':'),
+        ).encode('utf-8')
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        return CatalogPage(body, etag)
+
+
+def _json_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def _parse_iso_date(value, name):
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} must be YYYY-MM-DD")
+
+
+def _encode_cursor(key):
+    raw = json.dumps([key[0].isoformat(), key[1]], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(value):
+    if not value:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+        meeting_date, stock_id = json.loads(raw)
+        return (date.fromisoformat(meeting_date), str(stock_id))
+    except Exception:
+        raise ValueError("invalid cursor")
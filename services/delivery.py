@@ -0,0 +1,345 @@
+import logging
+import math
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import requests
+from linebot.exceptions import LineBotApiError
+from linebot.models import AudienceRecipient
+
+from models import db, DeliveryRun
+from services.dispatcher import MESSAGES_PER_REQUEST, flatten_user_ids, message_groups
+from utils import metrics
+from utils.http import line_post
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ('auto', 'broadcast', 'narrowcast', 'multicast')
+
+# User ids per audience upload request
+AUDIENCE_UPLOAD_LIMIT = 10000
+
+# Audience groups of narrowcasts still sending when their run ended are deleted this much later
+STALE_AUDIENCE_SECONDS = 86400
+
+DELIVERY_SECONDS = metrics.histogram('delivery_seconds', "Report delivery time per strategy", ['strategy'])
+DELIVERY_RUNS = metrics.counter('delivery_runs_total', "Report deliveries by strategy and outcome", ['strategy', 'status'])
+
+# size: number of recipients; everyone: the audience is every active user, so a
+# broadcast reaches the same people; user_ids: callable returning a fresh sorted
+# iterable of ids (or id batches), as delivery may fall back and re-read it
+Audience = namedtuple('Audience', ['size', 'everyone', 'user_ids'])
+
+Plan = namedtuple('Plan', ['strategy', 'reason'])
+
+
+class NarrowcastFailed(Exception):
+    pass
+
+
+class DeliveryFailed(Exception):
+    """
+    A delivery ended 'failed' or 'partial'; `run` is the planner's summary dict.
+    Raised so the job running it is recorded as failed (and retried).
+    """
+
+    def __init__(self, job_key, run):
+        super().__init__(f"Delivery {job_key} {run['status']}: {run.get('error') or 'no details'}")
+        self.job_key = job_key
+        self.run = run
+
+
+class DeliveryPlanner:
+    """
+    Picks the cheapest way to deliver one report and records it in DeliveryRun:
+    - broadcast: the audience is every active user and LINE's follower reach matches
+      the users table (within broadcast_tolerance): one call regardless of size.
+    - narrowcast: large audiences (>= narrowcast_min_audience) are uploaded as an
+      audience group, 10,000 ids per request, then sent with one narrowcast call.
+    - multicast: chunks of 500 through MulticastDispatcher (resumable via the ledger).
+    A send that would exceed the remaining monthly message quota is skipped.
+    Must be called inside an app context.
+    """
+
+    def __init__(self, line_bot_api, dispatcher, strategy='auto', broadcast_tolerance=0.02,
+                 narrowcast_min_audience=5000, progress_timeout=300, poll_interval=5):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown delivery strategy {strategy!r}")
+        self.line_bot_api = line_bot_api
+        self.dispatcher = dispatcher
+        self.strategy = strategy
+        self.broadcast_tolerance = broadcast_tolerance
+        self.narrowcast_min_audience = narrowcast_min_audience
+        self.progress_timeout = progress_timeout
+        self.poll_interval = poll_interval
+        self._reach_cache = {}  # insight date -> reachable followers
+
+    @classmethod
+    def from_config(cls, line_bot_api, dispatcher, config):
+        return cls(
+            line_bot_api,
+            dispatcher,
+            strategy=config['DELIVERY_STRATEGY'],
+            broadcast_tolerance=config['BROADCAST_MATCH_TOLERANCE'],
+            narrowcast_min_audience=config['NARROWCAST_MIN_AUDIENCE'],
+            progress_timeout=config['NARROWCAST_PROGRESS_TIMEOUT'],
+        )
+
+    def deliver(self, job_key, audience, messages):
+        """
+        Deliver messages to the audience; returns a summary dict.
+        A broadcast or narrowcast already sent for job_key is not sent again.
+        Raises DeliveryFailed if some or all of the audience was not reached.
+        """
+        if self._already_sent(job_key):
+            logger.info(f"{job_key} already delivered, skipping.")
+            return {'strategy': None, 'status': 'skipped', 'audience': audience.size}
+
+        plan = self.plan(audience, messages)
+        logger.info(f"Delivering {job_key} to {audience.size} users by {plan.strategy}: {plan.reason}")
+        run = DeliveryRun(
+            job_key=job_key, strategy=plan.strategy, reason=plan.reason[:200],
+            audience_size=audience.size, api_calls=0, status='running',
+        )
+        db.session.add(run)
+        db.session.commit()
+
+        start = time.perf_counter()
+        try:
+            if plan.strategy == 'none':
+                run.status = 'skipped'
+            elif plan.strategy == 'broadcast':
+                self._broadcast(run, messages)
+            elif plan.strategy == 'narrowcast':
+                try:
+                    self._narrowcast(run, audience, messages)
+                except NarrowcastFailed as e:
+                    # Nobody received it, so multicast is safe
+                    logger.warning(f"Narrowcast for {job_key} failed ({e}), falling back to multicast.")
+                    run.strategy = 'multicast'
+                    run.reason = f"narrowcast failed: {e}"[:200]
+                    self._multicast(run, job_key, audience, messages)
+            else:
+                self._multicast(run, job_key, audience, messages)
+        except Exception as e:
+            db.session.rollback()
+            run.status = 'failed'
+            run.error = str(e)
+            logger.error(f"Delivery {job_key} by {run.strategy} failed: {e}")
+        finally:
+            run.seconds = time.perf_counter() - start
+            run.finished_at = datetime.utcnow()
+            db.session.commit()
+            DELIVERY_SECONDS.observe(run.seconds, strategy=run.strategy)
+            DELIVERY_RUNS.inc(strategy=run.strategy, status=run.status)
+
+        logger.info(
+            f"Delivery {job_key}: {run.strategy} {run.status} in {run.seconds:.2f}s "
+            f"({run.api_calls} API calls, {audience.size} users)."
+        )
+        summary = {
+            'strategy': run.strategy, 'status': run.status, 'audience': audience.size,
+            'api_calls': run.api_calls, 'seconds': run.seconds, 'error': run.error,
+        }
+        if run.status in ('failed', 'partial'):
+            raise DeliveryFailed(job_key, summary)
+        return summary
+
+    def plan(self, audience, messages):
+        """
+        Plan(strategy, reason); strategy 'none' means skip (not enough quota).
+        """
+        requests_per_user = math.ceil(len(messages) / MESSAGES_PER_REQUEST)
+        if self.strategy != 'auto':
+            if self.strategy == 'broadcast' and not audience.everyone:
+                return Plan('multicast', "broadcast forced but the audience is a subset")
+            return Plan(self.strategy, "forced by DELIVERY_STRATEGY")
+
+        remaining = self._remaining_quota()
+        note = ''
+        if audience.everyone:
+            reach = self._reach()
+            if reach and abs(reach - audience.size) <= self.broadcast_tolerance * reach:
+                cost = reach * requests_per_user
+                if remaining is None or cost <= remaining:
+                    return Plan('broadcast', f"audience is all {audience.size} active users, LINE reach {reach}")
+                note = f"broadcast needs {cost} of {remaining} remaining messages; "
+            elif reach:
+                note = f"LINE reach {reach} differs from {audience.size} active users; "
+
+        cost = audience.size * requests_per_user
+        if remaining is not None and cost > remaining:
+            return Plan('none', f"{note}needs {cost} messages, {remaining} left in quota")
+        if audience.size >= self.narrowcast_min_audience:
+            return Plan('narrowcast', f"{note}{audience.size} users >= {self.narrowcast_min_audience}")
+        return Plan('multicast', f"{note}{audience.size} users")
+
+    def _multicast(self, run, job_key, audience, messages):
+        summary = self.dispatcher.dispatch(job_key, audience.user_ids(), messages)
+        run.api_calls += summary['requests']
+        if summary['failed'] == 0:
+            run.status = 'sent'
+        else:
+            run.status = 'partial' if summary['sent'] or summary['skipped'] else 'failed'
+            run.error = f"{summary['failed']} users failed"
+
+    def _broadcast(self, run, messages):
+        for group in message_groups(messages):
+            responses = []
+            run.api_calls += self.dispatcher.call_with_retries(
+                lambda api, retry_key: responses.append(api.broadcast(group, retry_key=retry_key)),
+                'Broadcast',
+            )
+            if responses:
+                run.request_id = responses[-1].request_id
+        run.status = 'sent'
+
+    def _narrowcast(self, run, audience, messages):
+        # Groups left by narrowcasts that were still sending when their run ended
+        self._delete_stale_audiences(run)
+        request_ids = []
+        try:
+            try:
+                self._upload_audience(run, audience)
+                db.session.commit()
+                for group in message_groups(messages):
+                    run.api_calls += self.dispatcher.call_with_retries(
+                        lambda api, retry_key: request_ids.append(
+                            post_narrowcast(api, group, run.audience_group_id, retry_key)),
+                        'Narrowcast',
+                    )
+            except LineBotApiError as e:
+                # Rejected up front (audience too small, plan limits, ...): nobody got
+                # anything unless an earlier message group was accepted
+                if request_ids:
+                    raise
+                raise NarrowcastFailed(e.error.message if e.error else str(e)) from e
+            run.request_id = request_ids[-1] if request_ids else None
+            db.session.commit()
+            self._wait_for_narrowcast(run, request_ids)
+        finally:
+            # LINE caps audience groups per channel: drop this one unless LINE is still sending
+            if run.status != 'accepted':
+                self._delete_audience(run)
+
+    def _wait_for_narrowcast(self, run, request_ids):
+        # Narrowcast is asynchronous: wait for LINE to finish (bounded)
+        deadline = time.monotonic() + self.progress_timeout
+        pending = [request_id for request_id in request_ids if request_id]
+        failed = []
+        while pending and time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            still_pending = []
+            for request_id in pending:
+                progress = self.line_bot_api.get_progress_status_narrowcast(request_id)
+                run.api_calls += 1
+                if progress.phase == 'failed':
+                    failed.append(progress)
+                elif progress.phase != 'succeeded':
+                    still_pending.append(request_id)
+            pending = still_pending
+
+        if failed:
+            reason = failed[0].failed_description or failed[0].error_code
+            if len(failed) == len(request_ids) and not any(p.success_count for p in failed):
+                raise NarrowcastFailed(reason)
+            raise RuntimeError(f"{len(failed)} of {len(request_ids)} narrowcast requests failed: {reason}")
+        # Accepted but not confirmed within the timeout: LINE is still sending
+        run.status = 'accepted' if pending else 'sent'
+
+    def _upload_audience(self, run, audience):
+        # run.audience_group_id is set as soon as the group exists, so it is deleted even if an upload fails
+        batch = []
+        for user_id in flatten_user_ids(audience.user_ids()):
+            batch.append({'id': user_id})
+            if len(batch) >= AUDIENCE_UPLOAD_LIMIT:
+                self._upload_batch(run, batch)
+                batch = []
+        if batch or run.audience_group_id is None:
+            self._upload_batch(run, batch)
+
+    def _upload_batch(self, run, batch):
+        run.api_calls += 1
+        if run.audience_group_id is None:
+            created = self.line_bot_api.create_audience_group(f"stockgift {run.job_key}"[:120], audiences=batch)
+            run.audience_group_id = created.audience_group_id
+            db.session.commit()
+        else:
+            self.line_bot_api.add_audiences_to_audience_group(run.audience_group_id, batch)
+
+    def _delete_audience(self, run):
+        if run.audience_group_id is None:
+            return
+        try:
+            run.api_calls += 1
+            self.line_bot_api.delete_audience_group(run.audience_group_id)
+        except LineBotApiError as e:
+            if e.status_code != 404:
+                logger.warning(f"Failed to delete audience group {run.audience_group_id}: {e}")
+                return
+        except requests.RequestException as e:
+            logger.warning(f"Failed to delete audience group {run.audience_group_id}: {e}")
+            return
+        # audience_group_id is kept only while the group exists on LINE
+        run.audience_group_id = None
+        db.session.commit()
+
+    def _delete_stale_audiences(self, current, older_than=STALE_AUDIENCE_SECONDS):
+        cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+        stale = DeliveryRun.query.filter(
+            DeliveryRun.audience_group_id.isnot(None),
+            DeliveryRun.id != current.id,
+            DeliveryRun.status != 'running',
+            DeliveryRun.finished_at < cutoff,
+        ).all()
+        for run in stale:
+            self._delete_audience(run)
+
+    def _already_sent(self, job_key):
+        return db.session.query(DeliveryRun.id).filter(
+            DeliveryRun.job_key == job_key,
+            DeliveryRun.strategy.in_(('broadcast', 'narrowcast')),
+            DeliveryRun.status.in_(('sent', 'accepted')),
+        ).first() is not None
+
+    def _reach(self):
+        """
+        Followers LINE can deliver to (followers - blocks) as of yesterday, or None.
+        """
+        day = (datetime.now() - timedelta(days=1)).strftime('%Y%m%d')
+        if day not in self._reach_cache:
+            try:
+                insight = self.line_bot_api.get_insight_followers(day)
+                ready = insight.status == 'ready' and insight.followers is not None
+                self._reach_cache[day] = insight.followers - (insight.blocks or 0) if ready else None
+            except Exception as e:
+                logger.warning(f"Follower insight unavailable: {e}")
+                return None
+        return self._reach_cache[day]
+
+    def _remaining_quota(self):
+        """
+        Messages left this month, or None if unlimited or unknown.
+        """
+        try:
+            quota = self.line_bot_api.get_message_quota()
+            if quota.type != 'limited':
+                return None
+            used = self.line_bot_api.get_message_quota_consumption().total_usage or 0
+            return max(0, quota.value - used)
+        except Exception as e:
+            logger.warning(f"Message quota unavailable: {e}")
+            return None
+
+
+def post_narrowcast(api, messages, audience_group_id, retry_key):
+    """
+    Narrowcast to an audience group; returns the request id for progress polling.
+    The v2 SDK's narrowcast() requires filter and limit objects, so the minimal body is posted directly.
+    """
+    response = line_post(api, '/v2/bot/message/narrowcast', {
+        'messages': [message.as_json_dict() for message in messages],
+        'recipient': AudienceRecipient(group_id=audience_group_id).as_json_dict(),
+    }, retry_key=retry_key)
+    return response.headers.get('X-Line-Request-Id')
@@ -0,0 +1,294 @@
+import bisect
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from linebot.exceptions import LineBotApiError
+
+from models import db, DeliveryLedger
+from utils import metrics
+from utils.http import scoped_line_api
+
+logger = logging.getLogger(__name__)
+
+# LINE multicast accepts up to 500 recipients and 5 messages per request
+MULTICAST_LIMIT = 500
+MESSAGES_PER_REQUEST = 5
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+CHUNK_SECONDS = metrics.histogram(
+    'multicast_chunk_seconds', "Time to deliver one chunk, retries and rate-limit waits included", ['status'])
+CHUNKS = metrics.counter('multicast_chunks_total', "Chunks by final status (sent, failed)", ['status'])
+RECIPIENTS = metrics.counter('multicast_recipients_total', "Recipients by final status (sent, failed)", ['status'])
+RETRIES = metrics.counter('line_request_retries_total', "Retried LINE send requests by cause (HTTP status or 'connection')", ['reason'])
+
+
+class RateLimiter:
+    """
+    Spaces calls evenly at `rate` per second across threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class MulticastDispatcher:
+    """
+    Sends multicast chunks concurrently, rate limited, with jittered backoff on
+    429/5xx (honouring Retry-After). Every chunk's outcome goes to DeliveryLedger,
+    so re-running the same job_key only sends to users not yet covered by a 'sent' chunk.
+    Reports of more than 5 messages go out as consecutive requests, each recorded
+    under its own ledger key (see ledger_key), so a resume sends a user only the
+    message groups they have not received yet.
+    Callers must supply user ids in sorted order (ledger ranges rely on it).
+    """
+
+    def __init__(self, line_bot_api, max_workers=8, rate=50, max_retries=5,
+                 base_delay=1.0, max_delay=60.0):
+        self.line_bot_api = line_bot_api
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(rate)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def from_config(cls, line_bot_api, config):
+        return cls(
+            line_bot_api,
+            max_workers=config['LINE_MULTICAST_WORKERS'],
+            rate=config['LINE_MULTICAST_RATE'],
+            max_retries=config['LINE_MULTICAST_MAX_RETRIES'],
+        )
+
+    def dispatch(self, job_key, user_ids, messages, chunk_size=MULTICAST_LIMIT):
+        """
+        user_ids: sorted iterable of LINE user ids (or of sorted batches, see flatten_user_ids).
+        Must be called inside an app context. Returns counts of users sent / failed / skipped,
+        chunks and send requests.
+        """
+        summary = {'sent': 0, 'failed': 0, 'skipped': 0, 'chunks': 0, 'requests': 0}
+        groups = message_groups(messages)
+        sent_ranges = [self._sent_ranges(ledger_key(job_key, group)) for group in range(len(groups))]
+        if any(sent_ranges):
+            logger.info(f"Resuming {job_key}: {sum(map(len, sent_ranges))} chunk ranges already delivered.")
+
+        pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='multicast')
+        in_flight = {}
+        try:
+            for chunk, first_group in self._pending_chunks(user_ids, sent_ranges, chunk_size, summary):
+                # Bounded in-flight work keeps memory flat for large audiences
+                while len(in_flight) >= self.max_workers * 2:
+                    self._collect(job_key, in_flight, summary)
+                future = pool.submit(self._timed_send, chunk, groups, first_group)
+                in_flight[future] = (chunk, first_group)
+            while in_flight:
+                self._collect(job_key, in_flight, summary)
+        finally:
+            pool.shutdown(wait=True)
+
+        logger.info(
+            f"Dispatch {job_key}: {summary['sent']} sent, {summary['failed']} failed, "
+            f"{summary['skipped']} skipped (already delivered) in {summary['chunks']} chunks."
+        )
+        return summary
+
+    def _sent_ranges(self, key):
+        rows = db.session.query(DeliveryLedger.first_user_id, DeliveryLedger.last_user_id) \
+            .filter_by(job_key=key, status='sent') \
+            .order_by(DeliveryLedger.first_user_id) \
+            .all()
+        # Merged, so a range recorded by a resume that spans older ones is looked up correctly
+        merged = []
+        for first, last in rows:
+            if merged and first <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        return merged
+
+    def _pending_chunks(self, user_ids, sent_ranges, chunk_size, summary):
+        """
+        Yield (chunk, first_group): users still missing message groups first_group onwards.
+        Groups go out in order, so a user's first group not yet delivered is where they resume.
+        A chunk holds consecutive pending users with the same first_group only, so its ledger
+        range never spans a user who is still missing an earlier group.
+        """
+        starts = [[r[0] for r in ranges] for ranges in sent_ranges]
+        chunk, chunk_group = [], None
+        for user_id in flatten_user_ids(user_ids):
+            first_group = len(sent_ranges)
+            for group, ranges in enumerate(sent_ranges):
+                i = bisect.bisect_right(starts[group], user_id) - 1
+                if i < 0 or user_id > ranges[i][1]:
+                    first_group = group
+                    break
+            if first_group == len(sent_ranges):
+                summary['skipped'] += 1
+                continue
+            if chunk and (first_group != chunk_group or len(chunk) >= chunk_size):
+                yield chunk, chunk_group
+                chunk = []
+            chunk.append(user_id)
+            chunk_group = first_group
+        if chunk:
+            yield chunk, chunk_group
+
+    def _collect(self, job_key, in_flight, summary):
+        done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+        for future in done:
+            chunk, first_group = in_flight.pop(future)
+            summary['chunks'] += 1
+            try:
+                attempts, groups_sent = future.result()
+                status, error = 'sent', None
+                summary['sent'] += len(chunk)
+            except Exception as e:
+                attempts = getattr(e, 'attempts', None)
+                groups_sent = getattr(e, 'groups_sent', 0)
+                status, error = 'failed', str(e)
+                summary['failed'] += len(chunk)
+                logger.error(f"Failed to send chunk {chunk[0]}..{chunk[-1]}: {e}")
+            summary['requests'] += groups_sent + (status == 'failed')
+            CHUNKS.inc(status=status)
+            RECIPIENTS.inc(len(chunk), status=status)
+
+            # One row per message group delivered, plus the group that failed
+            for group in range(first_group, first_group + groups_sent):
+                db.session.add(self._ledger_row(ledger_key(job_key, group), chunk, 'sent', attempts))
+            if status == 'failed':
+                db.session.add(self._ledger_row(
+                    ledger_key(job_key, first_group + groups_sent), chunk, 'failed', attempts, error))
+            db.session.commit()
+
+    def _ledger_row(self, key, chunk, status, attempts, error=None):
+        return DeliveryLedger(
+            job_key=key,
+            first_user_id=chunk[0],
+            last_user_id=chunk[-1],
+            user_count=len(chunk),
+            status=status,
+            attempts=attempts,
+            error=error,
+        )
+
+    def _timed_send(self, chunk, groups, first_group=0):
+        start = time.perf_counter()
+        status = 'failed'
+        try:
+            result = self._send(chunk, groups, first_group)
+            status = 'sent'
+            return result
+        finally:
+            CHUNK_SECONDS.observe(time.perf_counter() - start, status=status)
+
+    def _send(self, chunk, groups, first_group=0):
+        """
+        Runs in a worker thread (no DB access). Sends message groups first_group onwards
+        to the chunk, in order; returns (attempts, groups sent). A failure is raised with
+        `attempts` and `groups_sent` (groups delivered before it) attributes.
+        """
+        attempts = 0
+        for sent, group in enumerate(groups[first_group:]):
+            try:
+                attempts += self._send_request(chunk, group)
+            except Exception as e:
+                e.attempts = attempts + (getattr(e, 'attempts', None) or 1)
+                e.groups_sent = sent
+                raise
+        return attempts, len(groups) - first_group
+
+    def _send_request(self, chunk, messages):
+        return self.call_with_retries(
+            lambda api, retry_key: api.multicast(chunk, messages, retry_key=retry_key),
+            'Multicast',
+        )
+
+    def call_with_retries(self, call, label='LINE call'):
+        """
+        call(line_bot_api, retry_key) with rate limiting and jittered backoff on
+        429/5xx and connection errors. Returns the number of attempts; the final
+        error is raised with an `attempts` attribute.
+        """
+        # Same retry key across attempts: LINE answers 409 if an earlier attempt got through
+        retry_key = str(uuid.uuid4())
+        api = scoped_line_api(self.line_bot_api)
+        attempt = 0
+        while True:
+            attempt += 1
+            self.limiter.acquire()
+            try:
+                call(api, retry_key)
+                return attempt
+            except LineBotApiError as e:
+                if e.status_code == 409 and e.accepted_request_id:
+                    return attempt
+                if e.status_code not in RETRYABLE_STATUS or attempt > self.max_retries:
+                    e.attempts = attempt
+                    raise
+                delay = self._retry_after(e.headers) or self._backoff(attempt)
+                RETRIES.inc(reason=e.status_code)
+                logger.warning(f"{label} got {e.status_code}, retry {attempt} in {delay:.1f}s.")
+            except requests.RequestException as e:
+                if attempt > self.max_retries:
+                    e.attempts = attempt
+                    raise
+                delay = self._backoff(attempt)
+                RETRIES.inc(reason='connection')
+                logger.warning(f"{label} connection error ({e}), retry {attempt} in {delay:.1f}s.")
+            time.sleep(delay)
+
+    def _backoff(self, attempt):
+        # Full jitter exponential backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _retry_after(self, headers):
+        value = (headers or {}).get('Retry-After') or (headers or {}).get('retry-after')
+        try:
+            return min(self.max_delay, float(value))
+        except (TypeError, ValueError):
+            return None
+
+
+def message_groups(messages):
+    """
+    Split a report into the consecutive groups of up to 5 messages one request can carry.
+    """
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    return [list(messages[i:i + MESSAGES_PER_REQUEST]) for i in range(0, len(messages), MESSAGES_PER_REQUEST)]
+
+
+def ledger_key(job_key, group):
+    """
+    DeliveryLedger.job_key for one message group of a report (the first keeps the plain job key).
+    """
+    return job_key if group == 0 else f"{job_key}#{group}"
+
+
+def flatten_user_ids(user_ids):
+    """
+    Accept either a flat iterable of ids or an iterable of id batches.
+    """
+    for item in user_ids:
+        if isinstance(item, (list, tuple)):
+            yield from item
+        else:
+            yield item
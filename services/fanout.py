@@ -0,0 +1,100 @@
+import logging
+from collections import defaultdict
+
+from sqlalchemy import exists
+
+from models import db, User, Subscription
+
+logger = logging.getLogger(__name__)
+
+# Stock ids per IN (...) when reading the inverted index
+LOOKUP_BATCH_SIZE = 500
+
+
+def plan_fanout(stock_ids, keyword_matches=None):
+    """
+    Group watchlist users by the exact set of reported stocks they follow.
+
+    Reads the stock -> subscribers index for the reported stock_ids only, adds
+    keyword alert matches ({line_user_id: {stock_id}}, see services.alerts) of
+    users with a watchlist (the others get the full report, see
+    plan_keyword_alerts), and
+    returns {tuple(sorted stock_ids): [sorted line_user_ids]}. Every user in a
+    group receives the same filtered report, so it is rendered once and multicast
+    to the whole group; API calls scale with distinct reports, not users.
+    Users without a watchlist are not included (see iter_active_user_batches).
+    """
+    stock_ids = list(stock_ids)
+    followed = defaultdict(set)  # line_user_id -> {stock_id, ...}
+    for i in range(0, len(stock_ids), LOOKUP_BATCH_SIZE):
+        rows = db.session.query(Subscription.stock_id, User.line_user_id) \
+            .join(User, User.id == Subscription.user_id) \
+            .filter(
+                Subscription.stock_id.in_(stock_ids[i:i + LOOKUP_BATCH_SIZE]),
+                User.is_active.is_(True)
+            )
+        for stock_id, line_user_id in rows:
+            followed[line_user_id].add(stock_id)
+
+    if keyword_matches:
+        for line_user_id in _active_matched_users(keyword_matches, with_watchlist=True):
+            followed[line_user_id] |= keyword_matches[line_user_id]
+
+    groups = _group(followed)
+    logger.info(f"Fan-out: {len(followed)} watchlist users in {len(groups)} distinct reports.")
+    return groups
+
+
+def plan_keyword_alerts(keyword_matches):
+    """
+    Group keyword alert matches ({line_user_id: {stock_id}}) of active users without
+    a watchlist by the exact set of matched stocks, like plan_fanout. Those users get
+    the full report, so their matches go out as a separate alert report on top of it.
+    """
+    matched = {
+        line_user_id: keyword_matches[line_user_id]
+        for line_user_id in _active_matched_users(keyword_matches, with_watchlist=False)
+    }
+    groups = _group(matched)
+    logger.info(f"Keyword alerts: {len(matched)} users without a watchlist in {len(groups)} distinct reports.")
+    return groups
+
+
+def _active_matched_users(keyword_matches, with_watchlist):
+    has_watchlist = exists().where(Subscription.user_id == User.id)
+    candidates = list(keyword_matches)
+    for i in range(0, len(candidates), LOOKUP_BATCH_SIZE):
+        active = db.session.query(User.line_user_id).filter(
+            User.line_user_id.in_(candidates[i:i + LOOKUP_BATCH_SIZE]),
+            User.is_active.is_(True),
+            has_watchlist if with_watchlist else ~has_watchlist
+        )
+        for (line_user_id,) in active:
+            yield line_user_id
+
+
+def _group(stocks_by_user):
+    groups = defaultdict(list)
+    for line_user_id, ids in stocks_by_user.items():
+        groups[tuple(sorted(ids))].append(line_user_id)
+    for user_ids in groups.values():
+        user_ids.sort()  # The delivery ledger relies on sorted ids
+    return dict(groups)
+
+
+def set_watch(line_user_id, stock_id, watching):
+    """
+    Add or remove one stock on a user's watchlist (creating the user if needed).
+    """
+    user = User.query.filter_by(line_user_id=line_user_id).first()
+    if not user:
+        user = User(line_user_id=line_user_id, is_active=True)
+        db.session.add(user)
+        db.session.flush()
+
+    subscription = db.session.get(Subscription, (user.id, stock_id))
+    if watching and not subscription:
+        db.session.add(Subscription(user_id=user.id, stock_id=stock_id))
+    elif not watching and subscription:
+        db.session.delete(subscription)
+    db.session.commit()
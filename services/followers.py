@@ -0,0 +1,192 @@
+import io
+import logging
+import re
+import uuid
+from datetime import datetime
+
+from sqlalchemy import exists, insert, literal, or_, select, update
+
+from models import db, FollowerStaging, User
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# LINE's maximum page size for GET /v2/bot/followers/ids
+FOLLOWERS_PAGE_SIZE = 1000
+
+# LINE user ids are 'U' + 32 hex chars; whitespace or backslashes would also break COPY's text format
+USER_ID_RE = re.compile(r'^[A-Za-z0-9_]{1,50}$')
+
+RECONCILE_SECONDS = metrics.histogram('follower_reconcile_seconds', "Follower reconciliation time per stage", ['stage'])
+RECONCILE_USERS = metrics.counter(
+    'follower_reconcile_users_total', "Users changed by follower reconciliation (added, reactivated, deactivated)",
+    ['change'])
+
+
+def iter_follower_ids(line_bot_api, page_size=FOLLOWERS_PAGE_SIZE):
+    """
+    Yield every follower's user id, one API page at a time.
+    """
+    start = None
+    while True:
+        page = line_bot_api.get_followers_ids(limit=page_size, start=start)
+        yield from page.user_ids
+        start = page.next
+        if not start:
+            return
+
+
+def iter_file_ids(path):
+    """
+    Yield user ids from a file with one id per line (stand-in for the follower-ids API).
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+class FollowerReconciler:
+    """
+    Brings users.is_active in line with LINE's follower list in one pass:
+    follower ids are streamed into follower_staging in batches (COPY on Postgres,
+    multi-row INSERTs elsewhere), so memory stays at one batch whatever the
+    follower count; then three set-based statements in one transaction add
+    unknown followers, reactivate returning ones and deactivate users who are no
+    longer followers. Users created after the run started are never deactivated,
+    and a run that would deactivate more than max_deactivate_ratio of the users
+    active before it is rolled back (e.g. a truncated or wrong follower list).
+    Must run inside an app context.
+    """
+
+    def __init__(self, line_bot_api, ids_file=None, batch_size=5000, max_deactivate_ratio=0.2):
+        self.line_bot_api = line_bot_api
+        self.ids_file = ids_file
+        self.batch_size = batch_size
+        self.max_deactivate_ratio = max_deactivate_ratio
+
+    @classmethod
+    def from_config(cls, line_bot_api, config):
+        return cls(
+            line_bot_api,
+            ids_file=config['FOLLOWER_IDS_FILE'],
+            batch_size=config['FOLLOWER_STAGING_BATCH'],
+            max_deactivate_ratio=config['FOLLOWER_MAX_DEACTIVATE_RATIO'],
+        )
+
+    def follower_ids(self):
+        if self.ids_file:
+            return iter_file_ids(self.ids_file)
+        return iter_follower_ids(self.line_bot_api)
+
+    def run(self):
+        """
+        Returns {'followers', 'added', 'reactivated', 'deactivated'}.
+        """
+        run_id = uuid.uuid4().hex
+        started = datetime.utcnow()
+        try:
+            with RECONCILE_SECONDS.time(stage='stage'):
+                staged = self._stage(run_id, self.follower_ids())
+            if not staged:
+                raise RuntimeError("No follower ids received, not reconciling.")
+            with RECONCILE_SECONDS.time(stage='apply'):
+                counts = self._apply(run_id, started)
+        finally:
+            self._cleanup(run_id)
+
+        counts['followers'] = staged
+        for change in ('added', 'reactivated', 'deactivated'):
+            RECONCILE_USERS.inc(counts[change], change=change)
+        logger.info(
+            f"Followers reconciled: {staged} followers, {counts['added']} added, "
+            f"{counts['reactivated']} reactivated, {counts['deactivated']} deactivated."
+        )
+        return counts
+
+    def _stage(self, run_id, user_ids):
+        staged = 0
+        batch = []
+        for user_id in user_ids:
+            if not _valid_user_id(user_id):
+                logger.warning(f"Skipping malformed follower id {user_id!r}.")
+                continue
+            batch.append(user_id)
+            if len(batch) >= self.batch_size:
+                staged += self._write_batch(run_id, batch)
+                batch = []
+        if batch:
+            staged += self._write_batch(run_id, batch)
+        return staged
+
+    def _write_batch(self, run_id, batch):
+        if db.engine.dialect.name == 'postgresql':
+            # COPY ... FROM STDIN through the session's psycopg2 connection
+            buffer = io.StringIO(''.join(f"{run_id}\t{user_id}\n" for user_id in batch))
+            cursor = db.session.connection().connection.cursor()
+            cursor.copy_expert("COPY follower_staging (run_id, line_user_id) FROM STDIN", buffer)
+        else:
+            db.session.execute(
+                FollowerStaging.__table__.insert(),
+                [{'run_id': run_id, 'line_user_id': user_id} for user_id in batch],
+            )
+        # Committed per batch, so a run over millions of ids is not one huge transaction
+        db.session.commit()
+        return len(batch)
+
+    def _apply(self, run_id, started):
+        staged = exists().where(
+            FollowerStaging.run_id == run_id,
+            FollowerStaging.line_user_id == User.line_user_id,
+        )
+        try:
+            # Before the run's own additions, so a list of mostly unknown ids cannot dilute the ratio
+            active = db.session.query(User.id).filter(User.is_active.is_(True)).count()
+            added = db.session.execute(
+                insert(User).from_select(
+                    ['line_user_id', 'is_active', 'created_at'],
+                    select(FollowerStaging.line_user_id, literal(True), literal(started))
+                    .where(
+                        FollowerStaging.run_id == run_id,
+                        ~exists().where(User.line_user_id == FollowerStaging.line_user_id),
+                    )
+                    .distinct(),
+                )
+            ).rowcount
+            reactivated = db.session.execute(
+                update(User)
+                .where(User.is_active.is_(False), staged)
+                .values(is_active=True)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+
+            deactivated = db.session.execute(
+                update(User)
+                .where(User.is_active.is_(True), or_(User.created_at.is_(None), User.created_at < started), ~staged)
+                .values(is_active=False)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if deactivated > self.max_deactivate_ratio * active:
+                raise RuntimeError(
+                    f"Reconciliation would deactivate {deactivated} of {active} active users "
+                    f"(limit {self.max_deactivate_ratio:.0%}), rolled back."
+                )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return {'added': added, 'reactivated': reactivated, 'deactivated': deactivated}
+
+    def _cleanup(self, run_id):
+        try:
+            db.session.query(FollowerStaging).filter(FollowerStaging.run_id == run_id) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Failed to clear follower staging for run {run_id}: {e}")
+
+
+def _valid_user_id(user_id):
+    return isinstance(user_id, str) and USER_ID_RE.match(user_id) is not None
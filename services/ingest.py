@@ -0,0 +1,183 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from models import db, dialect_insert, User
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+DROPPED = metrics.counter(
+    'webhook_state_changes_dropped_total', "Subscriber state changes dropped after every retry failed")
+
+# Queued by flush() to wake the flusher thread
+_STOP = object()
+
+
+class EventIngestor:
+    """
+    In-process queue for subscriber state changes coming from the webhook.
+    Handlers call submit() and return immediately; a background thread drains
+    the queue and applies the latest state per user as one batched upsert.
+    LINE has already had its 200, so a failed flush is retried with backoff
+    (max_retries times), then applied user by user; only the changes that still
+    fail are dropped (and logged).
+    active_cache (optional TTLCache) is filled with users known to be active once written.
+    """
+
+    def __init__(self, app, flush_interval=1.0, max_batch=500, max_queue=10000, active_cache=None,
+                 max_retries=3, retry_delay=0.5, max_retry_delay=10.0):
+        self.app = app
+        self.active_cache = active_cache
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopping = threading.Event()
+        atexit.register(self.flush)
+
+    @classmethod
+    def from_config(cls, app, active_cache=None):
+        return cls(
+            app,
+            flush_interval=app.config['WEBHOOK_FLUSH_INTERVAL'],
+            max_batch=app.config['WEBHOOK_FLUSH_BATCH'],
+            active_cache=active_cache,
+            max_retries=app.config['WEBHOOK_FLUSH_RETRIES'],
+        )
+
+    def submit(self, line_user_id, is_active):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((line_user_id, is_active))
+        except queue.Full:
+            # Backpressure: write this one inline rather than drop it
+            logger.warning("Webhook queue full, applying state change inline.")
+            self._apply([(line_user_id, is_active)])
+
+    def flush(self, timeout=30.0):
+        """
+        Apply everything submitted so far (used at shutdown): stop the flusher thread,
+        letting it apply the batch it has already taken off the queue, then drain
+        and apply what is still queued. A later submit() starts a new flusher.
+        """
+        thread = self._thread
+        if thread and thread.is_alive():
+            self._stopping.set()
+            try:
+                self.queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                pass  # The flusher is busy, so it will see _stopping soon
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.warning(f"Webhook flusher still busy after {timeout}s; its batch may be lost.")
+
+        items = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                items.append(item)
+        if items:
+            self._flush(items)
+        self._stopping.clear()
+
+    def _ensure_started(self):
+        # Started lazily so each gunicorn worker gets its own thread after fork
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='webhook-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # Until flush() asks it to stop; the batch in hand is always applied first
+        while not self._stopping.is_set():
+            item = self.queue.get()
+            if item is _STOP:
+                continue
+            items = [item]
+            # Give a burst up to flush_interval to accumulate, then take up to max_batch
+            deadline = time.monotonic() + self.flush_interval
+            try:
+                while len(items) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    item = self.queue.get(timeout=remaining)
+                    if item is _STOP:
+                        break
+                    items.append(item)
+            except queue.Empty:
+                pass
+            self._flush(items)
+
+    def _flush(self, items):
+        """
+        Apply a batch, retrying with backoff; if it keeps failing, apply each user's
+        change on its own so one bad row does not sink the rest.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._apply(items)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Failed to flush {len(items)} webhook events after {attempt + 1} attempts: {e}; "
+                                 f"applying them one by one.")
+                    break
+                delay = min(self.max_retry_delay, self.retry_delay * 2 ** attempt)
+                logger.warning(f"Failed to flush {len(items)} webhook events ({e}), retry {attempt + 1} in {delay:.1f}s.")
+                time.sleep(delay)
+
+        states = {}
+        for line_user_id, is_active in items:
+            states[line_user_id] = is_active
+        for line_user_id, is_active in states.items():
+            try:
+                self._apply([(line_user_id, is_active)])
+            except Exception as e:
+                DROPPED.inc()
+                logger.error(f"Dropped state change {line_user_id} -> active={is_active}: {e}")
+
+    def _apply(self, items):
+        # Latest state per user wins (queue order == event order)
+        states = {}
+        for line_user_id, is_active in items:
+            states[line_user_id] = is_active
+
+        with self._flush_lock, self.app.app_context():
+            try:
+                stmt = dialect_insert(User).values([
+                    {'line_user_id': uid, 'is_active': active} for uid, active in states.items()
+                ])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[User.line_user_id],
+                    set_={'is_active': stmt.excluded.is_active},
+                    # Skip no-op writes for users already in that state
+                    where=User.is_active.is_distinct_from(stmt.excluded.is_active),
+                )
+                db.session.execute(stmt)
+                db.session.commit()
+                logger.info(f"Applied {len(states)} subscriber state changes ({len(items)} events).")
+            except Exception:
+                db.session.rollback()
+                raise
+
+        if self.active_cache is not None:
+            for line_user_id, is_active in states.items():
+                if is_active:
+                    self.active_cache.add(line_user_id)
+                else:
+                    self.active_cache.discard(line_user_id)
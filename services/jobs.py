@@ -0,0 +1,198 @@
+import logging
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import or_, update
+
+from models import db, dialect_insert, Job
+
+logger = logging.getLogger(__name__)
+
+
+def _utc(dt):
+    """
+    Aware datetime -> naive UTC (how the jobs table stores times).
+    """
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class JobQueue:
+    """
+    Postgres-backed queue of scheduled job runs (see models.Job).
+
+    A claimed run holds a lease of lease_seconds, which a heartbeat pushes forward
+    while its handler runs (see hold). A run that fails, or whose worker dies (still
+    'running' past its lease), goes back to 'pending' and is claimed again after retry_delay, up to
+    max_attempts in total and only while it is within the misfire grace window;
+    handlers resume from their own progress records (e.g. the delivery ledger).
+    All methods must be called inside an app context.
+    """
+
+    def __init__(self, misfire_grace_time=3600, lease_seconds=1200, max_attempts=3, retry_delay=60,
+                 heartbeat_seconds=None):
+        self.misfire_grace_time = misfire_grace_time
+        if lease_seconds >= misfire_grace_time:
+            # Otherwise a lost run is only noticed once it is too late to retry
+            logger.warning(f"Job lease ({lease_seconds}s) is not shorter than the grace time "
+                           f"({misfire_grace_time}s); using half the grace time.")
+            lease_seconds = misfire_grace_time // 2
+        self.lease_seconds = lease_seconds
+        # A few beats per lease, so one slow or failed renewal doesn't lose it
+        self.heartbeat_seconds = heartbeat_seconds or lease_seconds / 3
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            misfire_grace_time=config['JOB_MISFIRE_GRACE_SECONDS'],
+            lease_seconds=config['JOB_LEASE_SECONDS'],
+            max_attempts=config['JOB_MAX_ATTEMPTS'],
+            retry_delay=config['JOB_RETRY_DELAY_SECONDS'],
+        )
+
+    def enqueue_due(self, schedules, now=None):
+        """
+        schedules: {kind: APScheduler trigger}. Enqueue each trigger's fire time if it
+        falls within the last misfire_grace_time, so a run missed during a cold start
+        is caught up, and one older than that is skipped. Idempotent across processes.
+        """
+        for kind, trigger in schedules.items():
+            local_now = now or datetime.now(trigger.timezone)
+            window_start = local_now - timedelta(seconds=self.misfire_grace_time)
+            fire_time = trigger.get_next_fire_time(None, window_start)
+            if fire_time and fire_time <= local_now:
+                self.enqueue(kind, _utc(fire_time))
+
+    def enqueue(self, kind, run_at):
+        stmt = dialect_insert(Job).values(kind=kind, run_at=run_at, status='pending')
+        result = db.session.execute(stmt.on_conflict_do_nothing(index_elements=['kind', 'run_at']))
+        db.session.commit()
+        if result.rowcount:
+            logger.info(f"Enqueued {kind} job for {run_at} (UTC).")
+
+    def claim(self):
+        """
+        Claim the oldest due pending job, or return None.
+        A retried run (finished_at set by its failed attempt) waits retry_delay first.
+        """
+        now = datetime.utcnow()
+        self._expire(now)
+
+        job = Job.query.filter(
+            Job.status == 'pending',
+            Job.run_at <= now,
+            or_(Job.finished_at.is_(None), Job.finished_at <= now - timedelta(seconds=self.retry_delay)),
+        ) \
+            .order_by(Job.run_at) \
+            .with_for_update(skip_locked=True) \
+            .first()
+        if job is None:
+            db.session.rollback()
+            return None
+
+        job.status = 'running'
+        job.attempts += 1
+        job.claimed_by = self.worker_id
+        job.started_at = now
+        job.lease_expires_at = now + timedelta(seconds=self.lease_seconds)
+        db.session.commit()
+        logger.info(f"Claimed {job.kind} job {job.id} (run_at {job.run_at}).")
+        return job
+
+    @contextmanager
+    def hold(self, job):
+        """
+        Keep extending a claimed job's lease while the block runs. The renewals use
+        their own connection, so the handler's transactions are left alone.
+        """
+        engine = db.engine
+        # Read here: the ORM object is not safe to touch from the heartbeat thread
+        job_id, kind = job.id, job.kind
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat_seconds):
+                try:
+                    if not self._extend(engine, job_id):
+                        logger.warning(f"{kind} job {job_id} lost its lease; stopping heartbeat.")
+                        return
+                except Exception as e:
+                    logger.warning(f"Failed to extend the lease of {kind} job {job_id}: {e}")
+
+        thread = threading.Thread(target=beat, name=f'job-{job_id}-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def _extend(self, engine, job_id):
+        expires = datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+        with engine.begin() as conn:
+            result = conn.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == 'running', Job.claimed_by == self.worker_id)
+                .values(lease_expires_at=expires)
+            )
+        return result.rowcount == 1
+
+    def complete(self, job, error=None):
+        """
+        Mark a claimed job done, or on error either back to pending (to be retried) or failed.
+        Only applies while this worker still holds the run; returns False (and changes
+        nothing) if its lease expired and the run was requeued or claimed elsewhere.
+        """
+        now = datetime.utcnow()
+        job_id, kind, attempts, run_at = job.id, job.kind, job.attempts, job.run_at
+        status = 'done'
+        if error:
+            status = 'pending' if self._can_retry(attempts, run_at, now) else 'failed'
+        updated = Job.query.filter(
+            Job.id == job_id,
+            Job.status == 'running',
+            Job.claimed_by == self.worker_id,
+        ).update({'status': status, 'error': error, 'finished_at': now}, synchronize_session=False)
+        db.session.commit()
+        if not updated:
+            logger.warning(f"{kind} job {job_id} is no longer held by {self.worker_id}; not marking it {status}.")
+            return False
+        if status == 'pending':
+            logger.warning(f"{kind} job {job_id} will be retried (attempt {attempts} of {self.max_attempts}).")
+        return True
+
+    def _can_retry(self, attempts, run_at, now):
+        return attempts < self.max_attempts and run_at >= now - timedelta(seconds=self.misfire_grace_time)
+
+    def _expire(self, now):
+        # Pending past the grace window (e.g. no worker was up): skip, like APScheduler misfires
+        missed = Job.query.filter(
+            Job.status == 'pending',
+            Job.run_at < now - timedelta(seconds=self.misfire_grace_time)
+        ).update({'status': 'missed', 'finished_at': now}, synchronize_session=False)
+
+        # Running past the lease: the worker died mid-job (its heartbeat stopped). Retried if
+        # attempts and the grace window allow (the retry resumes from the job's progress records)
+        lost = Job.query.filter(
+            Job.status == 'running',
+            or_(
+                Job.lease_expires_at < now,
+                # Claimed before leases were recorded
+                Job.lease_expires_at.is_(None) & (Job.started_at < now - timedelta(seconds=self.lease_seconds)),
+            ),
+        )
+        retry = lost.filter(
+            Job.attempts < self.max_attempts,
+            Job.run_at >= now - timedelta(seconds=self.misfire_grace_time),
+        ).update({'status': 'pending', 'error': 'lease expired', 'finished_at': now}, synchronize_session=False)
+        failed = lost.update({'status': 'failed', 'error': 'lease expired', 'finished_at': now},
+                             synchronize_session=False)
+
+        if missed or retry or failed:
+            logger.warning(f"Jobs expired: {missed} missed, {retry} lost and requeued, {failed} lost.")
+        db.session.commit()
@@ -0,0 +1,243 @@
+import logging
+from html.parser import HTMLParser
+
+logger = logging.getLogger(__name__)
+
+# Header keyword -> column key. Order matters: first match wins per header cell.
+HEADER_KEYWORDS = (
+    ("代號", 'id'),
+    ("名稱", 'name'),  # Sometimes combined
+    ("股東會紀念品", 'gift'),
+    ("股東會日期", 'meeting_date'),
+    ("最後買進日", 'last_buy_date'),
+)
+
+
+def build_col_map(header_cells):
+    """
+    Identify columns dynamically from the header row texts.
+    Returns the column map if this looks like the gift table, else None.
+    """
+    col_map = {}
+    for idx, text in enumerate(header_cells):
+        for keyword, key in HEADER_KEYWORDS:
+            if keyword in text:
+                col_map[key] = idx
+                break
+
+    # Check if this is the correct table (needs minimal fields)
+    if 'gift' in col_map and ('id' in col_map or 'name' in col_map):
+        return col_map
+    return None
+
+
+def parse_table_bs4(html):
+    """
+    Reference backend: full BeautifulSoup tree walk.
+    Returns (col_map, rows) where rows are lists of stripped <td> texts,
+    or (None, []) if no gift table was found.
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    for table in soup.find_all('table'):
+        headers_row = table.find('tr')
+        if not headers_row:
+            continue
+
+        header_cells = [c.get_text(strip=True) for c in headers_row.find_all(['th', 'td'])]
+        col_map = build_col_map(header_cells)
+        if col_map is None:
+            continue
+
+        rows = [
+            [cell.get_text(strip=True) for cell in row.find_all('td')]
+            for row in table.find_all('tr')[1:]  # Skip header
+        ]
+        return col_map, rows
+
+    return None, []
+
+
+class _TableDone(Exception):
+    """Raised to stop tokenizing once the gift table has been read."""
+
+
+class _Table:
+    __slots__ = ('header', 'rows', 'closed')
+
+    def __init__(self):
+        self.header = None       # first <tr> anywhere inside (bs4's table.find('tr'))
+        self.rows = []           # every later <tr> inside, nested tables' included
+        self.closed = False
+
+
+class _Row:
+    __slots__ = ('cells', 'closed')
+
+    def __init__(self):
+        self.cells = []          # every <td>/<th> inside, nested ones included
+        self.closed = False
+
+
+class _Cell:
+    __slots__ = ('is_td', 'chunks')
+
+    def __init__(self, is_td):
+        self.is_td = is_td
+        self.chunks = []         # stripped text pieces, nested elements' included
+
+
+class StreamingTableParser(HTMLParser):
+    """
+    Streaming backend on the stdlib tokenizer: only table, row and cell records
+    are kept, no tree. Open elements are tracked the way bs4's html.parser
+    builder does it (no implied end tags; an end tag closes everything above
+    the latest open element of that name, and is ignored if none is open), and
+    every row, cell and text piece is credited to all of its open ancestors, as
+    bs4's recursive find_all / get_text see them. So malformed markup (unclosed
+    <td> or <tr>, tables nested in cells) gives the same rows as parse_table_bs4.
+    Tokenizing stops once the first matching table is closed and no earlier
+    table can still match.
+    """
+
+    # Never opened (bs4 closes them at once); their end tags are ignored
+    VOID_TAGS = frozenset((
+        'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image',
+        'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source',
+        'spacer', 'track', 'wbr',
+    ))
+    # Text inside these is not part of get_text()
+    SKIP_TEXT_TAGS = frozenset(('script', 'style', 'template', 'rt', 'rp'))
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tables = []         # every table in start order
+        self.col_map = None
+        self.rows = []
+        self._stack = []         # open elements: (tag, record or None)
+        self._open = {}          # tag -> open count
+        self._open_tables = []
+        self._open_rows = []
+        self._open_cells = []
+        self._checked = 0        # tables before this index are known not to match
+        self._skip_text = 0
+
+    def parse(self, html):
+        try:
+            self.feed(html)
+            self.close()
+            # End of document: whatever is still open is complete
+            for table in self._open_tables:
+                table.closed = True
+            for row in self._open_rows:
+                row.closed = True
+            self._find_target()
+        except _TableDone:
+            pass
+        return self.col_map, self.rows
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.VOID_TAGS:
+            return
+        record = None
+        if tag == 'table':
+            record = _Table()
+            self.tables.append(record)
+            self._open_tables.append(record)
+        elif tag == 'tr':
+            record = _Row()
+            for table in self._open_tables:
+                if table.header is None:
+                    table.header = record
+                else:
+                    table.rows.append(record)
+            self._open_rows.append(record)
+        elif tag in ('td', 'th'):
+            record = _Cell(tag == 'td')
+            for row in self._open_rows:
+                row.cells.append(record)
+            self._open_cells.append(record)
+        elif tag in self.SKIP_TEXT_TAGS:
+            self._skip_text += 1
+        self._stack.append((tag, record))
+        self._open[tag] = self._open.get(tag, 0) + 1
+
+    def handle_endtag(self, tag):
+        if not self._open.get(tag):
+            return
+        while True:
+            name, record = self._stack.pop()
+            self._open[name] -= 1
+            if name == 'table':
+                self._open_tables.pop().closed = True
+                if not self._open_tables:
+                    self._find_target()
+            elif name == 'tr':
+                self._open_rows.pop().closed = True
+            elif name in ('td', 'th'):
+                self._open_cells.pop()
+            elif name in self.SKIP_TEXT_TAGS:
+                self._skip_text -= 1
+            if name == tag:
+                return
+
+    def handle_data(self, data):
+        if self._skip_text or not self._open_cells:
+            return
+        data = data.strip()
+        if data:
+            for cell in self._open_cells:
+                cell.chunks.append(data)
+
+    def _find_target(self):
+        """
+        Check tables in start order, as bs4's find_all('table') does; stop
+        (raise _TableDone) at the first matching one that is complete.
+        """
+        while self._checked < len(self.tables):
+            table = self.tables[self._checked]
+            header = table.header
+            if header is None and not table.closed:
+                return  # No row yet, may still get one
+            if header is not None:
+                if not header.closed:
+                    return
+                col_map = build_col_map([''.join(cell.chunks) for cell in header.cells])
+                if col_map is not None:
+                    if not table.closed:
+                        return
+                    self.col_map = col_map
+                    self.rows = [
+                        [''.join(cell.chunks) for cell in row.cells if cell.is_td]
+                        for row in table.rows
+                    ]
+                    raise _TableDone()
+            # Not the gift table: drop what it collected
+            table.header = None
+            table.rows = []
+            self._checked += 1
+
+
+def parse_table_stream(html):
+    """
+    Fast backend: see StreamingTableParser.
+    """
+    col_map, rows = StreamingTableParser().parse(html)
+    if col_map is None:
+        return None, []
+    return col_map, rows
+
+
+PARSER_BACKENDS = {
+    'bs4': parse_table_bs4,
+    'stream': parse_table_stream,
+}
+
+
+def get_parser(name):
+    try:
+        return PARSER_BACKENDS[name]
+    except KeyError:
+        logger.warning(f"Unknown parser backend '{name}', falling back to 'bs4'.")
+        return PARSER_BACKENDS['bs4']
@@ -0,0 +1,231 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import tuple_, update
+
+from config import Config
+from models import db, dialect_insert, Reminder, Stock
+from utils import metrics
+from utils.timing_wheel import TimingWheel
+
+logger = logging.getLogger(__name__)
+
+LOCAL_TZ = ZoneInfo('Asia/Taipei')
+
+# Stocks per statement when rescheduling changed stocks
+SYNC_BATCH_SIZE = 500
+
+REMINDERS_SENT = metrics.counter('reminders_claimed_total', "Last-buy reminders claimed for sending")
+REMINDERS_RELEASED = metrics.counter('reminders_released_total', "Claimed reminders released after a failed send")
+WHEEL_SIZE = metrics.gauge('reminder_wheel_size', "Reminders held in the in-memory timing wheel")
+
+# Bumped by invalidate(); queues in this process reload their wheel on the next poll
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+def invalidate():
+    """
+    Reload timing wheels in this process (save_stocks calls it after rescheduling).
+    Other processes pick the change up on their next periodic reload.
+    """
+    global _generation
+    with _generation_lock:
+        _generation += 1
+
+
+def due_at(last_buy_date, days_before=None, hour=None):
+    """
+    When the reminder for a last buy date goes out: `days_before` days earlier
+    at `hour` o'clock Taipei time, as naive UTC (how the reminders table stores it).
+    """
+    days_before = Config.REMINDER_DAYS_BEFORE if days_before is None else days_before
+    hour = Config.REMINDER_HOUR if hour is None else hour
+    day = last_buy_date - timedelta(days=days_before)
+    local = datetime(day.year, day.month, day.day, hour, tzinfo=LOCAL_TZ)
+    return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def schedule(stock_ids, now=None):
+    """
+    Bring the due queue in line with the stored last buy dates of stock_ids
+    (see schedule_dates). Returns rows added; the caller commits.
+    """
+    stock_ids = list(stock_ids)
+    added = 0
+    for i in range(0, len(stock_ids), SYNC_BATCH_SIZE):
+        dates = dict(
+            db.session.query(Stock.stock_id, Stock.last_buy_date)
+            .filter(Stock.stock_id.in_(stock_ids[i:i + SYNC_BATCH_SIZE]))
+        )
+        added += schedule_dates(dates, now)
+    return added
+
+
+def schedule_dates(dates, now=None, new_ids=()):
+    """
+    dates: {stock_id: last_buy_date}. Unsent reminders for another date are
+    dropped and one is added for the given date unless it has passed. Stocks in
+    new_ids were just inserted, so they have nothing to drop. save_stocks passes
+    the dates it is writing, inside its transaction (the caller commits).
+    Returns rows added.
+    """
+    now = now or datetime.utcnow()
+    today = _local_date(now)
+    new_ids = set(new_ids)
+    items = list(dates.items())
+    added = 0
+    for i in range(0, len(items), SYNC_BATCH_SIZE):
+        batch = items[i:i + SYNC_BATCH_SIZE]
+
+        # Unsent reminders whose date no longer matches the stock, in one DELETE
+        moved = [(stock_id, last_buy_date) for stock_id, last_buy_date in batch if stock_id not in new_ids]
+        if moved:
+            keep = [(stock_id, last_buy_date) for stock_id, last_buy_date in moved if last_buy_date is not None]
+            stale = db.session.query(Reminder).filter(
+                Reminder.stock_id.in_([stock_id for stock_id, _ in moved]),
+                Reminder.sent_at.is_(None),
+            )
+            if keep:
+                stale = stale.filter(tuple_(Reminder.stock_id, Reminder.last_buy_date).not_in(keep))
+            stale.delete(synchronize_session=False)
+
+        # A reminder whose time has passed is still worth sending up to the last buy date
+        rows = [
+            {'stock_id': stock_id, 'last_buy_date': last_buy_date, 'due_at': due_at(last_buy_date)}
+            for stock_id, last_buy_date in batch
+            if last_buy_date is not None and last_buy_date >= today
+        ]
+        if rows:
+            stmt = dialect_insert(Reminder).values(rows)
+            result = db.session.execute(
+                stmt.on_conflict_do_nothing(index_elements=['stock_id', 'last_buy_date'])
+            )
+            added += max(result.rowcount, 0)
+    return added
+
+
+class ReminderQueue:
+    """
+    Due queue of last-buy-date reminders (models.Reminder) with an in-memory
+    timing wheel of the ones due within `horizon` seconds.
+
+    due() answers from the wheel, so a poll with nothing due costs no query; the
+    wheel is reloaded from the partial index on unsent rows every `refresh_seconds`
+    or after invalidate(). claim() marks reminders sent with a conditional UPDATE,
+    so each is sent by exactly one process. All DB methods need an app context.
+    """
+
+    def __init__(self, horizon=86400, refresh_seconds=600, resolution=60):
+        self.horizon = horizon
+        self.refresh_seconds = refresh_seconds
+        self.resolution = resolution
+        self._wheel = None
+        self._loaded_at = 0.0
+        self._generation = None
+        self._backfilled = False
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            horizon=config['REMINDER_HORIZON_SECONDS'],
+            refresh_seconds=config['REMINDER_REFRESH_SECONDS'],
+        )
+
+    def due(self, now=None):
+        """
+        Ids of reminders due at `now` (naive UTC), reloading the wheel if stale.
+        """
+        now = now or datetime.utcnow()
+        if (
+            self._wheel is None
+            or self._generation != _generation
+            or time.monotonic() - self._loaded_at >= self.refresh_seconds
+        ):
+            self._load(now)
+        due = self._wheel.advance(_epoch(now))
+        WHEEL_SIZE.set(len(self._wheel))
+        return due
+
+    def claim(self, reminder_ids, now=None):
+        """
+        Mark reminders sent; returns [(stock_id, last_buy_date)] for the ones this
+        call claimed (not yet sent by another process, not deleted since loading).
+        """
+        if not reminder_ids:
+            return []
+        now = now or datetime.utcnow()
+        claimed = db.session.execute(
+            update(Reminder)
+            .where(Reminder.id.in_(reminder_ids), Reminder.sent_at.is_(None))
+            .values(sent_at=now)
+            .returning(Reminder.stock_id, Reminder.last_buy_date)
+        ).all()
+        db.session.commit()
+        REMINDERS_SENT.inc(len(claimed))
+        # Past its last buy date (e.g. the process was down): claimed, but not worth sending
+        today = _local_date(now)
+        return [(stock_id, last_buy_date) for stock_id, last_buy_date in claimed if last_buy_date >= today]
+
+    def release(self, reminder_ids, claimed_at):
+        """
+        Undo claim() for reminders whose delivery failed, so a later poll retries them.
+        Only rows claimed at `claimed_at` are touched (not ones another process sent).
+        """
+        if not reminder_ids:
+            return 0
+        released = db.session.execute(
+            update(Reminder)
+            .where(Reminder.id.in_(reminder_ids), Reminder.sent_at == claimed_at)
+            .values(sent_at=None)
+        ).rowcount
+        db.session.commit()
+        REMINDERS_RELEASED.inc(released)
+        # They have already left the wheel; reload it on the next poll
+        self._wheel = None
+        return released
+
+    def _load(self, now):
+        if not self._backfilled:
+            self._backfill(now)
+
+        until = now + timedelta(seconds=self.horizon)
+        # Range on the partial index of unsent rows; overdue ones still relevant are included
+        rows = db.session.query(Reminder.id, Reminder.due_at).filter(
+            Reminder.sent_at.is_(None),
+            Reminder.due_at < until,
+            Reminder.last_buy_date >= _local_date(now),
+        ).all()
+        db.session.commit()
+
+        slot_count = max(1, -(-self.horizon // self.resolution))
+        wheel = TimingWheel(_epoch(now), resolution=self.resolution, slot_count=slot_count)
+        for reminder_id, when in rows:
+            wheel.add(_epoch(when), reminder_id)
+        self._wheel = wheel
+        self._generation = _generation
+        self._loaded_at = time.monotonic()
+        logger.info(f"Reminder wheel loaded: {len(wheel)} due within {self.horizon}s.")
+
+    def _backfill(self, now):
+        # Once per process: stocks stored before the queue existed (or while scheduling
+        # failed) get their reminders. Only upcoming last buy dates are read.
+        stock_ids = [
+            row[0] for row in db.session.query(Stock.stock_id).filter(Stock.last_buy_date >= _local_date(now))
+        ]
+        added = schedule(stock_ids, now)
+        db.session.commit()
+        self._backfilled = True
+        if added:
+            logger.info(f"Reminder backfill: {added} reminders scheduled.")
+
+
+def _epoch(dt):
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _local_date(utc_now):
+    return utc_now.replace(tzinfo=timezone.utc).astimezone(LOCAL_TZ).date()
@@ -1,48 +1,121 @@
 from apscheduler.schedulers.background import BackgroundScheduler
-from linebot import LineBotApi
+from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime, timedelta
+import hashlib
+import json
 import logging
+import time
+import uuid
 
-from models import db, User, Stock
-from utils.flex import create_stock_report
+from sqlalchemy import func, case
+from models import db, Stock, StockEvent, Watermark
+from utils.flex import create_stock_report, prune_rendered_reports
 from services.scraper import ScraperService
+from services.dispatcher import MulticastDispatcher
+from services.alerts import KeywordMatcher
+from services.fanout import plan_fanout, plan_keyword_alerts
+from services.followers import FollowerReconciler
+from services.jobs import JobQueue
+from services.reminders import ReminderQueue
+from services.delivery import Audience, DeliveryFailed, DeliveryPlanner
+from services.subscribers import iter_active_user_batches, has_active_users, count_active_users
+from utils import metrics
+from utils.http import create_line_bot_api
 
 logger = logging.getLogger(__name__)
 
+JOB_SECONDS = metrics.histogram('job_seconds', "Scheduled job run time", ['kind', 'status'])
+RENDER_SECONDS = metrics.histogram('broadcast_render_seconds', "Flex report build time (cache lookups included)")
+
 class SchedulerService:
-    def __init__(self, app):
+    def __init__(self, app, line_bot_api=None):
         self.app = app
         self.scheduler = BackgroundScheduler(timezone="Asia/Taipei")
-        self.line_bot_api = LineBotApi(app.config['LINE_CHANNEL_ACCESS_TOKEN'])
+        # Reuse the web process's client when given one
+        self.line_bot_api = line_bot_api or create_line_bot_api(app.config)
         self.scraper = ScraperService() # Initialize scraper
+        self.dispatcher = MulticastDispatcher.from_config(self.line_bot_api, app.config)
+        self.planner = DeliveryPlanner.from_config(self.line_bot_api, self.dispatcher, app.config)
+        self.jobs = JobQueue.from_config(app.config)
+        self.reminders = ReminderQueue.from_config(app.config)
+        self.followers = FollowerReconciler.from_config(self.line_bot_api, app.config)
+        self.keywords = KeywordMatcher()
 
-    def start(self):
-        # 1. Scrape Job (e.g., Mon 08:00 before broadcast)
-        self.scheduler.add_job(
-            self.scrape_job,
-            'cron',
-            day_of_week='mon',
-            hour=8,
-            minute=0,
-            misfire_grace_time=3600
-        )
+        # Cron schedules; runs are enqueued in the jobs table and executed once across processes
+        self.schedules = {
+            # 1. Scrape Job (e.g., Mon 08:00 before broadcast)
+            'scrape': CronTrigger(day_of_week='mon', hour=8, minute=0, timezone="Asia/Taipei"),
+            # 2. Broadcast Job (Mon 08:30)
+            'broadcast': CronTrigger(day_of_week='mon', hour=8, minute=30, timezone="Asia/Taipei"),
+        }
+        self.handlers = {
+            'scrape': self.scrape_job,
+            'broadcast': self.broadcast_job,
+            'reconcile': self.reconcile_job,
+        }
+        if app.config['FOLLOWER_RECONCILE_ENABLED']:
+            # 3. Follower reconciliation (daily 04:00, before the scrape and broadcast)
+            self.schedules['reconcile'] = CronTrigger(hour=4, minute=0, timezone="Asia/Taipei")
 
-        # 2. Broadcast Job (Mon 08:30)
+    def start(self):
+        # Poll the job table; the first tick runs right away to catch up after a cold start
         self.scheduler.add_job(
-            self.broadcast_job, 
-            'cron', 
-            day_of_week='mon', 
-            hour=8, 
-            minute=30, 
-            misfire_grace_time=3600
+            self.tick,
+            'interval',
+            seconds=self.app.config['JOB_POLL_SECONDS'],
+            next_run_time=datetime.now(self.scheduler.timezone),
+            max_instances=1,
+            coalesce=True
         )
         self.scheduler.start()
         logger.info("Scheduler started with Scrape(08:00) and Broadcast(08:30) jobs.")
 
-    def scrape_job(self):
+    def tick(self):
+        """
+        Enqueue due cron runs (idempotent), claim and run pending jobs one by one,
+        then send any last-buy reminders that are due.
+        """
+        with self.app.app_context():
+            try:
+                self.jobs.enqueue_due(self.schedules)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Failed to enqueue jobs: {e}")
+                return
+
+            while True:
+                job = self.jobs.claim()
+                if job is None:
+                    break
+                start = time.perf_counter()
+                try:
+                    with self.jobs.hold(job):
+                        self.handlers[job.kind]()
+                    self.jobs.complete(job)
+                    status = 'done'
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"{job.kind} job {job.id} failed: {e}")
+                    self.jobs.complete(job, error=str(e))
+                    status = 'failed'
+                JOB_SECONDS.observe(time.perf_counter() - start, kind=job.kind, status=status)
+
+            if self.app.config['REMINDERS_ENABLED']:
+                self.remind()
+
+    def scrape_job(self, force=False):
         logger.info("Starting scrape job...")
         with self.app.app_context():
-            self.scraper.run()
+            self.scraper.run(force=force)
+            try:
+                prune_rendered_reports(self.app.config['RENDERED_REPORT_MAX_AGE_DAYS'])
+            except Exception as e:
+                logger.warning(f"Failed to prune rendered reports: {e}")
+
+    def reconcile_job(self):
+        logger.info("Starting follower reconciliation...")
+        with self.app.app_context():
+            self.followers.run()
 
     def broadcast_job(self, is_test=False):
         """
@@ -53,21 +126,17 @@ class SchedulerService:
         
         with self.app.app_context():
             stocks = []
+            labels = {}
+            read_at = datetime.utcnow()
             if is_test:
                 # Test Mode: Fetch all stocks with future last buy dates (or recently passed)
                 # To ensure the user sees something, we just fetch the top 20 upcoming/active ones.
                 stocks = Stock.query.order_by(Stock.last_buy_date.desc()).limit(20).all()
             else:
                 # Normal Mode: 
-                # Notify for stocks that were ADDED or UPDATED in the past 7 days.
-                # And ensure the "Last Buy Date" hasn't passed yet.
-                today = datetime.now().date()
-                one_week_ago = datetime.utcnow() - timedelta(days=7)
-                
-                stocks = Stock.query.filter(
-                    Stock.updated_at >= one_week_ago,
-                    Stock.last_buy_date >= today
-                ).all()
+                # Notify for stocks ADDED or UPDATED since the last successful broadcast
+                # (read from the indexed stock_events log), whose "Last Buy Date" hasn't passed yet.
+                stocks, labels = self._changed_stocks(self._last_broadcast_at())
 
             # Early Exit
             if not stocks:
@@ -78,30 +147,197 @@ class SchedulerService:
                      if not stocks:
                          return # DB is really empty
                 else:
+                    # Nothing to send up to read_at
+                    self._set_broadcast_watermark(read_at)
                     return
 
-            # Batch Sending
-            users = User.query.filter_by(is_active=True).all()
-            user_ids = [u.line_user_id for u in users]
-            
-            if not user_ids:
+            if not has_active_users():
                 logger.info("No active users to notify.")
                 return 
 
-            logger.info(f"Found {len(stocks)} stocks and {len(user_ids)} users.")
+            logger.info(f"Found {len(stocks)} stocks.")
 
-            # Create Message
-            message = create_stock_report(stocks)
-            if not message:
-                logger.error("Failed to create flex message.")
+            if is_test:
+                audience = Audience(count_active_users(), True, lambda: iter_active_user_batches())
+                self._deliver(stocks, labels, audience, is_test)
                 return
 
-            # Loop: Chunk users into batches of 500
-            chunk_size = 500
-            for i in range(0, len(user_ids), chunk_size):
-                chunk = user_ids[i:i + chunk_size]
-                try:
-                    self.line_bot_api.multicast(chunk, message)
-                    logger.info(f"Broadcasted to batch {i//chunk_size + 1}")
-                except Exception as e:
-                    logger.error(f"Failed to send batch {i}: {str(e)}")
+            # Raises if any audience was not reached, so the watermark stays put and the job is retried
+            self._send_report(stocks, labels, 'weekly')
+            self._set_broadcast_watermark(read_at)
+
+    def remind(self, now=None):
+        """
+        Send the "last buy date is tomorrow" reminders due now. Due reminders come
+        from the in-memory timing wheel, so a poll with none due costs no query.
+        Claimed reminders are sent at most once, even with several processes polling;
+        if sending fails they are released and retried on a later poll.
+        Must be called inside an app context (tick does).
+        """
+        now = now or datetime.utcnow()
+        try:
+            due = self.reminders.due(now)
+            claimed = self.reminders.claim(due, now)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Failed to read reminders: {e}")
+            return
+        if not claimed:
+            return
+
+        start = time.perf_counter()
+        status = 'done'
+        try:
+            stock_ids = sorted({stock_id for stock_id, _ in claimed})
+            stocks = Stock.query.filter(Stock.stock_id.in_(stock_ids)).all()
+            logger.info(f"Sending last-buy reminders for {len(stocks)} stocks.")
+            if stocks and has_active_users():
+                self._send_report(stocks, {stock.stock_id: 'last_buy' for stock in stocks}, 'reminder')
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Reminder delivery failed: {e}")
+            status = 'failed'
+            try:
+                self.reminders.release(due, now)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Failed to release reminders for retry: {e}")
+        JOB_SECONDS.observe(time.perf_counter() - start, kind='reminder', status=status)
+
+    def _send_report(self, stocks, labels, kind):
+        """
+        Full report to users without a watchlist, filtered reports to watchlist users, and
+        (with the weekly digest) a keyword alert report to users without a watchlist whose
+        keywords matched. Every audience is attempted; if any delivery failed, the first DeliveryFailed
+        is raised afterwards so the job is retried (delivered audiences are skipped then).
+        """
+        failures = []
+        # Users without a watchlist get the full report
+        # (when nobody has a watchlist that is every follower, so it can go out as a broadcast)
+        active_count = count_active_users()
+        full_count = count_active_users(without_watchlist=True)
+        if full_count:
+            audience = Audience(
+                full_count, full_count == active_count,
+                lambda: iter_active_user_batches(without_watchlist=True)
+            )
+            self._try_deliver(failures, stocks, labels, audience, kind=kind, audience_key='full')
+
+        # Watchlist users (followed stocks + gift keyword matches on these stocks):
+        # one report per distinct set of stocks, sent to its group
+        self.keywords.sync()
+        keyword_matches = self.keywords.match(stocks)
+        stock_by_id = {stock.stock_id: stock for stock in stocks}
+        for stock_ids, user_ids in plan_fanout(stock_by_id, keyword_matches).items():
+            audience = Audience(len(user_ids), False, lambda user_ids=user_ids: user_ids)
+            self._try_deliver(failures, [stock_by_id[i] for i in stock_ids], labels, audience, kind=kind,
+                              audience_key=_group_key(stock_ids, user_ids))
+
+        # Users without a watchlist already have their matches in the full report;
+        # the alert points them out, so a keyword is not silently ignored
+        if kind == 'weekly' and keyword_matches:
+            for stock_ids, user_ids in plan_keyword_alerts(keyword_matches).items():
+                audience = Audience(len(user_ids), False, lambda user_ids=user_ids: user_ids)
+                self._try_deliver(failures, [stock_by_id[i] for i in stock_ids], labels, audience, kind='keyword',
+                                  audience_key=_group_key(stock_ids, user_ids))
+
+        if failures:
+            raise failures[0]
+
+    def _try_deliver(self, failures, *args, **kwargs):
+        try:
+            return self._deliver(*args, **kwargs)
+        except DeliveryFailed as e:
+            logger.error(str(e))
+            failures.append(e)
+
+    def _deliver(self, stocks, labels, audience, is_test=False, kind='weekly', audience_key='full'):
+        # Create Messages (cached per unique stock set, paginated into carousels)
+        with RENDER_SECONDS.time():
+            messages = create_stock_report(stocks, labels=labels, **self._report_text(kind))
+        if not messages:
+            raise RuntimeError("Failed to create flex message.")
+
+        # The planner picks broadcast, narrowcast or multicast (chunks of 500, resumable
+        # per job key) from the audience size, LINE follower reach and remaining quota.
+        return self.planner.deliver(self._job_key(messages, is_test, kind, audience_key), audience, messages)
+
+    def _report_text(self, kind):
+        """
+        Flex alt text, title and subtitle for a report kind (the weekly digest uses the defaults),
+        so a reminder or keyword alert does not look like the digest in the chat list.
+        """
+        if kind == 'keyword':
+            return {
+                'alt_text': "🔔 關鍵字提醒：有符合的紀念品",
+                'title': "🔔 關鍵字提醒",
+                'subtitle': "以下紀念品符合您設定的關鍵字",
+            }
+        if kind != 'reminder':
+            return {}
+        days = self.app.config['REMINDER_DAYS_BEFORE']
+        when = {0: "今天", 1: "明天"}.get(days, f"{days} 天後")
+        return {
+            'alt_text': f"⏰ 最後買進提醒：{when}截止",
+            'title': "⏰ 最後買進提醒",
+            'subtitle': f"以下紀念品{when}為最後買進日",
+        }
+
+    def _last_broadcast_at(self):
+        """
+        Stock events up to this time have been delivered by a successful weekly broadcast;
+        a week ago if there has been none.
+        """
+        watermark = db.session.get(Watermark, 'broadcast')
+        return watermark.value if watermark else datetime.utcnow() - timedelta(days=7)
+
+    def _set_broadcast_watermark(self, value):
+        watermark = db.session.get(Watermark, 'broadcast')
+        if watermark is None:
+            db.session.add(Watermark(name='broadcast', value=value))
+        else:
+            watermark.value = value
+        db.session.commit()
+
+    def _changed_stocks(self, since):
+        """
+        Stocks with change events after `since` and a last buy date not yet passed,
+        plus a {stock_id: 'new' | 'updated'} label map for the report.
+        """
+        is_new = func.max(case((StockEvent.kind == 'new', 1), else_=0))
+        delta = db.session.query(StockEvent.stock_id, is_new) \
+            .filter(StockEvent.created_at > since) \
+            .group_by(StockEvent.stock_id) \
+            .all()
+        if not delta:
+            return [], {}
+
+        labels = {stock_id: 'new' if new else 'updated' for stock_id, new in delta}
+        today = datetime.now().date()
+        stocks = []
+        ids = list(labels)
+        for i in range(0, len(ids), 500):
+            stocks.extend(Stock.query.filter(
+                Stock.stock_id.in_(ids[i:i + 500]),
+                Stock.last_buy_date >= today
+            ).all())
+        return stocks, labels
+
+    def _job_key(self, messages, is_test, kind='weekly', audience_key='full'):
+        """
+        kind:date:report hash:audience. The audience part keeps a watchlist group whose
+        report happens to equal the full one from sharing its ledger and delivery runs.
+        """
+        if is_test:
+            return f"test:{uuid.uuid4().hex}"
+        payload = json.dumps([m.as_json_dict() for m in messages], sort_keys=True, ensure_ascii=False)
+        digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+        return f"{kind}:{datetime.now().date().isoformat()}:{digest}:{audience_key}"
+
+
+def _group_key(stock_ids, user_ids):
+    """
+    Audience part of a watchlist group's job key: a hash of its stocks and members.
+    """
+    payload = json.dumps([list(stock_ids), list(user_ids)], separators=(',', ':'))
+    return 'g' + hashlib.sha256(payload.encode('utf-8')).hexdigest()[:12]
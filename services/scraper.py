@@ -1,66 +1,179 @@
+import hashlib
 import logging
-from bs4 import BeautifulSoup
-import requests
-from models import db, Stock
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import date, datetime
+from sqlalchemy import func
+from config import Config
+from models import db, dialect_insert, Stock, StockEvent, PageSnapshot
+from services import catalog, reminders
+from services.parsers import get_parser
+from services.sources import SOURCES, get_sources, merge_results
+from utils import metrics
+from utils.http import get_client
 
 logger = logging.getLogger(__name__)
 
+REQUEST_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+# Raw pages kept per source for re-parsing
+SNAPSHOT_RETENTION = 30
+
+# Rows per INSERT ... ON CONFLICT statement (one round trip each)
+UPSERT_BATCH_SIZE = 500
+
+STOCK_FIELDS = ('stock_id', 'name', 'gift_name', 'meeting_date', 'vote_start_date', 'last_buy_date', 'gift_year',
+                'field_sources')
+# Fields that count as a "real" change for updated_at
+COMPARED_FIELDS = ('name', 'gift_name', 'meeting_date', 'vote_start_date', 'last_buy_date', 'gift_year')
+# Optional dates: an empty scraped value never overwrites a stored one
+KEEP_IF_EMPTY_FIELDS = ('vote_start_date', 'last_buy_date')
+
+FETCH_SECONDS = metrics.histogram('scraper_fetch_seconds', "HTTP fetch time per source", ['source'])
+FETCH_RESULTS = metrics.counter(
+    'scraper_fetch_total', "Fetch outcomes per source (changed, unchanged, timeout, error)", ['source', 'result'])
+PARSE_SECONDS = metrics.histogram('scraper_parse_seconds', "Page parse time per source", ['source'])
+ROWS_PARSED = metrics.counter('scraper_rows_parsed_total', "Rows parsed per source", ['source'])
+ROWS_REJECTED = metrics.counter('scraper_rows_rejected_total', "Rows rejected by validate_data")
+UPSERT_SECONDS = metrics.histogram('scraper_upsert_seconds', "save_stocks time (diff, upsert, events, commit)")
+ROWS_SAVED = metrics.counter('scraper_rows_saved_total', "Rows by save outcome (inserted, updated, unchanged)", ['result'])
+
+def _event_value(value):
+    # JSON-friendly value for stock_events.changes
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
 class ScraperService:
-    def scrape_histock(self):
+    def __init__(self, parser_backend=None):
+        self.parser_backend = parser_backend or Config.SCRAPER_PARSER
+
+    def scrape_histock(self, force=False):
         """
         Primary Source: HiStock
+        Returns None when the page is unchanged since the last snapshot
+        (304 or same content hash), so callers can skip parsing and saving.
+        force: fetch unconditionally and parse even if the content is unchanged.
+        """
+        try:
+            source = SOURCES['histock']
+            html = self.fetch_page(source.name, source.url, force=force)
+        except Exception as e:
+            logger.error(f"Scraping failed: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+            return []
+
+        if html is None:
+            return None
+        return self.parse_histock(html)
+
+    def fetch_page(self, source, url, force=False):
+        """
+        Conditional GET backed by PageSnapshot.
+        Sends If-None-Match / If-Modified-Since from the latest applied snapshot and
+        returns None if the server says 304 or the body hashes the same.
+        New content is stored as a compressed snapshot before it is returned.
+        """
+        latest, headers = self._conditional_request(source, force)
+        logger.info(f"Fetching {url}...")
+        response = get_client().get(url, headers=headers, timeout=10)
+        return self._handle_response(source, url, response, latest, force)
+
+    def _conditional_request(self, source, force=False):
+        """
+        Latest snapshot for the source and the request headers built from it.
+        No validators until the snapshot's rows were saved (applied_at), so a page
+        whose save failed is fetched and saved again instead of getting a 304.
+        """
+        latest = PageSnapshot.latest(source)
+
+        headers = dict(REQUEST_HEADERS)
+        if latest and latest.applied_at and not force:
+            if latest.etag:
+                headers['If-None-Match'] = latest.etag
+            if latest.last_modified:
+                headers['If-Modified-Since'] = latest.last_modified
+        return latest, headers
+
+    def _handle_response(self, source, url, response, latest, force=False):
+        """
+        Returns the page HTML if it is new (or force is set), None if unchanged.
+        """
+        if response.status_code == 304:
+            logger.info(f"{source}: 304 Not Modified, skipping.")
+            return None
+        response.raise_for_status()
+
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        if latest and latest.content_hash == content_hash:
+            # Same bytes; keep the newest validators so the next run can get a 304
+            latest.etag = response.headers.get('ETag') or latest.etag
+            latest.last_modified = response.headers.get('Last-Modified') or latest.last_modified
+            db.session.commit()
+            if latest.applied_at and not force:
+                logger.info(f"{source}: content hash unchanged, skipping.")
+                return None
+        else:
+            self._store_snapshot(source, url, response, content_hash)
+
+        return response.text
+
+    def _store_snapshot(self, source, url, response, content_hash):
+        snapshot = PageSnapshot(
+            source=source,
+            url=url,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+            encoding=response.encoding,
+            content_hash=content_hash,
+            body=zlib.compress(response.content, 9),
+        )
+        db.session.add(snapshot)
+        db.session.flush()
+
+        # Retention: keep only the most recent snapshots per source
+        keep_ids = db.session.query(PageSnapshot.id).filter_by(source=source) \
+            .order_by(PageSnapshot.fetched_at.desc(), PageSnapshot.id.desc()) \
+            .limit(SNAPSHOT_RETENTION)
+        PageSnapshot.query.filter(
+            PageSnapshot.source == source,
+            PageSnapshot.id.notin_(keep_ids.scalar_subquery())
+        ).delete(synchronize_session=False)
+
+        db.session.commit()
+        logger.info(f"{source}: stored snapshot {content_hash[:8]} ({len(snapshot.body)} bytes compressed).")
+
+    def parse_histock(self, html, backend=None, gift_year=None):
+        """
+        Parse a HiStock gift.aspx page (live or from a snapshot) into stock dicts.
+        backend: parser engine name from services.parsers (default: Config.SCRAPER_PARSER).
+        gift_year: season the page lists (default: this year); also the year for MM/DD dates.
         """
-        url = "https://histock.tw/stock/gift.aspx"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        }
-        
         results = []
         try:
-            logger.info(f"Fetching {url}...")
-            response = requests.get(url, headers=headers, timeout=10)
-            response.raise_for_status()
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Find the main table: look for headers
-            target_table = None
-            tables = soup.find_all('table')
-            
-            col_map = {}
-            
-            for table in tables:
-                headers_row = table.find('tr')
-                if not headers_row:
-                    continue
-                
-                header_cells = [c.get_text(strip=True) for c in headers_row.find_all(['th', 'td'])]
-                
-                # Identify columns dynamically
-                current_map = {}
-                for idx, text in enumerate(header_cells):
-                    if "代號" in text: current_map['id'] = idx
-                    elif "名稱" in text: current_map['name'] = idx # Sometimes combined
-                    elif "股東會紀念品" in text: current_map['gift'] = idx
-                    elif "股東會日期" in text: current_map['meeting_date'] = idx
-                    elif "最後買進日" in text: current_map['last_buy_date'] = idx
-                
-                # Check if this is the correct table (needs minimal fields)
-                if 'gift' in current_map and ('id' in current_map or 'name' in current_map):
-                    target_table = table
-                    col_map = current_map
-                    logger.info(f"Found target table with columns: {col_map}")
-                    break
-            
-            if not target_table:
+            col_map, rows = get_parser(backend or self.parser_backend)(html)
+
+            if col_map is None:
                 logger.error("Could not find stock gift table.")
                 return []
-                
-            # Parse Rows
-            rows = target_table.find_all('tr')[1:] # Skip header
-            for row in rows:
-                cells = row.find_all('td')
+            logger.info(f"Found target table with columns: {col_map}")
+
+            # Column positions resolved once for every row
+            id_idx = col_map.get('id')
+            name_idx = col_map.get('name')
+            gift_idx = col_map.get('gift')
+            meeting_idx = col_map.get('meeting_date')
+            last_buy_idx = col_map.get('last_buy_date')
+
+            if gift_year is None:
+                gift_year = date.today().year
+
+            # Parse Rows (each cell is already its stripped text)
+            for cells in rows:
                 if not cells: continue
+                n_cells = len(cells)
                 
                 try:
                     # Extract Data
@@ -69,19 +182,16 @@ class ScraperService:
                     stock_name = ""
                     
                     # Logic for ID column (often has <a> link)
-                    if 'id' in col_map and len(cells) > col_map['id']:
-                        id_cell = cells[col_map['id']]
+                    if id_idx is not None and n_cells > id_idx:
+                        id_text = cells[id_idx]
                         # ID is likely 4 digits
-                        stock_id = id_cell.get_text(strip=True)[:4] 
+                        stock_id = id_text[:4]
                         # Name might be in the same cell or separate
-                        stock_name = id_cell.get_text(strip=True)[4:].strip()
-                        
-                        # Inspect link if present for cleaner ID
-                        # (Not strictly needed if text parsing works)
+                        stock_name = id_text[4:].strip()
 
                     # Logic for Name (if separate)
-                    if not stock_name and 'name' in col_map and len(cells) > col_map['name']:
-                         stock_name = cells[col_map['name']].get_text(strip=True)
+                    if not stock_name and name_idx is not None and n_cells > name_idx:
+                         stock_name = cells[name_idx]
                     
                     # Fallback name if empty (extract from link if possible)
                     if not stock_name:
@@ -89,32 +199,23 @@ class ScraperService:
 
                     # Gift Name
                     gift_name = ""
-                    if 'gift' in col_map and len(cells) > col_map['gift']:
-                        gift_name = cells[col_map['gift']].get_text(strip=True)
-                    
-                    # Extract Gift Year from page or assume next year if strictly future list
-                    # For now, let's assume the year is part of the context or current year + 1
-                    # A robust way is to find "2026" in the page title. 
-                    # Assuming 2026 for now based on known URL context.
-                    gift_year = 2026 
+                    if gift_idx is not None and n_cells > gift_idx:
+                        gift_name = cells[gift_idx]
                     
                     # Meeting Date
                     meeting_date = None
-                    if 'meeting_date' in col_map and len(cells) > col_map['meeting_date']:
-                        date_str = cells[col_map['meeting_date']].get_text(strip=True)
-                        meeting_date = self._parse_date(date_str, default_year=gift_year)
+                    if meeting_idx is not None and n_cells > meeting_idx:
+                        meeting_date = self._parse_date(cells[meeting_idx], default_year=gift_year)
 
                     # Last Buy Date
                     last_buy_date = None
-                    if 'last_buy_date' in col_map and len(cells) > col_map['last_buy_date']:
-                         date_str = cells[col_map['last_buy_date']].get_text(strip=True)
-                         last_buy_date = self._parse_date(date_str, default_year=gift_year)
+                    if last_buy_idx is not None and n_cells > last_buy_idx:
+                         last_buy_date = self._parse_date(cells[last_buy_idx], default_year=gift_year)
                     
                     # Cross-Year Logic Check
                     # If Last Buy is Dec (12) and Meeting is Jan (1), Last Buy should be Prev Year
                     if last_buy_date and meeting_date:
                         if last_buy_date.month > meeting_date.month + 6: # Simple heuristic: if buy is way later than meet, it's probably prev year
-                             from datetime import date
                              last_buy_date = last_buy_date.replace(year=last_buy_date.year - 1)
                     
                     # Validation Check
@@ -133,7 +234,7 @@ class ScraperService:
                     continue
                     
         except Exception as e:
-            logger.error(f"Scraping failed: {e}")
+            logger.error(f"Parsing failed: {e}")
             import traceback
             logger.error(traceback.format_exc())
             
@@ -197,52 +298,255 @@ class ScraperService:
 
     def save_stocks(self, stocks_data):
         """
-        Persist valid stocks to DB.
+        Persist valid stocks to DB with a batched, set-based upsert.
         Integrity: Never overwrite existing valid data with empty data.
+        Only rows whose name, gift or dates actually changed are written, so
+        `updated_at` keeps meaning "last real change" for broadcast_job.
+        Returns counts of inserted / updated / unchanged rows; raises (after
+        rolling back) if the rows could not be written.
         """
-        count = 0
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+        # Dedupe by stock_id (last one wins); ON CONFLICT can't touch a row twice per statement
+        rows = {}
         for data in stocks_data:
-            stock = Stock.query.get(data['stock_id'])
-            if stock:
-                # Update logic
-                stock.name = data['name']
-                stock.gift_name = data['gift_name']
-                stock.meeting_date = data['meeting_date']
-                stock.gift_year = data.get('gift_year')
-                # Recalculate dates if needed
-                if data.get('vote_start_date'):
-                    stock.vote_start_date = data['vote_start_date']
-                if data.get('last_buy_date'):
-                    stock.last_buy_date = data['last_buy_date']
-            else:
-                # Insert
-                stock = Stock(**data)
-                db.session.add(stock)
-            count += 1
-        
+            rows[data['stock_id']] = {field: data.get(field) for field in STOCK_FIELDS}
+        rows = list(rows.values())
+
+        start = time.perf_counter()
         try:
+            rescheduled = {}  # stock_id -> new last buy date
+            inserted = set()
+            for i in range(0, len(rows), UPSERT_BATCH_SIZE):
+                batch = rows[i:i + UPSERT_BATCH_SIZE]
+                changed, events = self._diff_batch(batch, counts)
+                if changed:
+                    db.session.execute(self._upsert_statement(changed))
+                    # Change log in the same transaction as the rows it describes
+                    db.session.execute(StockEvent.__table__.insert(), events)
+                    dates = {row['stock_id']: row['last_buy_date'] for row in changed}
+                    for event in events:
+                        if 'last_buy_date' in event['changes']:
+                            rescheduled[event['stock_id']] = dates[event['stock_id']]
+                            if event['kind'] == 'new':
+                                inserted.add(event['stock_id'])
+            # Reminder due queue: only stocks whose last buy date is new or moved, from the
+            # dates just written (new stocks have no reminders to drop)
+            if rescheduled and Config.REMINDERS_ENABLED:
+                reminders.schedule_dates(rescheduled, new_ids=inserted)
             db.session.commit()
-            logger.info(f"Saved {count} stocks to database.")
+            UPSERT_SECONDS.observe(time.perf_counter() - start)
+            if counts['inserted'] or counts['updated']:
+                catalog.invalidate()
+            if rescheduled:
+                reminders.invalidate()
+            for result, count in counts.items():
+                ROWS_SAVED.inc(count, result=result)
+            logger.info(
+                f"Saved stocks: {counts['inserted']} inserted, "
+                f"{counts['updated']} updated, {counts['unchanged']} unchanged."
+            )
         except Exception as e:
             db.session.rollback()
             logger.error(f"Failed to commit stocks: {e}")
+            raise
+        return counts
+
+    def _diff_batch(self, batch, counts):
+        """
+        One SELECT per batch: compare scraped rows with what is stored and
+        return the rows that need writing (new or changed) plus a stock_events
+        row for each, recording which fields changed from what to what.
+        """
+        existing = {
+            row.stock_id: row
+            for row in db.session.query(Stock.stock_id, *[getattr(Stock, f) for f in COMPARED_FIELDS])
+            .filter(Stock.stock_id.in_([r['stock_id'] for r in batch]))
+        }
+
+        now = datetime.utcnow()
+        changed = []
+        events = []
+        for row in batch:
+            current = existing.get(row['stock_id'])
+            if current is None:
+                counts['inserted'] += 1
+                changed.append(row)
+                events.append({
+                    'stock_id': row['stock_id'],
+                    'kind': 'new',
+                    'changes': {
+                        field: [None, _event_value(row[field])]
+                        for field in COMPARED_FIELDS if row[field] is not None
+                    },
+                    'created_at': now,
+                })
+                continue
+
+            changes = {}
+            for field in COMPARED_FIELDS:
+                new_value = row[field]
+                # Empty optional dates keep the stored value, so they are never a change
+                if new_value is None and field in KEEP_IF_EMPTY_FIELDS:
+                    continue
+                old_value = getattr(current, field)
+                if new_value != old_value:
+                    changes[field] = [_event_value(old_value), _event_value(new_value)]
+
+            if changes:
+                counts['updated'] += 1
+                changed.append(row)
+                events.append({'stock_id': row['stock_id'], 'kind': 'updated', 'changes': changes, 'created_at': now})
+            else:
+                counts['unchanged'] += 1
+        return changed, events
 
-    def run(self):
+    def _upsert_statement(self, rows):
+        """
+        INSERT ... ON CONFLICT (stock_id) DO UPDATE for Postgres (and SQLite for local runs).
+        """
+        now = datetime.utcnow()
+        stmt = dialect_insert(Stock).values([dict(row, updated_at=now) for row in rows])
+        excluded = stmt.excluded
+        set_ = {
+            'name': excluded.name,
+            'gift_name': excluded.gift_name,
+            'meeting_date': excluded.meeting_date,
+            'gift_year': excluded.gift_year,
+            # Provenance of the values written now (not itself a change)
+            'field_sources': excluded.field_sources,
+            # onupdate isn't applied to ON CONFLICT, so set it explicitly
+            'updated_at': excluded.updated_at,
+        }
+        for field in KEEP_IF_EMPTY_FIELDS:
+            set_[field] = func.coalesce(getattr(excluded, field), getattr(Stock, field))
+        return stmt.on_conflict_do_update(index_elements=[Stock.stock_id], set_=set_)
+
+    def run(self, force=False):
         """
         Orchestrate scraping and saving.
+        All registered sources are fetched concurrently, then merged by priority.
         """
-        results = self.scrape_histock()
-        
+        results = self.scrape_sources(get_sources(), force=force)
+
+        if results is None:
+            logger.info("No source changed since last scrape. Nothing to do.")
+            return None
+
+        merged = merge_results(results)
+        logger.info(f"Merged {len(merged)} stocks from {len(results)} sources.")
+        counts = self._save_results(merged)
+        if counts is not None:
+            # Only now may later runs skip these pages (304 / same hash)
+            self._mark_applied([source.name for source, _ in results])
+        return counts
+
+    def _mark_applied(self, sources):
+        """
+        Mark each source's latest snapshot (the page just saved) as applied.
+        """
+        now = datetime.utcnow()
+        for source in sources:
+            latest = PageSnapshot.latest(source)
+            if latest and latest.applied_at is None:
+                latest.applied_at = now
+        db.session.commit()
+
+    def scrape_sources(self, sources, force=False):
+        """
+        Fetch all sources at once (HTTP in a thread pool; snapshots and parsing here),
+        each bounded by its own timeout, so the run takes about as long as the slowest source.
+        Unchanged sources are re-parsed from their latest snapshot so the merge stays complete.
+        Returns [(source, rows), ...], or None if no source had new content.
+        Raises RuntimeError if every source failed, so the run is not mistaken for "unchanged".
+        """
+        if not sources:
+            return None
+
+        prepared = {s.name: self._conditional_request(s.name, force) for s in sources}
+
+        pool = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix='scrape')
+        start = time.monotonic()
+        futures = {}
+        for source in sources:
+            logger.info(f"Fetching {source.url}...")
+            futures[source.name] = pool.submit(_timed_fetch, source, prepared[source.name][1])
+
+        results = []
+        changed = False
+        try:
+            for source in sources:
+                latest = prepared[source.name][0]
+                try:
+                    remaining = max(0, start + source.timeout - time.monotonic())
+                    response = futures[source.name].result(timeout=remaining)
+                    html = self._handle_response(source.name, source.url, response, latest, force)
+                    if html is not None:
+                        changed = True
+                        FETCH_RESULTS.inc(source=source.name, result='changed')
+                    else:
+                        FETCH_RESULTS.inc(source=source.name, result='unchanged')
+                        if latest:
+                            html = latest.html
+                except FutureTimeoutError:
+                    FETCH_RESULTS.inc(source=source.name, result='timeout')
+                    logger.error(f"{source.name}: timed out after {source.timeout}s.")
+                    continue
+                except Exception as e:
+                    FETCH_RESULTS.inc(source=source.name, result='error')
+                    logger.error(f"{source.name}: scraping failed: {e}")
+                    continue
+
+                rows = []
+                if html:
+                    with PARSE_SECONDS.time(source=source.name):
+                        rows = source.parse(self, html)
+                ROWS_PARSED.inc(len(rows), source=source.name)
+                results.append((source, rows))
+        finally:
+            # Don't wait for sources that ran past their deadline
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        logger.info(f"Scraped {len(sources)} sources in {time.monotonic() - start:.2f}s.")
         if not results:
-            logger.info("HiStock returned no data. Trying WantGoo...")
-            results = self.scrape_wantgoo()
-            
+            raise RuntimeError(f"All {len(sources)} sources failed")
+        if not changed:
+            return None
+        return results
+
+    def reparse_snapshot(self, snapshot_id=None):
+        """
+        Re-run the parser over a stored snapshot (latest HiStock one by default)
+        and save the result, without fetching anything.
+        """
+        if snapshot_id:
+            snapshot = PageSnapshot.query.get(snapshot_id)
+        else:
+            snapshot = PageSnapshot.latest('histock')
+        if not snapshot:
+            logger.info("No snapshot to re-parse.")
+            return None
+
+        logger.info(f"Re-parsing snapshot {snapshot.id} from {snapshot.fetched_at}.")
+        with PARSE_SECONDS.time(source=snapshot.source):
+            rows = self.parse_histock(snapshot.html)
+        ROWS_PARSED.inc(len(rows), source=snapshot.source)
+        return self._save_results(rows)
+
+    def _save_results(self, results):
         valid_stocks = []
         for stock in results:
             if self.validate_data(stock):
                 valid_stocks.append(stock)
-        
+        ROWS_REJECTED.inc(len(results) - len(valid_stocks))
+
         if valid_stocks:
-            self.save_stocks(valid_stocks)
+            return self.save_stocks(valid_stocks)
         else:
             logger.info("No valid stock data found to save.")
+
+
+def _timed_fetch(source, headers):
+    # Runs in the fetch pool; observed even when the request fails
+    with FETCH_SECONDS.time(source=source.name):
+        return source.fetch(headers)
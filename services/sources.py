@@ -0,0 +1,121 @@
+import logging
+
+from utils.http import get_client
+
+logger = logging.getLogger(__name__)
+
+# Fields merged across sources (stock_id is the dedupe key)
+MERGE_FIELDS = ('name', 'gift_name', 'meeting_date', 'vote_start_date', 'last_buy_date', 'gift_year')
+
+SOURCES = {}
+
+
+def register_source(cls):
+    """
+    Class decorator: add a Source plugin to the registry.
+    """
+    SOURCES[cls.name] = cls()
+    return cls
+
+
+def get_sources():
+    """
+    Enabled sources, highest priority first.
+    """
+    return sorted(
+        (s for s in SOURCES.values() if s.enabled),
+        key=lambda s: s.priority,
+        reverse=True
+    )
+
+
+class Source:
+    """
+    A scrape source plugin.
+    fetch() runs in a worker thread (HTTP only, no DB); parse() runs in the caller's
+    thread and gets the page HTML (live or from the latest snapshot).
+    """
+    name = None
+    url = None
+    priority = 0    # Higher wins when sources disagree on a field
+    timeout = 10    # Seconds; also the source's overall deadline in ScraperService.run
+    enabled = True
+
+    def fetch(self, headers):
+        return get_client().get(self.url, headers=headers, timeout=self.timeout)
+
+    def parse(self, scraper, html):
+        raise NotImplementedError
+
+
+@register_source
+class HiStockSource(Source):
+    """
+    Primary Source: HiStock
+    """
+    name = 'histock'
+    url = "https://histock.tw/stock/gift.aspx"
+    priority = 100
+    timeout = 10
+
+    def parse(self, scraper, html):
+        return scraper.parse_histock(html)
+
+
+@register_source
+class WantGooSource(Source):
+    """
+    Backup Source: WantGoo
+    Placeholder: disabled until a parser exists.
+    """
+    name = 'wantgoo'
+    url = None
+    priority = 50
+    timeout = 10
+    enabled = False
+
+    def parse(self, scraper, html):
+        return scraper.scrape_wantgoo()
+
+
+def _is_empty(field, value):
+    if value is None or value == '':
+        return True
+    # Parser placeholder, let a lower-priority source fill in a real name
+    return field == 'name' and value == "Unknown"
+
+
+def merge_results(results):
+    """
+    Combine [(source, rows), ...] into one row per stock_id.
+    Each field takes the first non-empty value in source priority order, and
+    row['field_sources'] records which source supplied it.
+    """
+    merged = {}
+    for source, rows in sorted(results, key=lambda r: r[0].priority, reverse=True):
+        for row in rows:
+            stock_id = row.get('stock_id')
+            if not stock_id:
+                continue
+
+            target = merged.get(stock_id)
+            if target is None:
+                target = merged[stock_id] = {'stock_id': stock_id, 'field_sources': {}}
+            provenance = target['field_sources']
+
+            for field in MERGE_FIELDS:
+                if field in provenance:
+                    continue
+                value = row.get(field)
+                if _is_empty(field, value):
+                    continue
+                target[field] = value
+                provenance[field] = source.name
+
+    for target in merged.values():
+        for field in MERGE_FIELDS:
+            target.setdefault(field, None)
+        if not target['name']:
+            target['name'] = "Unknown"
+
+    return list(merged.values())
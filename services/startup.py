@@ -0,0 +1,70 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import text
+
+from models import db, init_db
+
+logger = logging.getLogger(__name__)
+
+
+class Startup:
+    """
+    Boot work kept off the request path. start() runs init_db once and opens a
+    pooled DB connection in a daemon thread, then optionally starts the scheduler,
+    so /health and /webhook answer before the scraping/scheduling stack is imported.
+    The process has a single SchedulerService, created on first use (scheduler()).
+    """
+
+    def __init__(self, app, line_bot_api=None):
+        self.app = app
+        self.line_bot_api = line_bot_api
+        self.ready = threading.Event()
+        self.error = None
+        self._scheduler = None
+        self._scheduler_lock = threading.Lock()
+        self._thread = None
+
+    def start(self, start_scheduler=False):
+        self._thread = threading.Thread(
+            target=self._run, args=(start_scheduler,), name='startup', daemon=True
+        )
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """
+        Block until boot work is done; True if it finished without error.
+        """
+        self.ready.wait(timeout)
+        return self.ready.is_set() and self.error is None
+
+    def scheduler(self):
+        with self._scheduler_lock:
+            if self._scheduler is None:
+                # Deferred: pulls in APScheduler, the scraper and the dispatcher
+                from services.scheduler import SchedulerService
+                self._scheduler = SchedulerService(self.app, line_bot_api=self.line_bot_api)
+            return self._scheduler
+
+    def _run(self, start_scheduler):
+        start = time.perf_counter()
+        try:
+            with self.app.app_context():
+                if self.app.config['INIT_DB_ON_BOOT']:
+                    init_db()
+                # Open the first pooled connection now rather than on the first webhook
+                db.session.execute(text('SELECT 1'))
+                db.session.remove()
+            logger.info(f"Database ready in {time.perf_counter() - start:.2f}s.")
+        except Exception as e:
+            self.error = e
+            logger.error(f"Startup DB warm-up failed: {e}")
+        finally:
+            self.ready.set()
+
+        if start_scheduler:
+            try:
+                self.scheduler().start()
+            except Exception as e:
+                logger.error(f"Failed to start scheduler: {e}")
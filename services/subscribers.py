@@ -0,0 +1,45 @@
+import logging
+
+from sqlalchemy import exists, func
+from models import db, User, Subscription
+from services.dispatcher import MULTICAST_LIMIT
+
+logger = logging.getLogger(__name__)
+
+
+def iter_active_user_batches(batch_size=MULTICAST_LIMIT, without_watchlist=False):
+    """
+    Yield active subscribers' line_user_ids in sorted batches of up to batch_size.
+    Keyset pagination on line_user_id (backed by ix_users_active_line_user_id):
+    only one batch of plain strings is held at a time, whatever the follower count.
+    without_watchlist: only users with no stock subscriptions (they get the full report,
+    which already holds any keyword alert matches).
+    Must be consumed inside an app context.
+    """
+    last_id = None
+    while True:
+        query = _active_users_query(User.line_user_id, without_watchlist)
+        if last_id is not None:
+            query = query.filter(User.line_user_id > last_id)
+        batch = [row[0] for row in query.order_by(User.line_user_id).limit(batch_size)]
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1]
+
+
+def count_active_users(without_watchlist=False):
+    return _active_users_query(func.count(User.id), without_watchlist).scalar()
+
+
+def has_active_users():
+    return db.session.query(User.id).filter(User.is_active.is_(True)).first() is not None
+
+
+def _active_users_query(column, without_watchlist=False):
+    query = db.session.query(column).filter(User.is_active.is_(True))
+    if without_watchlist:
+        query = query.filter(~exists().where(Subscription.user_id == User.id))
+    return query
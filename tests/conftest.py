@@ -0,0 +1,107 @@
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from models import db, init_db
+
+
+@pytest.fixture
+def app(tmp_path):
+    """
+    App with a fresh SQLite file database (a file, so dispatcher threads share it).
+    """
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'test.db'}",
+        LINE_CHANNEL_ACCESS_TOKEN='test',
+        LINE_MULTICAST_RATE=0,
+        DELIVERY_STRATEGY='multicast',
+        REMINDERS_ENABLED=False,
+    )
+    db.init_app(app)
+    with app.app_context():
+        init_db()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture(scope='session')
+def web(tmp_path_factory):
+    """
+    The app module (routes, webhook handler) on a temporary SQLite database, scheduler off.
+    """
+    overrides = {
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path_factory.mktemp('web') / 'web.db'}",
+        'LINE_CHANNEL_ACCESS_TOKEN': 'test',
+        'LINE_CHANNEL_SECRET': 'test-secret',
+        'SCHEDULER_EMBEDDED': False,
+    }
+    saved = {name: getattr(Config, name) for name in overrides}
+    for name, value in overrides.items():
+        setattr(Config, name, value)
+    try:
+        import app as web
+    finally:
+        for name, value in saved.items():
+            setattr(Config, name, value)
+    assert web.startup.wait(timeout=30)
+    return web
+
+
+@pytest.fixture
+def web_client(web):
+    """
+    Test client for the app module, on emptied tables and caches.
+    """
+    from services import catalog
+    with web.app.app_context():
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+    catalog.invalidate()
+    web.active_users.clear()
+    with web.app.app_context():
+        yield web.app.test_client()
+        db.session.remove()
+
+
+class FakeLineApi:
+    """
+    Duck-typed LineBotApi recording multicasts as (recipients, message texts or alt texts).
+    fail(n) makes the n-th multicast call from now on raise; with fail_all set every
+    call does. State lives in shared
+    containers, as the dispatcher calls shallow copies (utils.http.scoped_line_api).
+    """
+
+    def __init__(self):
+        self.headers = {}
+        self.multicasts = []
+        self._calls = [0]
+        self._fail_at = set()
+        self.fail_all = False
+
+    def fail(self, call):
+        self._fail_at.add(self._calls[0] + call)
+
+    def multicast(self, to, messages, retry_key=None):
+        self._calls[0] += 1
+        if self.fail_all or self._calls[0] in self._fail_at:
+            self._fail_at.discard(self._calls[0])
+            raise ValueError("injected failure")
+        self.multicasts.append((list(to), [_text(message) for message in messages]))
+
+
+def _text(message):
+    payload = message.as_json_dict()
+    return payload.get('text') or payload.get('altText')
+
+
+@pytest.fixture
+def line_api():
+    return FakeLineApi()
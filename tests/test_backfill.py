@@ -0,0 +1,74 @@
+import zlib
+from datetime import date
+
+from models import db, BackfillCheckpoint, PageSnapshot, StockHistory
+from services import backfill as backfill_module
+from services.backfill import HistoryBackfill, snapshot_source
+from services.scraper import ScraperService
+
+
+def season_page(title, rows=(('1101', '台泥', '咖啡券'),)):
+    out = [f"<html><head><title>{title}</title></head><body><table>",
+           "<tr><th>代號名稱</th><th>最後買進日</th><th>股東會日期</th><th>股東會紀念品</th></tr>"]
+    for stock_id, name, gift in rows:
+        out.append(f"<tr><td>{stock_id}{name}</td><td>05/10</td><td>06/15</td><td>{gift}</td></tr>")
+    out.append("</table></body></html>")
+    return "".join(out)
+
+
+def store_snapshot(year, html):
+    db.session.add(PageSnapshot(source=snapshot_source(year), url=f"https://example.test/{year}",
+                                content_hash=str(year), body=zlib.compress(html.encode('utf-8'))))
+    db.session.commit()
+
+
+def test_rerun_resumes_from_checkpoints(app):
+    store_snapshot(2024, season_page("2024股東會紀念品"))
+    backfill = HistoryBackfill("https://example.test/{year}", workers=2, from_snapshots=True)
+
+    # 2025 has no snapshot yet: it fails, 2024 is loaded and checkpointed
+    summary = backfill.run([2024, 2025])
+    assert summary['loaded'] == {2024: 1} and 2025 in summary['failed']
+    assert db.session.get(BackfillCheckpoint, 2025).status == 'failed'
+
+    store_snapshot(2025, season_page("114年股東會紀念品", rows=[('1101', '台泥', '毛巾'), ('2330', '台積電', '無')]))
+    summary = backfill.run([2024, 2025])
+    assert summary['skipped'] == [2024] and summary['loaded'] == {2025: 2}
+    assert db.session.get(StockHistory, ('1101', 2024)).gift_name == '咖啡券'
+    assert db.session.get(StockHistory, ('1101', 2025)).meeting_date == date(2025, 6, 15)
+
+
+class FakeClient:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get(self, url, headers=None, timeout=None):
+        return FakeResponse(self.pages[url])
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+        self.content = text.encode('utf-8')
+        self.headers = {}
+        self.encoding = 'utf-8'
+
+    def raise_for_status(self):
+        pass
+
+
+def test_season_page_naming_another_season_is_rejected(app, monkeypatch):
+    # The archive URL fell back to the current season's page
+    pages = {"https://example.test/2020": season_page("2026股東會紀念品")}
+    monkeypatch.setattr(backfill_module, 'get_client', lambda: FakeClient(pages))
+
+    summary = HistoryBackfill("https://example.test/{year}").run([2020])
+    assert "2026 season" in summary['failed'][2020]
+    assert StockHistory.query.count() == 0
+
+
+def test_live_scrape_does_not_take_the_year_from_the_title(app):
+    rows = ScraperService().parse_histock(season_page("2020股東會紀念品"))
+    assert rows[0]['gift_year'] == date.today().year
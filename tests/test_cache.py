@@ -0,0 +1,61 @@
+from models import db
+from services.ingest import EventIngestor
+from utils import cache as cache_module
+from utils.cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, 'monotonic', clock)
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.add('U1')
+
+    clock.now += 59
+    assert 'U1' in cache
+    clock.now += 1
+    assert 'U1' not in cache
+    assert cache.stats() == {'size': 0, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+    # Re-adding restarts the TTL
+    cache.add('U1')
+    clock.now += 30
+    cache.add('U1')
+    clock.now += 45
+    assert 'U1' in cache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.add('U1')
+    cache.add('U2')
+    assert 'U1' in cache  # U2 is now the least recently used
+    cache.add('U3')
+
+    assert 'U2' not in cache
+    assert 'U1' in cache and 'U3' in cache
+    assert cache.stats()['evictions'] == 1 and cache.stats()['size'] == 2
+
+
+def test_ingestor_caches_users_only_once_written_active(app, monkeypatch):
+    cache = TTLCache()
+    cache.add('U2')
+    ingestor = EventIngestor(app, active_cache=cache)
+
+    ingestor._flush([('U1', False), ('U1', True), ('U2', False)])
+    assert 'U1' in cache
+    assert 'U2' not in cache
+
+    def broken():
+        raise RuntimeError("database unavailable")
+    monkeypatch.setattr(db.session, 'commit', broken)
+    ingestor.max_retries = 0
+    ingestor._flush([('U3', True)])
+    assert 'U3' not in cache
@@ -0,0 +1,93 @@
+import json
+from datetime import date
+
+import pytest
+
+from models import db, Stock, StockEvent
+from services.catalog import StockCatalog, parse_query
+from services.scraper import ScraperService
+
+
+def stock(stock_id, meeting_date, last_buy_date=None, gift_year=2026, gift_name='咖啡券'):
+    return {'stock_id': stock_id, 'name': f"Stock {stock_id}", 'gift_name': gift_name, 'gift_year': gift_year,
+            'meeting_date': meeting_date, 'last_buy_date': last_buy_date}
+
+
+STOCKS = [
+    stock('2330', date(2026, 6, 10), date(2026, 5, 1)),
+    stock('1101', date(2026, 6, 10), date(2026, 5, 20)),
+    stock('1102', date(2026, 6, 12), date(2026, 5, 25), gift_year=2025),
+    stock('2002', date(2026, 6, 15), date(2026, 5, 30)),
+    stock('2412', date(2026, 6, 20)),
+]
+
+
+def ids(page):
+    return [item['stock_id'] for item in json.loads(page.body)['data']]
+
+
+def test_pages_follow_the_cursor_in_meeting_order(app):
+    ScraperService().save_stocks(STOCKS)
+    catalog = StockCatalog()
+
+    seen, cursor = [], None
+    while True:
+        body = json.loads(catalog.page(parse_query({'limit': '2', 'cursor': cursor})).body)
+        seen.append([item['stock_id'] for item in body['data']])
+        cursor = body['next_cursor']
+        if cursor is None:
+            break
+    assert seen == [['1101', '2330'], ['1102', '2002'], ['2412']]
+
+
+def test_filters_skip_to_meeting_from_and_stop_at_meeting_to(app):
+    ScraperService().save_stocks(STOCKS)
+    catalog = StockCatalog()
+    today = date(2026, 5, 10)
+
+    assert ids(catalog.page(parse_query({'meeting_from': '2026-06-11', 'meeting_to': '2026-06-15'}))) == ['1102', '2002']
+    assert ids(catalog.page(parse_query({'gift_year': '2026', 'limit': '2'}))) == ['1101', '2330']
+    # Missing or past last-buy dates are not upcoming
+    assert ids(catalog.page(parse_query({'upcoming': 'true'}), today=today)) == ['1101', '1102', '2002']
+    assert ids(catalog.page(parse_query({'upcoming': 'true'}), today=date(2026, 5, 26))) == ['2002']
+
+
+@pytest.mark.parametrize('args', [{'limit': '0'}, {'limit': 'all'}, {'upcoming': 'soon'},
+                                  {'meeting_from': '06/10'}, {'cursor': 'not-a-cursor'}])
+def test_bad_queries_are_rejected(args):
+    with pytest.raises(ValueError):
+        parse_query(args)
+
+
+def test_changes_from_another_process_are_picked_up_by_version(app):
+    ScraperService().save_stocks(STOCKS[:2])
+    catalog = StockCatalog(version_check_seconds=0)
+    before = catalog.page(parse_query({}))
+    assert catalog.page(parse_query({})) is before
+
+    # Written without this process's invalidate(): only the stock_events id changes
+    db.session.add(Stock(**stock('2002', date(2026, 6, 1))))
+    db.session.add(StockEvent(stock_id='2002', kind='new', changes={}))
+    db.session.commit()
+    assert ids(catalog.page(parse_query({}))) == ['2002', '1101', '2330']
+
+
+def test_etag_answers_304_until_the_page_changes(web_client):
+    ScraperService().save_stocks(STOCKS)
+    response = web_client.get('/api/stocks?limit=2')
+    assert response.status_code == 200 and response.json['data'][0]['stock_id'] == '1101'
+    etag = response.headers['ETag']
+    assert response.headers['Cache-Control'].startswith('public, max-age=')
+
+    for header in (etag, f'W/{etag}', f'"other", {etag}', '*'):
+        cached = web_client.get('/api/stocks?limit=2', headers={'If-None-Match': header})
+        assert cached.status_code == 304 and cached.data == b'' and cached.headers['ETag'] == etag
+
+    # A change off this page keeps its ETag; a change on it does not
+    ScraperService().save_stocks([stock('2412', date(2026, 6, 20), gift_name='毛巾')])
+    assert web_client.get('/api/stocks?limit=2', headers={'If-None-Match': etag}).status_code == 304
+    ScraperService().save_stocks([stock('1101', date(2026, 6, 10), date(2026, 5, 20), gift_name='毛巾')])
+    changed = web_client.get('/api/stocks?limit=2', headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+
+    assert web_client.get('/api/stocks?cursor=bogus').status_code == 400
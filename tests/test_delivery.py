@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from benchmarks.fake_line import FakeLineServer
+from models import db, DeliveryRun
+from services.delivery import Audience, DeliveryFailed, DeliveryPlanner
+from services.dispatcher import MulticastDispatcher
+from utils.flex import create_stock_report
+from utils.http import create_line_bot_api
+from tests.test_scheduler import add_stock
+
+
+@pytest.fixture
+def fake_line():
+    server = FakeLineServer().start()
+    yield server
+    server.stop()
+
+
+def test_narrowcast_deletes_its_audience_group(app, fake_line):
+    app.config['LINE_API_ENDPOINT'] = fake_line.url
+    api = create_line_bot_api(app.config)
+    planner = DeliveryPlanner(api, MulticastDispatcher(api, rate=0), strategy='narrowcast', poll_interval=0)
+    users = [f"U{i:032d}" for i in range(3)]
+
+    result = planner.deliver('weekly:test:full', Audience(3, False, lambda: users),
+                             create_stock_report([add_stock('1101')]))
+
+    calls = fake_line.stats()['calls']
+    assert result['status'] == 'sent'
+    assert calls['/v2/bot/message/narrowcast'] == 1
+    assert calls['DELETE /v2/bot/audienceGroup/1'] == 1
+    assert DeliveryRun.query.one().audience_group_id is None
+
+
+def test_narrowcast_deletes_groups_left_by_earlier_runs(app, fake_line):
+    app.config['LINE_API_ENDPOINT'] = fake_line.url
+    api = create_line_bot_api(app.config)
+    planner = DeliveryPlanner(api, MulticastDispatcher(api, rate=0), strategy='narrowcast', poll_interval=0)
+    # Still sending when its run ended two days ago
+    db.session.add(DeliveryRun(job_key='weekly:old:full', strategy='narrowcast', audience_size=3, status='accepted',
+                               audience_group_id=7, finished_at=datetime.utcnow() - timedelta(days=2)))
+    db.session.commit()
+
+    planner.deliver('weekly:test:full', Audience(1, False, lambda: ['U1']), create_stock_report([add_stock('1101')]))
+    assert fake_line.stats()['calls']['DELETE /v2/bot/audienceGroup/7'] == 1
+    assert DeliveryRun.query.filter(DeliveryRun.audience_group_id.isnot(None)).count() == 0
+
+
+def test_failed_multicast_raises(app, line_api):
+    line_api.fail_all = True
+    planner = DeliveryPlanner(line_api, MulticastDispatcher(line_api, rate=0), strategy='multicast')
+
+    with pytest.raises(DeliveryFailed) as failure:
+        planner.deliver('weekly:test:full', Audience(2, False, lambda: ['U1', 'U2']),
+                        create_stock_report([add_stock('1101')]))
+    assert failure.value.run['status'] == 'failed'
+    assert DeliveryRun.query.one().status == 'failed'
+
+
+def test_rejected_narrowcast_falls_back_to_multicast(app, fake_line):
+    app.config['LINE_API_ENDPOINT'] = fake_line.url
+    fake_line.errors['/v2/bot/audienceGroup/upload'] = 400  # e.g. audience too small
+    api = create_line_bot_api(app.config)
+    planner = DeliveryPlanner(api, MulticastDispatcher(api, rate=0), strategy='narrowcast', poll_interval=0)
+
+    result = planner.deliver('weekly:test:full', Audience(2, False, lambda: ['U1', 'U2']),
+                             create_stock_report([add_stock('1101')]))
+    assert result['strategy'] == 'multicast' and result['status'] == 'sent'
+    assert fake_line.stats()['recipients'] == 2
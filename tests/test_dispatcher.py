@@ -0,0 +1,120 @@
+import pytest
+from linebot.exceptions import LineBotApiError
+from linebot.models import Error, TextSendMessage
+
+from models import DeliveryLedger
+from services import dispatcher as dispatcher_module
+from services.dispatcher import MulticastDispatcher, ledger_key
+
+
+def messages(count):
+    return [TextSendMessage(text=f"m{i}") for i in range(count)]
+
+
+def received(line_api, user_id):
+    return [text for call in line_api.multicasts if user_id in call[0] for text in call[1]]
+
+
+def test_resume_sends_only_message_groups_not_delivered(app, line_api):
+    dispatcher = MulticastDispatcher(line_api, max_workers=1, rate=0)
+    users = [f"U{i:02d}" for i in range(6)]
+    report = messages(7)  # Two requests per chunk: 5 + 2 messages
+
+    line_api.fail(2)  # The second group of the first chunk
+    summary = dispatcher.dispatch('weekly:test', users, report, chunk_size=3)
+    assert summary['failed'] == 3 and summary['sent'] == 3
+    assert DeliveryLedger.query.filter_by(job_key=ledger_key('weekly:test', 1), status='failed').count() == 1
+
+    summary = dispatcher.dispatch('weekly:test', users, report, chunk_size=3)
+    assert summary == {'sent': 3, 'failed': 0, 'skipped': 3, 'chunks': 1, 'requests': 1}
+    for user_id in users:
+        assert received(line_api, user_id) == [f"m{i}" for i in range(7)]
+
+    summary = dispatcher.dispatch('weekly:test', users, report, chunk_size=3)
+    assert summary['skipped'] == 6 and summary['requests'] == 0
+
+
+def test_resume_chunks_do_not_span_users_missing_earlier_groups(app, line_api):
+    dispatcher = MulticastDispatcher(line_api, max_workers=1, rate=0)
+    report = messages(7)
+
+    line_api.fail(1)  # First chunk gets nothing
+    dispatcher.dispatch('weekly:test', ['U00', 'U01'], report, chunk_size=2)
+    line_api.fail(2)  # Second chunk gets only the first group
+    dispatcher.dispatch('weekly:test', ['U02', 'U03'], report, chunk_size=2)
+
+    users = ['U00', 'U01', 'U02', 'U03']
+    dispatcher.dispatch('weekly:test', users, report, chunk_size=4)
+    for user_id in users:
+        assert received(line_api, user_id) == [f"m{i}" for i in range(7)]
+
+
+class FlakyApi:
+    """
+    Raises the queued errors on successive multicast calls, then succeeds.
+    """
+
+    def __init__(self, *errors):
+        self.headers = {}
+        self.errors = list(errors)
+        self.retry_keys = []
+
+    def multicast(self, to, messages, retry_key=None):
+        self.retry_keys.append(retry_key)
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+def api_error(status_code, headers=None, accepted_request_id=None):
+    return LineBotApiError(status_code, headers or {}, accepted_request_id=accepted_request_id,
+                           error=Error(message=f"HTTP {status_code}"))
+
+
+def test_retries_honour_retry_after_with_one_retry_key(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(dispatcher_module.time, 'sleep', sleeps.append)
+    api = FlakyApi(api_error(429, {'Retry-After': '7'}), api_error(503))
+    dispatcher = MulticastDispatcher(api, rate=0, base_delay=2, max_delay=30)
+
+    assert dispatcher.call_with_retries(lambda api, key: api.multicast(['U1'], [], retry_key=key)) == 3
+    assert sleeps[0] == 7
+    assert 0 <= sleeps[1] <= 4  # No Retry-After: jittered backoff for the second attempt
+    assert len(set(api.retry_keys)) == 1
+
+
+def test_retry_after_is_capped_at_max_delay(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(dispatcher_module.time, 'sleep', sleeps.append)
+    api = FlakyApi(api_error(429, {'retry-after': '3600'}))
+    MulticastDispatcher(api, rate=0, max_delay=30).call_with_retries(lambda api, key: api.multicast([], []))
+    assert sleeps == [30]
+
+
+def test_accepted_retry_counts_as_sent_and_client_errors_are_not_retried(monkeypatch):
+    monkeypatch.setattr(dispatcher_module.time, 'sleep', lambda seconds: None)
+    send = lambda api, key: api.multicast([], [])  # noqa: E731
+
+    api = FlakyApi(api_error(500), api_error(409, accepted_request_id='req-1'))
+    assert MulticastDispatcher(api, rate=0).call_with_retries(send) == 2
+
+    api = FlakyApi(api_error(400), api_error(500))
+    with pytest.raises(LineBotApiError) as raised:
+        MulticastDispatcher(api, rate=0).call_with_retries(send)
+    assert raised.value.status_code == 400 and raised.value.attempts == 1
+
+    api = FlakyApi(*[api_error(503)] * 3)
+    with pytest.raises(LineBotApiError) as raised:
+        MulticastDispatcher(api, rate=0, max_retries=1).call_with_retries(send)
+    assert raised.value.attempts == 2
+
+
+def test_recipients_are_chunked_and_every_chunk_is_recorded(app, line_api):
+    dispatcher = MulticastDispatcher(line_api, max_workers=3, rate=0)
+    users = [f"U{i:02d}" for i in range(7)]
+
+    summary = dispatcher.dispatch('weekly:test', [users[:4], users[4:]], messages(1), chunk_size=3)
+    assert summary == {'sent': 7, 'failed': 0, 'skipped': 0, 'chunks': 3, 'requests': 3}
+    assert sorted(call[0] for call in line_api.multicasts) == [users[:3], users[3:6], users[6:]]
+    ledger = DeliveryLedger.query.order_by(DeliveryLedger.first_user_id).all()
+    assert [(row.first_user_id, row.last_user_id, row.user_count) for row in ledger] == [
+        ('U00', 'U02', 3), ('U03', 'U05', 3), ('U06', 'U06', 1)]
@@ -0,0 +1,53 @@
+from datetime import date, datetime, timedelta
+
+from models import db, RenderedReport, Stock, User
+from utils import flex
+
+
+def stock(stock_id):
+    return Stock(stock_id=stock_id, name=f"Stock {stock_id}", gift_name='咖啡券',
+                 meeting_date=date.today() + timedelta(days=30), last_buy_date=date.today() + timedelta(days=5))
+
+
+def test_report_cache_leaves_the_callers_session_alone(app):
+    flex._memory_cache.clear()
+    # No transaction open: the cache commits its own row
+    messages = flex.create_stock_report([stock('1101')])
+    db.session.rollback()
+    assert RenderedReport.query.count() == 1
+
+    # Pending work in the session is neither committed nor rolled back by cache writes or reads
+    db.session.add(User(line_user_id='Upending'))
+    db.session.flush()
+    flex.create_stock_report([stock('1102')])
+    flex._memory_cache.clear()
+    assert flex.create_stock_report([stock('1101')])[0].as_json_dict() == messages[0].as_json_dict()
+    assert User.query.filter_by(line_user_id='Upending').count() == 1
+    db.session.rollback()
+    assert User.query.count() == 0
+
+
+def test_prune_drops_reports_not_used_lately(app):
+    old = datetime.utcnow() - timedelta(days=40)
+    db.session.add_all([
+        RenderedReport(report_key='stale', payload='[]', created_at=old, last_used_at=old),
+        RenderedReport(report_key='never-read', payload='[]', created_at=old),
+        RenderedReport(report_key='used', payload='[]', created_at=old, last_used_at=datetime.utcnow()),
+    ])
+    db.session.commit()
+
+    assert flex.prune_rendered_reports(30) == 2
+    assert [r.report_key for r in RenderedReport.query] == ['used']
+
+
+def test_cache_hit_refreshes_last_used(app):
+    flex._memory_cache.clear()
+    flex.create_stock_report([stock('1101')])
+    row = RenderedReport.query.one()
+    row.last_used_at = datetime.utcnow() - timedelta(days=40)
+    db.session.commit()
+
+    flex._memory_cache.clear()
+    flex.create_stock_report([stock('1101')])
+    db.session.expire_all()
+    assert RenderedReport.query.one().last_used_at > datetime.utcnow() - timedelta(minutes=1)
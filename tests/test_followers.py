@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from models import db, FollowerStaging, User
+from services.followers import FollowerReconciler
+
+
+class FollowersApi:
+    """
+    get_followers_ids over `ids`, `page_size` per page (LINE caps the limit at 1000).
+    """
+
+    def __init__(self, ids, page_size=2):
+        self.ids = list(ids)
+        self.page_size = page_size
+        self.calls = 0
+
+    def get_followers_ids(self, limit=None, start=None):
+        self.calls += 1
+        offset = int(start or 0)
+        end = offset + self.page_size
+        return SimpleNamespace(user_ids=self.ids[offset:end], next=str(end) if end < len(self.ids) else None)
+
+
+def add_users(**states):
+    db.session.add_all(User(line_user_id=uid, is_active=active) for uid, active in states.items())
+    db.session.commit()
+
+
+def user_states():
+    db.session.expire_all()
+    return {user.line_user_id: user.is_active for user in User.query.all()}
+
+
+def test_users_follow_the_follower_list(app):
+    add_users(U1=True, U2=False, U3=True, U4=True, U5=True, U6=True)
+    api = FollowersApi(['U1', 'U2', 'U4', 'U5', 'U6', 'U7', 'U7', 'bad id'])
+
+    counts = FollowerReconciler(api, batch_size=3).run()
+    assert counts == {'added': 1, 'reactivated': 1, 'deactivated': 1, 'followers': 7}
+    assert api.calls == 4
+    assert user_states() == {'U1': True, 'U2': True, 'U3': False, 'U4': True, 'U5': True, 'U6': True, 'U7': True}
+    assert FollowerStaging.query.count() == 0
+
+
+def test_users_created_during_the_run_are_kept(app):
+    add_users(U1=True)
+    db.session.add(User(line_user_id='U2', is_active=True, created_at=datetime.utcnow() + timedelta(minutes=5)))
+    db.session.commit()
+
+    assert FollowerReconciler(FollowersApi(['U1'])).run()['deactivated'] == 0
+    assert user_states() == {'U1': True, 'U2': True}
+
+
+def test_deactivating_too_many_users_rolls_back_the_run(app):
+    add_users(U1=True, U2=True, U3=True, U4=True, U5=False)
+    # A truncated list: two of four active users missing
+    api = FollowersApi(['U1', 'U2', 'U5', 'U9'])
+
+    with pytest.raises(RuntimeError, match="deactivate 2 of 4"):
+        FollowerReconciler(api, max_deactivate_ratio=0.2).run()
+    assert user_states() == {'U1': True, 'U2': True, 'U3': True, 'U4': True, 'U5': False}
+    assert FollowerStaging.query.count() == 0
+
+    api.calls = 0
+    assert FollowerReconciler(api, max_deactivate_ratio=0.5).run()['deactivated'] == 2
+
+
+def test_empty_follower_list_changes_nothing(app, tmp_path):
+    add_users(U1=True)
+    ids_file = tmp_path / 'followers.txt'
+    ids_file.write_text("\n  \n", encoding='utf-8')
+
+    with pytest.raises(RuntimeError, match="No follower ids"):
+        FollowerReconciler(None, ids_file=str(ids_file)).run()
+    assert user_states() == {'U1': True}
+
+    ids_file.write_text("U1\nU2\n", encoding='utf-8')
+    assert FollowerReconciler(None, ids_file=str(ids_file)).run()['added'] == 1
+
+
+def test_unknown_followers_do_not_dilute_the_deactivate_ratio(app):
+    # Another channel's follower list: every known user missing, many new ids
+    add_users(U1=True, U2=True)
+    api = FollowersApi([f"Uother{i}" for i in range(10)], page_size=1000)
+
+    with pytest.raises(RuntimeError, match="deactivate 2 of 2"):
+        FollowerReconciler(api).run()
+    assert user_states() == {'U1': True, 'U2': True}
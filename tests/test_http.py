@@ -0,0 +1,127 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+
+from utils import http as http_module
+from utils.http import HttpClient, LineHttpClient, line_post, scoped_line_api
+
+
+class Server:
+    """
+    Local HTTP server answering with the queued (status, headers, body) responses,
+    then 200 OK; records each request's method, path and headers.
+    """
+
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_one(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                server.requests.append((self.command, self.path, dict(self.headers), body))
+                status, headers, payload = server.responses.pop(0) if server.responses else (200, {}, 'OK')
+                payload = payload.encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = handle_one
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    server = Server()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def client(server, monkeypatch):
+    client = HttpClient(backoff_factor=0, timeout=5)
+    monkeypatch.setattr(http_module, '_shared', client)
+    yield client
+    client.close()
+
+
+def test_line_post_raises_line_errors_for_plain_text_responses(server, client):
+    api = LineBotApi('token', endpoint=server.url)
+
+    server.responses.append((400, {'Content-Type': 'application/json'}, json.dumps({'message': "Invalid audience"})))
+    with pytest.raises(LineBotApiError) as raised:
+        line_post(api, '/v2/bot/message/narrowcast', {'messages': []}, retry_key='key-1')
+    assert raised.value.status_code == 400 and raised.value.error.message == "Invalid audience"
+    method, path, headers, body = server.requests[-1]
+    assert (method, path) == ('POST', '/v2/bot/message/narrowcast')
+    assert headers['Authorization'] == 'Bearer token' and headers['X-Line-Retry-Key'] == 'key-1'
+    assert json.loads(body) == {'messages': []}
+
+    # A gateway error page is not JSON
+    server.responses.append((413, {'X-Line-Request-Id': 'req-1'}, "Request Entity Too Large"))
+    with pytest.raises(LineBotApiError) as raised:
+        line_post(api, '/v2/bot/message/narrowcast', {'messages': []})
+    assert raised.value.status_code == 413 and raised.value.request_id == 'req-1'
+    assert raised.value.error.message == "Request Entity Too Large"
+
+
+def test_idempotent_requests_are_retried_honouring_retry_after(server, client):
+    server.responses.append((503, {'Retry-After': '1'}, "busy"))
+    start = time.monotonic()
+    response = client.get(server.url + '/gift')
+    assert response.status_code == 200 and len(server.requests) == 2
+    assert time.monotonic() - start >= 1
+
+    # Out of retries: the last response comes back for the caller's status check
+    server.responses.extend([(502, {}, "bad gateway")] * 4)
+    assert client.get(server.url + '/gift').status_code == 502
+    assert len(server.requests) == 6
+
+
+def test_posts_are_left_to_the_caller_to_retry(server, client):
+    server.responses.append((503, {}, "busy"))
+    assert client.post(server.url + '/v2/bot/message/multicast', data='{}').status_code == 503
+    assert len(server.requests) == 1
+
+
+def test_connections_are_reused_across_requests_and_line_calls(server, client):
+    for _ in range(3):
+        client.get(server.url + '/gift')
+    api = LineBotApi('token', endpoint=server.url, http_client=LineHttpClient)
+    api.multicast(['U1'], TextSendMessage(text="hi"))
+
+    assert server.requests[-1][1] == '/v2/bot/message/multicast'
+    assert client.stats() == {f"127.0.0.1:{server.httpd.server_port}": {'requests': 4, 'connections': 1}}
+
+
+def test_scoped_line_api_keeps_retry_keys_out_of_the_shared_headers():
+    api = LineBotApi('token')
+    scoped = scoped_line_api(api)
+    scoped.headers['X-Line-Retry-Key'] = 'key-1'
+
+    assert 'X-Line-Retry-Key' not in api.headers
+    assert scoped.headers['Authorization'] == api.headers['Authorization']
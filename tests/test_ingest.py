@@ -0,0 +1,51 @@
+import time
+
+from models import User
+from services.ingest import EventIngestor
+
+
+def failing_apply(ingestor, should_fail):
+    apply = ingestor._apply
+
+    def wrapper(items):
+        if should_fail(items):
+            raise RuntimeError("database unavailable")
+        return apply(items)
+    ingestor._apply = wrapper
+
+
+def active_users():
+    return {user.line_user_id: user.is_active for user in User.query.all()}
+
+
+def test_failed_flush_is_retried(app):
+    ingestor = EventIngestor(app, max_retries=3, retry_delay=0)
+    failures = iter([True, True])
+    failing_apply(ingestor, lambda items: next(failures, False))
+
+    ingestor._flush([('U1', True), ('U2', True), ('U1', False)])
+    assert active_users() == {'U1': False, 'U2': True}
+
+
+def test_batch_that_keeps_failing_is_applied_per_user(app):
+    ingestor = EventIngestor(app, max_retries=1, retry_delay=0)
+    failing_apply(ingestor, lambda items: any(uid == 'Ubad' for uid, _ in items))
+
+    ingestor._flush([('U1', True), ('Ubad', True), ('U2', True)])
+    assert active_users() == {'U1': True, 'U2': True}
+
+
+def test_shutdown_flush_applies_the_flushers_batch(app):
+    # A long burst window: the flusher sits on the events it has taken off the queue
+    ingestor = EventIngestor(app, flush_interval=30)
+    ingestor.submit('U1', True)
+    ingestor.submit('U2', True)
+    deadline = time.monotonic() + 5
+    while not ingestor.queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert ingestor.queue.empty()
+
+    start = time.monotonic()
+    ingestor.flush()
+    assert active_users() == {'U1': True, 'U2': True}
+    assert time.monotonic() - start < 5
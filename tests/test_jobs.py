@@ -0,0 +1,124 @@
+import time
+from datetime import date, datetime, timedelta
+
+from models import db, Job, User
+from services.jobs import JobQueue
+from services.scheduler import SchedulerService
+from services.scraper import ScraperService
+
+
+def enqueue(queue):
+    run_at = (datetime.utcnow() - timedelta(minutes=5)).replace(microsecond=0)
+    queue.enqueue('broadcast', run_at)
+    return run_at
+
+
+def test_lost_run_is_reclaimed_within_grace(app):
+    queue = JobQueue(misfire_grace_time=3600, lease_seconds=600, max_attempts=2, retry_delay=0)
+    enqueue(queue)
+    job = queue.claim()
+    assert job.attempts == 1
+
+    # The worker dies mid-job: the row stays 'running' until the lease runs out
+    job.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    retried = queue.claim()
+    assert retried.id == job.id and retried.attempts == 2 and retried.error == 'lease expired'
+
+    # Out of attempts: failed for good
+    retried.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    assert queue.claim() is None
+    assert db.session.get(Job, job.id).status == 'failed'
+
+
+def test_lost_run_past_grace_is_not_retried(app):
+    queue = JobQueue(misfire_grace_time=3600, lease_seconds=600, retry_delay=0)
+    enqueue(queue)
+    job = queue.claim()
+    # Lost so late that its fire time has left the grace window
+    job.run_at = datetime.utcnow() - timedelta(seconds=3601)
+    job.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    assert queue.claim() is None
+    assert db.session.get(Job, job.id).status == 'failed'
+
+
+def test_failed_run_waits_for_retry_delay(app):
+    queue = JobQueue(retry_delay=60)
+    enqueue(queue)
+    job = queue.claim()
+    queue.complete(job, error='boom')
+    assert job.status == 'pending'
+    assert queue.claim() is None
+
+    job.finished_at = datetime.utcnow() - timedelta(seconds=61)
+    db.session.commit()
+    assert queue.claim().id == job.id
+
+
+def test_lease_shorter_than_grace():
+    assert JobQueue(misfire_grace_time=3600, lease_seconds=7200).lease_seconds < 3600
+
+
+def test_tick_resumes_job_after_crash(app):
+    scheduler = SchedulerService(app)
+    scheduler.schedules = {}
+    scheduler.jobs.retry_delay = 0
+    runs = []
+
+    def broadcast():
+        runs.append(len(runs))
+        if len(runs) == 1:
+            raise RuntimeError("worker crashed mid-broadcast")
+    scheduler.handlers['broadcast'] = broadcast
+
+    enqueue(scheduler.jobs)
+    scheduler.tick()
+    job = Job.query.one()
+    assert runs == [0, 1] and job.status == 'done' and job.attempts == 2
+
+
+def test_heartbeat_extends_lease_while_handler_runs(app):
+    queue = JobQueue(lease_seconds=1, heartbeat_seconds=0.2, retry_delay=0)
+    enqueue(queue)
+    job = queue.claim()
+    with queue.hold(job):
+        time.sleep(1.5)
+        # Well past the original lease, yet still held
+        assert queue.claim() is None
+    assert queue.complete(job)
+    assert db.session.get(Job, job.id).status == 'done'
+
+
+def test_complete_after_losing_the_lease_changes_nothing(app):
+    queue = JobQueue(misfire_grace_time=3600, lease_seconds=600, retry_delay=0)
+    enqueue(queue)
+    job = queue.claim()
+    job.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    other = JobQueue(misfire_grace_time=3600, lease_seconds=600, retry_delay=0)
+    other.worker_id = 'other-host:1'
+    assert other.claim().id == job.id
+
+    assert queue.complete(job) is False
+    job = db.session.get(Job, job.id)
+    assert job.status == 'running' and job.claimed_by == 'other-host:1'
+
+
+def test_broadcast_is_not_done_when_line_fails(app, line_api):
+    last_buy_date = date.today() + timedelta(days=5)
+    ScraperService().save_stocks([{
+        'stock_id': '1101', 'name': 'Stock 1101', 'gift_name': '咖啡券',
+        'meeting_date': last_buy_date + timedelta(days=30), 'last_buy_date': last_buy_date,
+    }])
+    db.session.add(User(line_user_id='U00'))
+    db.session.commit()
+    line_api.fail_all = True
+
+    scheduler = SchedulerService(app, line_bot_api=line_api)
+    scheduler.schedules = {}
+    enqueue(scheduler.jobs)
+    scheduler.tick()
+    job = Job.query.one()
+    assert job.status != 'done' and job.error
@@ -0,0 +1,66 @@
+import pytest
+
+from utils import metrics
+
+
+def test_counter_renders_per_label_set_with_escaped_values():
+    counter = metrics.counter('test_events_total', "Events by kind", ['kind'])
+    counter.inc(kind='new')
+    counter.inc(2, kind='new')
+    counter.inc(kind='say "hi"\n')
+
+    assert counter.render() == [
+        "# HELP test_events_total Events by kind",
+        "# TYPE test_events_total counter",
+        'test_events_total{kind="new"} 3',
+        'test_events_total{kind="say \\"hi\\"\\n"} 1',
+    ]
+    with pytest.raises(ValueError):
+        counter.inc(status='new')
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.histogram('test_stage_seconds', "Stage time", ['stage'], buckets=(0.1, 1))
+    for seconds in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(seconds, stage='parse')
+
+    assert histogram.render()[2:] == [
+        'test_stage_seconds_bucket{stage="parse",le="0.1"} 2',
+        'test_stage_seconds_bucket{stage="parse",le="1"} 3',
+        'test_stage_seconds_bucket{stage="parse",le="+Inf"} 4',
+        'test_stage_seconds_sum{stage="parse"} 3.65',
+        'test_stage_seconds_count{stage="parse"} 4',
+    ]
+
+
+def test_histogram_times_a_block_that_raises():
+    histogram = metrics.histogram('test_failing_seconds', "Failing stage time")
+    with pytest.raises(RuntimeError):
+        with histogram.time():
+            raise RuntimeError("boom")
+    assert histogram.render()[-1] == "test_failing_seconds_count 1"
+
+
+def test_callback_metrics_are_read_at_render_time():
+    size = [3]
+    metrics.gauge('test_cache_size', "Cache size", callback=lambda: size[0])
+    metrics.counter('test_cache_requests_total', "Lookups", ['result'],
+                    callback=lambda: {('hits',): 5, ('misses',): 1})
+    size[0] = 4
+
+    rendered = metrics.render()
+    assert "test_cache_size 4\n" in rendered
+    assert 'test_cache_requests_total{result="hits"} 5\n' in rendered
+
+
+def test_redeclaring_returns_the_registered_metric():
+    counter = metrics.counter('test_redeclared_total', "Redeclared")
+    assert metrics.counter('test_redeclared_total', "Redeclared") is counter
+
+    # A second declaration's callback replaces the first
+    gauge = metrics.gauge('test_redeclared_size', "Size", callback=lambda: 1)
+    metrics.gauge('test_redeclared_size', "Size", callback=lambda: 2)
+    assert gauge.render()[-1] == "test_redeclared_size 2"
+
+    with pytest.raises(ValueError):
+        metrics.gauge('test_redeclared_total', "Redeclared")
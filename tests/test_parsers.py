@@ -0,0 +1,37 @@
+import zlib
+
+import pytest
+
+from benchmarks.synth import make_histock_html
+from models import db, PageSnapshot
+from services.parsers import parse_table_bs4, parse_table_stream
+
+HEADER = "<table><tr><th>代號名稱</th><th>股東會紀念品</th><th>股東會日期</th></tr>"
+
+MALFORMED = {
+    'unclosed td': HEADER + "<tr><td>1101台泥<td>咖啡<td>06/15</tr><tr><td>1102亞泥</td><td>毛巾</td><td>06/16</td></tr></table>",
+    'missing /tr': HEADER + "<tr><td>1101台泥</td><td>咖啡</td><td>06/15</td><tr><td>1102亞泥</td><td>毛巾</td></tr></table>",
+    'table in a cell': HEADER + "<tr><td><table><tr><td>1101</td></tr></table>台泥</td><td>咖啡</td><td>06/15</td></tr></table>",
+    'no end tags': HEADER + "<tr><td>1101台泥<td>咖啡<td>06/15<tr><td>1102亞泥<td>毛巾<td>06/16",
+    'stray end tags': HEADER + "</td></tr><tr><td>1101台泥</b></td><td>咖啡<br></br></td><td>06/15</td></tr></table>",
+    'header in a nested table': "<table><tr><td>" + HEADER + "<tr><td>1101台泥</td><td>咖啡</td></tr></table></td></tr></table>",
+    'script in a cell': HEADER + "<tr><td>1101<script>var s = '</td>';</script>台泥</td><td>咖啡</td><td>06/15</td></tr></table>",
+}
+
+
+@pytest.mark.parametrize('html', MALFORMED.values(), ids=MALFORMED.keys())
+def test_stream_matches_bs4_on_malformed_markup(html):
+    assert parse_table_stream(html) == parse_table_bs4(html)
+
+
+def test_stream_matches_bs4_on_stored_snapshots(app):
+    pages = [make_histock_html(n, seed=n, gift_year=2025 + n % 2) for n in (0, 1, 500)] + list(MALFORMED.values())
+    for i, html in enumerate(pages):
+        db.session.add(PageSnapshot(source='histock', url="https://example.test/gift", encoding='utf-8',
+                                    content_hash=str(i), body=zlib.compress(html.encode('utf-8'))))
+    db.session.commit()
+
+    for snapshot in PageSnapshot.query.order_by(PageSnapshot.id):
+        col_map, rows = parse_table_stream(snapshot.html)
+        assert col_map is not None
+        assert (col_map, rows) == parse_table_bs4(snapshot.html), snapshot.id
@@ -0,0 +1,42 @@
+from datetime import date, timedelta
+
+from models import db, Reminder, User
+from services.scheduler import SchedulerService
+from services.scraper import ScraperService
+
+
+def stock(stock_id, last_buy_date):
+    return {'stock_id': stock_id, 'name': f"Stock {stock_id}", 'gift_name': '咖啡券',
+            'meeting_date': last_buy_date + timedelta(days=30), 'last_buy_date': last_buy_date}
+
+
+def unsent():
+    return sorted((r.stock_id, r.last_buy_date) for r in Reminder.query.filter(Reminder.sent_at.is_(None)))
+
+
+def test_save_stocks_keeps_reminders_in_step(app):
+    scraper = ScraperService()
+    first, moved = date.today() + timedelta(days=10), date.today() + timedelta(days=12)
+
+    scraper.save_stocks([stock('1101', first), stock('1102', first)])
+    assert unsent() == [('1101', first), ('1102', first)]
+
+    scraper.save_stocks([stock('1101', moved), stock('1102', first)])
+    assert unsent() == [('1101', moved), ('1102', first)]
+
+
+def test_failed_reminder_is_released_and_retried(app, line_api):
+    db.session.add(User(line_user_id='U00'))
+    db.session.commit()
+    ScraperService().save_stocks([stock('1101', date.today() + timedelta(days=1))])
+    due_at = Reminder.query.one().due_at
+    scheduler = SchedulerService(app, line_bot_api=line_api)
+
+    line_api.fail_all = True
+    scheduler.remind(now=due_at + timedelta(minutes=1))
+    assert unsent() == [('1101', date.today() + timedelta(days=1))]
+
+    line_api.fail_all = False
+    scheduler.remind(now=due_at + timedelta(minutes=2))
+    assert unsent() == []
+    assert [to for to, _ in line_api.multicasts] == [['U00']]
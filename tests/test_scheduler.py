@@ -0,0 +1,115 @@
+from datetime import date, timedelta
+
+import pytest
+
+from models import db, DeliveryRun, Stock, User, Watermark
+from services.alerts import set_alert
+from services.delivery import DeliveryFailed
+from services.fanout import set_watch
+from services.scheduler import SchedulerService
+from services.scraper import ScraperService
+
+
+def add_stock(stock_id, gift_name='咖啡券'):
+    today = date.today()
+    stock = Stock(stock_id=stock_id, name=f"Stock {stock_id}", gift_name=gift_name,
+                  meeting_date=today + timedelta(days=30), last_buy_date=today + timedelta(days=5))
+    db.session.add(stock)
+    db.session.commit()
+    return stock
+
+
+def add_users(count):
+    db.session.add_all([User(line_user_id=f"U{i:02d}", is_active=True) for i in range(count)])
+    db.session.commit()
+    return [f"U{i:02d}" for i in range(count)]
+
+
+def recipients(line_api):
+    return sorted(user_id for to, _ in line_api.multicasts for user_id in to)
+
+
+def test_watchlist_group_with_same_report_as_everyone_is_delivered(app, line_api):
+    users = add_users(10)
+    set_watch('U05', '1101', True)
+    stock = add_stock('1101')
+
+    scheduler = SchedulerService(app, line_bot_api=line_api)
+    scheduler._send_report([stock], {'1101': 'updated'}, 'weekly')
+
+    assert recipients(line_api) == users
+    keys = [run.job_key for run in DeliveryRun.query.all()]
+    assert len(keys) == 2 and len(set(keys)) == 2
+
+
+def reports(line_api):
+    """
+    {user_id: [number of multicasts received]}.
+    """
+    received = {}
+    for to, _ in line_api.multicasts:
+        for user_id in to:
+            received[user_id] = received.get(user_id, 0) + 1
+    return received
+
+
+def test_keyword_alerts_add_to_the_digest(app, line_api):
+    add_users(2)
+    set_alert('U00', '咖啡', True)         # Keyword only: keeps the full report
+    set_alert('U01', '咖啡', True)         # Keyword plus a watchlist: watchlist + matches
+    set_watch('U01', '9999', True)
+    coffee, towel = add_stock('1101', '咖啡券'), add_stock('1102', '毛巾')
+
+    scheduler = SchedulerService(app, line_bot_api=line_api)
+    scheduler._send_report([coffee, towel], {}, 'weekly')
+    assert reports(line_api) == {'U00': 2, 'U01': 1}
+    full, filtered, alert = line_api.multicasts
+    assert full[0] == ['U00'] and filtered[0] == ['U01']
+    # The keyword-only user is also told which stocks matched
+    assert alert == (['U00'], ["🔔 關鍵字提醒：有符合的紀念品"])
+
+    # A week without a keyword match: the keyword-only user still gets the digest
+    line_api.multicasts.clear()
+    scheduler._send_report([towel], {}, 'weekly')
+    assert reports(line_api) == {'U00': 1}
+
+
+def test_reminders_do_not_look_like_the_digest(app, line_api):
+    add_users(1)
+    stock = add_stock('1101')
+    scheduler = SchedulerService(app, line_bot_api=line_api)
+
+    scheduler._send_report([stock], {'1101': 'updated'}, 'weekly')
+    scheduler._send_report([stock], {'1101': 'last_buy'}, 'reminder')
+    (_, weekly), (_, reminder) = line_api.multicasts
+    assert weekly == ["本週股東會紀念品通知"]
+    assert reminder == ["⏰ 最後買進提醒：明天截止"]
+
+
+def save(stock_id, gift_name='咖啡券'):
+    last_buy_date = date.today() + timedelta(days=5)
+    ScraperService().save_stocks([{
+        'stock_id': stock_id, 'name': f"Stock {stock_id}", 'gift_name': gift_name,
+        'meeting_date': last_buy_date + timedelta(days=30), 'last_buy_date': last_buy_date,
+    }])
+
+
+def test_broadcast_watermark_moves_only_after_delivery(app, line_api):
+    scheduler = SchedulerService(app, line_bot_api=line_api)
+    save('1101')
+
+    # No subscribers yet: nothing delivered, the change stays pending
+    scheduler.broadcast_job()
+    assert db.session.get(Watermark, 'broadcast') is None
+
+    add_users(2)
+    line_api.fail_all = True
+    with pytest.raises(DeliveryFailed):
+        scheduler.broadcast_job()
+    assert db.session.get(Watermark, 'broadcast') is None
+
+    line_api.fail_all = False
+    scheduler.broadcast_job()
+    assert recipients(line_api) == ['U00', 'U01']
+    assert db.session.get(Watermark, 'broadcast') is not None
+    assert scheduler._changed_stocks(scheduler._last_broadcast_at()) == ([], {})
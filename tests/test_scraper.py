@@ -0,0 +1,152 @@
+from datetime import date, timedelta
+
+import pytest
+
+from models import db, PageSnapshot, Stock, StockEvent
+from services import scraper as scraper_module
+from services.scraper import ScraperService
+from services.sources import Source
+
+
+class FakeResponse:
+    def __init__(self, body, status_code=200, headers=None):
+        self.content = body.encode('utf-8')
+        self.text = body
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.encoding = 'utf-8'
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+
+class FakeSource(Source):
+    """
+    Serves the queued responses in order and records the request headers;
+    parse() returns `rows` for any page.
+    """
+    url = "https://example.test/gift"
+
+    def __init__(self, name='fake', priority=100, rows=None):
+        self.name = name
+        self.priority = priority
+        self.rows = rows or []
+        self.responses = []
+        self.requests = []
+
+    def fetch(self, headers):
+        self.requests.append(dict(headers))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def parse(self, scraper, html):
+        return [dict(row) for row in self.rows]
+
+
+def stock(stock_id, **fields):
+    last_buy_date = date.today() + timedelta(days=10)
+    row = {'stock_id': stock_id, 'name': f"Stock {stock_id}", 'gift_name': '咖啡券',
+           'meeting_date': last_buy_date + timedelta(days=30), 'last_buy_date': last_buy_date}
+    row.update(fields)
+    return row
+
+
+@pytest.fixture
+def source(monkeypatch):
+    source = FakeSource(rows=[stock('1101')])
+    monkeypatch.setattr(scraper_module, 'get_sources', lambda: [source])
+    return source
+
+
+def test_unchanged_page_is_skipped_once_saved(app, source):
+    scraper = ScraperService()
+    source.responses.append(FakeResponse('<html>v1</html>', headers={'ETag': '"v1"'}))
+    assert scraper.run() == {'inserted': 1, 'updated': 0, 'unchanged': 0}
+    assert PageSnapshot.latest('fake').applied_at is not None
+
+    # The server honours the stored ETag
+    source.responses.append(FakeResponse('', status_code=304))
+    assert scraper.run() is None
+    assert source.requests[-1]['If-None-Match'] == '"v1"'
+
+    # Same bytes without a 304: skipped on the content hash
+    source.responses.append(FakeResponse('<html>v1</html>'))
+    assert scraper.run() is None
+    assert PageSnapshot.query.count() == 1
+
+
+def test_page_is_saved_again_after_a_failed_save(app, source):
+    scraper = ScraperService()
+
+    def broken(rows):
+        raise RuntimeError("database went away")
+    scraper._upsert_statement = broken
+    source.responses.append(FakeResponse('<html>v1</html>', headers={'ETag': '"v1"'}))
+    with pytest.raises(RuntimeError):
+        scraper.run()
+    assert Stock.query.count() == 0
+    assert PageSnapshot.latest('fake').applied_at is None
+
+    # Next run: no validators sent, and the same bytes are saved this time
+    del scraper._upsert_statement
+    source.responses.append(FakeResponse('<html>v1</html>', headers={'ETag': '"v1"'}))
+    assert scraper.run() == {'inserted': 1, 'updated': 0, 'unchanged': 0}
+    assert 'If-None-Match' not in source.requests[-1]
+    assert PageSnapshot.latest('fake').applied_at is not None
+
+
+def test_merge_takes_each_field_by_source_priority(app, monkeypatch):
+    primary = FakeSource('primary', priority=100, rows=[stock('1101', name="Unknown", last_buy_date=None)])
+    backup = FakeSource('backup', priority=50, rows=[stock('1101', name="台泥", gift_name='毛巾')])
+    for source in (primary, backup):
+        source.responses.append(FakeResponse(f'<html>{source.name}</html>'))
+    # Registry order must not matter
+    monkeypatch.setattr(scraper_module, 'get_sources', lambda: [backup, primary])
+
+    ScraperService().run()
+    saved = Stock.query.one()
+    # Gift from the primary; the placeholder name and the missing date come from the backup
+    assert (saved.name, saved.gift_name, saved.last_buy_date) == ("台泥", '咖啡券', backup.rows[0]['last_buy_date'])
+    assert saved.field_sources['gift_name'] == 'primary'
+    assert saved.field_sources['name'] == saved.field_sources['last_buy_date'] == 'backup'
+
+
+def test_run_fails_when_every_source_fails(app, source):
+    source.responses.append(RuntimeError("connection reset"))
+    with pytest.raises(RuntimeError, match="sources failed"):
+        ScraperService().run()
+
+
+def test_save_stocks_counts_real_changes_only(app):
+    scraper = ScraperService()
+    assert scraper.save_stocks([stock('1101'), stock('1102')]) == {'inserted': 2, 'updated': 0, 'unchanged': 0}
+    first_saved = db.session.get(Stock, '1102').updated_at
+
+    # Duplicate ids in one batch: the last row wins
+    counts = scraper.save_stocks([stock('1101', gift_name='毛巾'), stock('1102'), stock('1101', gift_name='雨傘')])
+    assert counts == {'inserted': 0, 'updated': 1, 'unchanged': 1}
+    db.session.expire_all()
+    assert db.session.get(Stock, '1101').gift_name == '雨傘'
+    assert db.session.get(Stock, '1102').updated_at == first_saved
+    assert [e.kind for e in StockEvent.query.filter_by(stock_id='1101').order_by(StockEvent.id)] == ['new', 'updated']
+
+
+def test_save_stocks_never_overwrites_dates_with_empty_values(app):
+    scraper = ScraperService()
+    saved = stock('1101', vote_start_date=date.today())
+    scraper.save_stocks([saved])
+
+    counts = scraper.save_stocks([stock('1101', last_buy_date=None, vote_start_date=None)])
+    assert counts == {'inserted': 0, 'updated': 0, 'unchanged': 1}
+    db.session.expire_all()
+    row = db.session.get(Stock, '1101')
+    assert (row.last_buy_date, row.vote_start_date) == (saved['last_buy_date'], saved['vote_start_date'])
+
+    # Written together with a real change, the empty dates still keep the stored ones
+    scraper.save_stocks([stock('1101', gift_name='毛巾', last_buy_date=None, vote_start_date=None)])
+    db.session.expire_all()
+    row = db.session.get(Stock, '1101')
+    assert row.gift_name == '毛巾' and row.last_buy_date == saved['last_buy_date']
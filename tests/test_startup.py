@@ -0,0 +1,60 @@
+import json
+import os
+import subprocess
+import sys
+
+from flask import Flask
+from sqlalchemy import inspect
+
+from benchmarks.bench_startup import LAZY_MODULES
+from config import Config
+from models import db
+from services.startup import Startup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = """
+import json, sys
+import app
+health = app.app.test_client().get('/health').status_code
+print(json.dumps({'health': health, 'modules': sorted(sys.modules)}))
+"""
+
+
+def make_app(database_uri):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config.update(SQLALCHEMY_DATABASE_URI=database_uri, LINE_CHANNEL_ACCESS_TOKEN='test', INIT_DB_ON_BOOT=True)
+    db.init_app(app)
+    return app
+
+
+def test_boot_creates_tables_in_the_background(tmp_path):
+    app = make_app(f"sqlite:///{tmp_path / 'boot.db'}")
+    startup = Startup(app)
+    startup.start()
+
+    assert startup.wait(timeout=10)
+    with app.app_context():
+        assert 'stocks' in inspect(db.engine).get_table_names()
+    assert startup.scheduler() is startup.scheduler()
+
+
+def test_failed_boot_is_reported_without_blocking_waiters(tmp_path):
+    app = make_app(f"sqlite:///{tmp_path / 'missing' / 'boot.db'}")
+    startup = Startup(app)
+    startup.start()
+
+    assert not startup.wait(timeout=10)
+    assert startup.ready.is_set() and startup.error is not None
+
+
+def test_importing_the_app_leaves_the_scheduling_stack_unloaded(tmp_path):
+    env = dict(os.environ, PYTHONPATH=ROOT, DATABASE_URL=f"sqlite:///{tmp_path / 'app.db'}",
+               LINE_CHANNEL_ACCESS_TOKEN='test', LINE_CHANNEL_SECRET='test', SCHEDULER_EMBEDDED='false')
+    proc = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=ROOT, env=env,
+                          capture_output=True, text=True, check=True, timeout=60)
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    assert result['health'] == 200
+    assert [module for module in LAZY_MODULES if module in result['modules']] == []
@@ -0,0 +1,41 @@
+from models import db, User, Subscription
+from services.subscribers import count_active_users, has_active_users, iter_active_user_batches
+
+
+def add_users(line_user_ids, is_active=True):
+    users = [User(line_user_id=line_user_id, is_active=is_active) for line_user_id in line_user_ids]
+    db.session.add_all(users)
+    db.session.commit()
+    return users
+
+
+def test_batches_are_sorted_keyset_pages_of_active_users(app):
+    assert not has_active_users()
+    assert list(iter_active_user_batches()) == []
+
+    add_users(['U05', 'U01', 'U04', 'U02', 'U03'])
+    add_users(['U00', 'U06'], is_active=False)
+    assert has_active_users() and count_active_users() == 5
+
+    assert list(iter_active_user_batches(batch_size=2)) == [['U01', 'U02'], ['U03', 'U04'], ['U05']]
+    # A full last page ends on the empty query after it
+    assert list(iter_active_user_batches(batch_size=5)) == [['U01', 'U02', 'U03', 'U04', 'U05']]
+
+
+def test_batches_continue_after_the_last_id_when_users_change_between_pages(app):
+    add_users(['U01', 'U02', 'U03', 'U04'])
+    batches = iter_active_user_batches(batch_size=2)
+    assert next(batches) == ['U01', 'U02']
+
+    add_users(['U00', 'U025'])
+    assert list(batches) == [['U025', 'U03'], ['U04']]
+
+
+def test_without_watchlist_skips_users_with_subscriptions(app):
+    users = add_users(['U01', 'U02', 'U03'])
+    db.session.add(Subscription(user_id=users[1].id, stock_id='2330'))
+    db.session.commit()
+
+    assert list(iter_active_user_batches(without_watchlist=True)) == [['U01', 'U03']]
+    assert count_active_users(without_watchlist=True) == 2
+    assert count_active_users() == 3
@@ -0,0 +1,63 @@
+import argparse
+import json
+
+import pytest
+from linebot import SignatureValidator, WebhookParser
+from linebot.models import FollowEvent, MessageEvent, UnfollowEvent
+
+from benchmarks.bench_webhook import EventFactory, parse_mix, sign
+from models import User
+
+SECRET = 'test-secret'
+
+
+def test_parse_mix():
+    assert parse_mix('follow=2, message') == (['follow', 'message'], [2.0, 1.0])
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_mix('follow=1,join=1')
+
+
+def test_signed_bodies_parse_as_line_events():
+    factory = EventFactory(parse_mix('follow=1,unfollow=1,message=2'), users=5, seed=1)
+    body, counts = factory.body(40)
+
+    assert SignatureValidator(SECRET).validate(body.decode('utf-8'), sign(SECRET, body))
+    assert not SignatureValidator(SECRET).validate(body.decode('utf-8'), sign('other-secret', body))
+
+    events = WebhookParser(SECRET).parse(body.decode('utf-8'), sign(SECRET, body))
+    types = {FollowEvent: 'follow', UnfollowEvent: 'unfollow', MessageEvent: 'message'}
+    assert sum(counts.values()) == len(events) == 40
+    assert {kind: sum(types[type(e)] == kind for e in events) for kind in counts} == dict(counts)
+    assert len({event.source.user_id for event in events}) <= 5
+
+    # Same seed, same event sequence
+    again, _ = EventFactory(parse_mix('follow=1,unfollow=1,message=2'), users=5, seed=1).body(40)
+    kinds = lambda raw: [(e['type'], e['source']['userId']) for e in json.loads(raw)['events']]  # noqa: E731
+    assert kinds(again) == kinds(body)
+
+
+def test_webhook_applies_signed_events(web, web_client, monkeypatch):
+    replies = []
+    monkeypatch.setattr(web.line_bot_api, 'reply_message', lambda token, message: replies.append(token))
+    body, counts = EventFactory(parse_mix('follow=1,unfollow=1,message=1'), users=4, seed=2).body(30)
+
+    response = web_client.post('/webhook', data=body, headers={'X-Line-Signature': sign(SECRET, body)})
+    assert response.status_code == 200
+    assert len(replies) == counts['follow']
+
+    # Each user ends in the state of their last event (messages re-activate)
+    expected = {}
+    for event in json.loads(body)['events']:
+        expected[event['source']['userId']] = event['type'] != 'unfollow'
+    web.ingestor.flush()
+    assert {user.line_user_id: user.is_active for user in User.query.all()} == expected
+
+
+def test_webhook_rejects_a_tampered_body(web_client):
+    body, _ = EventFactory(parse_mix('follow=1'), users=1).body(1)
+    signature = sign(SECRET, body)
+
+    response = web_client.post('/webhook', data=body.replace(b'follow', b'unfollow'),
+                               headers={'X-Line-Signature': signature})
+    assert response.status_code == 400
+    assert User.query.count() == 0
@@ -0,0 +1,93 @@
+from collections import deque
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over a changing keyword set.
+
+    add() extends the trie in place and marks failure links stale; they are
+    rebuilt once (BFS, linear in trie size) on the next search, so a batch of
+    additions costs one rebuild. remove() only clears the keyword's output and
+    needs no rebuild. search() is a single pass over the text.
+    """
+
+    def __init__(self):
+        self._goto = [{}]      # node -> {char: node}
+        self._fail = [0]       # node -> longest proper suffix node
+        self._dict = [0]       # node -> nearest suffix node with an output (0 = none)
+        self._out = [None]     # node -> keyword ending here, or None
+        self._nodes = {}       # keyword -> terminal node
+        self._stale = False
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, keyword):
+        return keyword in self._nodes
+
+    def add(self, keyword):
+        if not keyword or keyword in self._nodes:
+            return
+        node = 0
+        for char in keyword:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._dict.append(0)
+                self._out.append(None)
+                self._goto[node][char] = nxt
+            node = nxt
+        self._out[node] = keyword
+        self._nodes[keyword] = node
+        self._stale = True
+
+    def remove(self, keyword):
+        node = self._nodes.pop(keyword, None)
+        if node is not None:
+            # Trie and links stay valid; dictionary links may just skip over this node
+            self._out[node] = None
+
+    def search(self, text):
+        """
+        Set of keywords occurring in text.
+        """
+        if self._stale:
+            self._build()
+
+        found = set()
+        goto, fail, dict_link, out = self._goto, self._fail, self._dict, self._out
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            hit = node if out[node] is not None else dict_link[node]
+            while hit:
+                if out[hit] is not None:
+                    found.add(out[hit])
+                hit = dict_link[hit]
+        return found
+
+    def _build(self):
+        queue = deque()
+        for child in self._goto[0].values():
+            self._fail[child] = 0
+            self._dict[child] = 0
+            queue.append(child)
+
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                f = self._fail[node]
+                while f and char not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                fail_node = self._fail[child]
+                self._dict[child] = fail_node if self._out[fail_node] is not None else self._dict[fail_node]
+
+        self._stale = False
@@ -0,0 +1,57 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Bounded in-process set of keys with per-entry TTL and LRU eviction.
+    Thread-safe; keeps hit/miss/eviction counters for metrics.
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> expiry (monotonic)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        now = time.monotonic()
+        with self._lock:
+            expires = self._data.get(key)
+            if expires is not None and expires > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True
+            if expires is not None:
+                del self._data[key]
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._data[key] = time.monotonic() + self.ttl
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -1,42 +1,289 @@
-from linebot.models import FlexSendMessage, BubbleContainer, BoxComponent, TextComponent
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
-def create_stock_report(stocks):
+from linebot.models import SendMessage
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout changes so cached payloads are not reused
+RENDER_VERSION = 2
+
+# LINE limits: bubble JSON <= 30 KB, carousel <= 12 bubbles and <= 50 KB.
+# Keep some headroom, and size bubbles so two fit in one carousel.
+BUBBLE_MAX_BYTES = 22 * 1024
+CAROUSEL_MAX_BYTES = 45 * 1024
+CAROUSEL_MAX_BUBBLES = 12
+
+# Weekly digest texts; other reports (e.g. last-buy reminders) pass their own
+ALT_TEXT = "本週股東會紀念品通知"
+TITLE = "📅 股東會紀念品速報"
+SUBTITLE = "本週最新資訊"
+
+# In-process LRU of rendered reports: key -> list of message dicts
+_MEMORY_CACHE_SIZE = 64
+_memory_cache = OrderedDict()
+_memory_lock = threading.Lock()
+
+# How stale rendered_reports.last_used_at may get before a cache hit refreshes it
+LAST_USED_RESOLUTION = timedelta(days=1)
+
+
+class RenderedFlexMessage(SendMessage):
     """
-    Creates a Flex Message bubble for the weekly stock report.
+    A Flex message whose JSON was rendered (and cached) ahead of time.
+    as_json_dict() hands back the cached dict instead of rebuilding a component tree.
+    """
+
+    def __init__(self, payload, **kwargs):
+        super(RenderedFlexMessage, self).__init__(**kwargs)
+        self.type = 'flex'
+        self.payload = payload
+
+    def as_json_dict(self):
+        return self.payload
+
+
+# Row tags for labelled reports (see SchedulerService._changed_stocks)
+LABEL_TEXT = {
+    'new': "🆕 新增",
+    'updated': "🔄 更新",
+    'last_buy': "⏰ 最後買進倒數",
+}
+
+
+def create_stock_report(stocks, labels=None, alt_text=ALT_TEXT, title=TITLE, subtitle=SUBTITLE):
+    """
+    Creates the Flex messages for the weekly stock report.
+    labels: optional {stock_id: 'new' | 'updated' | 'last_buy'} shown as a tag on each row.
+    alt_text (chat list / notification text), title and subtitle default to the weekly digest's.
+    Returns a list of messages (one carousel each, paginated to LINE's size
+    limits), or [] if there are no stocks. Rendering is cached per unique stock set.
     """
     if not stocks:
-        return None
+        return []
+    labels = labels or {}
+
+    # Sort stocks by meeting date (without touching the caller's list)
+    stocks = sorted(stocks, key=lambda x: x.meeting_date)
 
-    # Sort stocks by meeting date
-    stocks.sort(key=lambda x: x.meeting_date)
+    key = report_key(stocks, labels, (alt_text, title, subtitle))
+    payloads = _cache_get(key)
+    if payloads is None:
+        payloads = render_report_payloads(stocks, labels, alt_text, title, subtitle)
+        _cache_put(key, payloads)
 
-    contents = []
-    
-    # Header
-    contents.append(TextComponent(text="📅 股東會紀念品速報", weight="bold", size="xl", color="#1DB446"))
-    contents.append(TextComponent(text="本週最新資訊", size="xs", color="#aaaaaa", margin="md"))
-    
-    # Separator
-    contents.append(BoxComponent(layout="vertical", margin="lg", spacing="sm", contents=[])) # Spacer
+    return [RenderedFlexMessage(payload) for payload in payloads]
 
-    # Stock List
+
+def report_key(stocks, labels=None, texts=(ALT_TEXT, TITLE, SUBTITLE)):
+    """
+    Content hash of the fields that appear in the report.
+    """
+    labels = labels or {}
+    digest = hashlib.sha256(f"v{RENDER_VERSION}".encode('utf-8'))
+    digest.update('\x1f'.join(texts).encode('utf-8'))
     for stock in stocks:
-        row = BoxComponent(
-            layout="vertical",
-            margin="md",
-            contents=[
-                TextComponent(text=f"{stock.stock_id} {stock.name}", weight="bold", size="md"),
-                TextComponent(text=f"🎁 {stock.gift_name}", size="sm", color="#555555", wrap=True),
-                TextComponent(text=f"🛒 最後買進: {stock.last_buy_date}", size="xs", color="#999999")
-            ]
+        digest.update(
+            f"\x1e{stock.stock_id}\x1f{stock.name}\x1f{stock.gift_name}"
+            f"\x1f{stock.meeting_date}\x1f{stock.last_buy_date}"
+            f"\x1f{labels.get(stock.stock_id, '')}".encode('utf-8')
         )
-        contents.append(row)
+    return digest.hexdigest()
+
+
+def render_report_payloads(stocks, labels=None, alt_text=ALT_TEXT, title=TITLE, subtitle=SUBTITLE):
+    """
+    Build the message dicts directly: rows are packed into bubbles by size,
+    bubbles into carousels, one carousel per message.
+    """
+    labels = labels or {}
+    rows = [_stock_row(stock, labels.get(stock.stock_id)) for stock in stocks]
+
+    # 1. Pack rows into bubbles
+    pages = []
+    page, page_bytes = [], 0
+    for row in rows:
+        size = _json_size(row)
+        if page and page_bytes + size > BUBBLE_MAX_BYTES:
+            pages.append(page)
+            page, page_bytes = [], 0
+        page.append(row)
+        page_bytes += size
+    if page:
+        pages.append(page)
+
+    bubbles = [_bubble(page, i + 1, len(pages), title, subtitle) for i, page in enumerate(pages)]
 
-    bubble = BubbleContainer(
-        body=BoxComponent(
-            layout="vertical",
-            contents=contents
+    # 2. Pack bubbles into carousels
+    carousels = []
+    carousel, carousel_bytes = [], 0
+    for bubble in bubbles:
+        size = _json_size(bubble)
+        if carousel and (len(carousel) >= CAROUSEL_MAX_BUBBLES or carousel_bytes + size > CAROUSEL_MAX_BYTES):
+            carousels.append(carousel)
+            carousel, carousel_bytes = [], 0
+        carousel.append(bubble)
+        carousel_bytes += size
+    if carousel:
+        carousels.append(carousel)
+
+    if len(bubbles) == 1:
+        return [{'type': 'flex', 'altText': alt_text, 'contents': bubbles[0]}]
+    return [
+        {
+            'type': 'flex',
+            'altText': alt_text,
+            'contents': {'type': 'carousel', 'contents': carousel},
+        }
+        for carousel in carousels
+    ]
+
+
+def _stock_row(stock, label=None):
+    title = f"{stock.stock_id} {stock.name}"
+    if label in LABEL_TEXT:
+        title = f"{LABEL_TEXT[label]} {title}"
+    return {
+        'type': 'box',
+        'layout': 'vertical',
+        'margin': 'md',
+        'contents': [
+            {'type': 'text', 'text': title, 'weight': 'bold', 'size': 'md'},
+            {'type': 'text', 'text': f"🎁 {stock.gift_name}", 'size': 'sm', 'color': '#555555', 'wrap': True},
+            {'type': 'text', 'text': f"🛒 最後買進: {stock.last_buy_date}", 'size': 'xs', 'color': '#999999'},
+        ],
+    }
+
+
+def _bubble(rows, page, total, title=TITLE, subtitle=SUBTITLE):
+    if total > 1:
+        subtitle = f"{subtitle} ({page}/{total})"
+    contents = [
+        # Header
+        {'type': 'text', 'text': title, 'weight': 'bold', 'size': 'xl', 'color': '#1DB446'},
+        {'type': 'text', 'text': subtitle, 'size': 'xs', 'color': '#aaaaaa', 'margin': 'md'},
+        # Spacer
+        {'type': 'box', 'layout': 'vertical', 'margin': 'lg', 'spacing': 'sm', 'contents': []},
+    ]
+    contents.extend(rows)
+    return {
+        'type': 'bubble',
+        'body': {'type': 'box', 'layout': 'vertical', 'contents': contents},
+    }
+
+
+def _json_size(obj):
+    # The SDK sends ASCII-escaped JSON, so measure it the same way
+    return len(json.dumps(obj, separators=(',', ':')))
+
+
+def _cache_get(key):
+    with _memory_lock:
+        payloads = _memory_cache.get(key)
+        if payloads is not None:
+            _memory_cache.move_to_end(key)
+            return payloads
+
+    payloads = _db_get(key)
+    if payloads is not None:
+        _memory_put(key, payloads)
+    return payloads
+
+
+def _cache_put(key, payloads):
+    _memory_put(key, payloads)
+    _db_put(key, payloads)
+
+
+def _memory_put(key, payloads):
+    with _memory_lock:
+        _memory_cache[key] = payloads
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > _MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+@contextmanager
+def _cache_connection():
+    """
+    Connection for the rendered_reports cache that never commits or rolls back the
+    caller's work: a savepoint inside the caller's open transaction (the cache row
+    is kept if the caller commits), else a short transaction of its own.
+    """
+    from models import db
+    if db.session().in_transaction():
+        with db.session.begin_nested():
+            yield db.session.connection()
+    else:
+        with db.engine.begin() as conn:
+            yield conn
+
+
+def _db_get(key):
+    from flask import has_app_context
+    if not has_app_context():
+        return None
+    from sqlalchemy import or_, select, update
+    from models import RenderedReport
+    try:
+        now = datetime.utcnow()
+        with _cache_connection() as conn:
+            payload = conn.execute(
+                select(RenderedReport.payload).where(RenderedReport.report_key == key)
+            ).scalar()
+            if payload is not None:
+                conn.execute(
+                    update(RenderedReport)
+                    .where(
+                        RenderedReport.report_key == key,
+                        or_(RenderedReport.last_used_at.is_(None),
+                            RenderedReport.last_used_at < now - LAST_USED_RESOLUTION),
+                    )
+                    .values(last_used_at=now)
+                )
+        return json.loads(payload) if payload is not None else None
+    except Exception as e:
+        logger.warning(f"Rendered report cache read failed: {e}")
+        return None
+
+
+def _db_put(key, payloads):
+    from flask import has_app_context
+    if not has_app_context():
+        return
+    from models import dialect_insert, RenderedReport
+    try:
+        now = datetime.utcnow()
+        stmt = dialect_insert(RenderedReport).values(
+            report_key=key, payload=json.dumps(payloads), created_at=now, last_used_at=now)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[RenderedReport.report_key],
+            set_={'payload': stmt.excluded.payload, 'last_used_at': stmt.excluded.last_used_at},
         )
-    )
+        with _cache_connection() as conn:
+            conn.execute(stmt)
+    except Exception as e:
+        logger.warning(f"Rendered report cache write failed: {e}")
 
-    return FlexSendMessage(alt_text="本週股東會紀念品通知", contents=bubble)
+
+def prune_rendered_reports(max_age_days):
+    """
+    Delete cached reports not used (or, if never read back, not written) for
+    max_age_days. Returns the number of rows deleted. Needs an app context.
+    """
+    from sqlalchemy import delete, func
+    from models import db, RenderedReport
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    with db.engine.begin() as conn:
+        deleted = conn.execute(
+            delete(RenderedReport)
+            .where(func.coalesce(RenderedReport.last_used_at, RenderedReport.created_at) < cutoff)
+        ).rowcount
+    if deleted:
+        logger.info(f"Pruned {deleted} rendered reports unused for {max_age_days} days.")
+    return deleted
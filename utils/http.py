@@ -0,0 +1,185 @@
+import copy
+import json
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import HttpClient as LineHttpClientBase, RequestsHttpResponse
+from linebot.models import Error
+
+from config import Config
+from utils import metrics
+
+# Retried by the transport for idempotent methods only (GET/HEAD/...); POSTs such as
+# multicast are retried by MulticastDispatcher, which owns the X-Line-Retry-Key
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+class HttpClient:
+    """
+    Shared outbound HTTP transport: one requests.Session whose adapter keeps a
+    keep-alive pool per host, bounded retries with backoff (honouring Retry-After)
+    for idempotent methods, and a per-host concurrency limit. Thread-safe.
+    """
+
+    def __init__(self, pool_size=16, max_retries=3, backoff_factor=0.5, max_per_host=8, timeout=10):
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS,
+            # Hand the last response back so callers' raise_for_status / status checks still apply
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self._hosts = {}  # host -> [semaphore, request count]
+        self._hosts_lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        host = self._host(urlsplit(url).netloc)
+        with host[0]:
+            with self._hosts_lock:
+                host[1] += 1
+            return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """
+        Per host: requests sent and connections opened (requests - connections were reused).
+        """
+        with self._hosts_lock:
+            stats = {host: {'requests': state[1], 'connections': 0} for host, state in self._hosts.items()}
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = f"{pool.host}:{pool.port}" if pool.port not in (80, 443) else pool.host
+            stats.setdefault(host, {'requests': 0, 'connections': 0})['connections'] += pool.num_connections
+        return stats
+
+    def close(self):
+        self.session.close()
+
+    def _host(self, netloc):
+        with self._hosts_lock:
+            state = self._hosts.get(netloc)
+            if state is None:
+                state = self._hosts[netloc] = [threading.BoundedSemaphore(self.max_per_host), 0]
+            return state
+
+
+class LineHttpClient(LineHttpClientBase):
+    """
+    line-bot-sdk HttpClient backed by the shared transport, so reply, multicast
+    and broadcast calls reuse pooled connections to api.line.me.
+    """
+
+    def __init__(self, timeout=LineHttpClientBase.DEFAULT_TIMEOUT, client=None):
+        super(LineHttpClient, self).__init__(timeout)
+        self.client = client or get_client()
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return RequestsHttpResponse(self.client.request(
+            'GET', url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout))
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.client.request(
+            'POST', url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.client.request(
+            'DELETE', url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.client.request(
+            'PUT', url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+
+def get_client():
+    """
+    The process-wide HttpClient (created on first use from Config).
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = HttpClient(
+                pool_size=Config.HTTP_POOL_SIZE,
+                max_retries=Config.HTTP_MAX_RETRIES,
+                backoff_factor=Config.HTTP_BACKOFF,
+                max_per_host=Config.HTTP_MAX_PER_HOST,
+            )
+            metrics.counter('http_requests_total', "Outbound HTTP requests per host", ['host'],
+                            callback=lambda: {(h,): s['requests'] for h, s in _shared.stats().items()})
+            metrics.counter('http_connections_opened_total', "Outbound connections opened per host (the rest were reused)",
+                            ['host'], callback=lambda: {(h,): s['connections'] for h, s in _shared.stats().items()})
+        return _shared
+
+
+def scoped_line_api(line_bot_api):
+    """
+    Shallow copy of a LineBotApi with its own headers dict. The SDK stores a call's
+    retry_key in LineBotApi.headers, which would otherwise leak it into concurrent
+    and later requests (other multicast chunks, webhook replies).
+    """
+    api = copy.copy(line_bot_api)
+    api.headers = dict(line_bot_api.headers)
+    return api
+
+
+def line_post(line_bot_api, path, payload, retry_key=None, timeout=None):
+    """
+    POST a JSON body to a LINE API path through the shared transport, with the
+    LineBotApi's endpoint and auth headers; for calls the v2 SDK cannot make as
+    needed. Non-2xx responses raise LineBotApiError, like SDK calls do.
+    """
+    headers = dict(line_bot_api.headers)
+    headers['Content-Type'] = 'application/json'
+    if retry_key:
+        headers['X-Line-Retry-Key'] = retry_key
+    response = get_client().post(
+        line_bot_api.endpoint + path, headers=headers, data=json.dumps(payload), timeout=timeout)
+    if not 200 <= response.status_code < 300:
+        try:
+            error = Error.new_from_json_dict(response.json())
+        except ValueError:
+            # LineBotApiError needs an Error; proxies and gateways answer in plain text
+            error = Error(message=response.text or f"HTTP {response.status_code}")
+        raise LineBotApiError(
+            status_code=response.status_code,
+            headers=dict(response.headers.items()),
+            request_id=response.headers.get('X-Line-Request-Id'),
+            accepted_request_id=response.headers.get('X-Line-Accepted-Request-Id'),
+            error=error,
+        )
+    return response
+
+
+def create_line_bot_api(config):
+    """
+    LineBotApi using the shared transport.
+    """
+    return LineBotApi(
+        config['LINE_CHANNEL_ACCESS_TOKEN'],
+        endpoint=config['LINE_API_ENDPOINT'],
+        http_client=LineHttpClient,
+    )
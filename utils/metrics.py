@@ -0,0 +1,185 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; covers sub-millisecond webhook handlers up to multi-minute jobs
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _label_str(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class _Value(_Metric):
+    """
+    One number per label set, kept here or read from a callback at scrape time
+    (for values another object already tracks, e.g. TTLCache.stats()).
+    callback returns a number, or {label value tuple: number} for labelled metrics.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self.callback = callback
+
+    def _samples(self):
+        if self.callback is not None:
+            value = self.callback()
+            values = value.items() if isinstance(value, dict) else [((), value)]
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [f"{self.name}{self._label_str(key)} {_number(v)}" for key, v in sorted(values)]
+
+
+class Counter(_Value):
+    """
+    Monotonic count, optionally per label set.
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Value):
+    """
+    Current value that can go up and down.
+    """
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """
+    Cumulative-bucket histogram (Prometheus semantics), per label set.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the wall time of the with-block (also when it raises).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, list(state)) for key, state in self._values.items())
+        lines = []
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._label_str(key, ('le', _number(bound)))} {cumulative}")
+            lines.append(f"{self.name}_bucket{self._label_str(key, ('le', '+Inf'))} {state[-1]}")
+            lines.append(f"{self.name}_sum{self._label_str(key)} {_number(state[-2])}")
+            lines.append(f"{self.name}_count{self._label_str(key)} {state[-1]}")
+        return lines
+
+
+def counter(name, documentation, labelnames=(), callback=None):
+    return _register(Counter, name, documentation, labelnames=labelnames, callback=callback)
+
+
+def gauge(name, documentation, labelnames=(), callback=None):
+    return _register(Gauge, name, documentation, labelnames=labelnames, callback=callback)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, documentation, labelnames=labelnames, buckets=buckets)
+
+
+def render():
+    """
+    All registered metrics in Prometheus text exposition format.
+    The registry is per process: with several gunicorn workers, each scrape
+    of /metrics reports the worker that served it.
+    """
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _register(cls, name, documentation, **kwargs):
+    # Same name returns the existing metric, so modules can declare theirs at import time
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, documentation, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} already registered as {metric.type}")
+        elif kwargs.get('callback') is not None:
+            # Re-declared (e.g. a second app instance): read from the newest object
+            metric.callback = kwargs['callback']
+        return metric
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
@@ -0,0 +1,73 @@
+import threading
+
+
+class TimingWheel:
+    """
+    Hashed timing wheel: slot_count slots of `resolution` seconds covering a
+    horizon of slot_count * resolution seconds from the last advance().
+    add() and advance() cost O(1) per entry plus the slots passed, so popping
+    what is due never scans the entries that are not. Entries beyond the horizon
+    are rejected (add returns False); the owner reloads them later. Thread-safe.
+    Times are plain numbers (e.g. epoch seconds).
+    """
+
+    def __init__(self, start, resolution=60, slot_count=1440):
+        self.resolution = resolution
+        self.slot_count = slot_count
+        self._slots = [[] for _ in range(slot_count)]
+        self._tick = int(start // resolution)  # Next slot to expire
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def horizon(self):
+        """
+        Latest time add() accepts.
+        """
+        return (self._tick + self.slot_count) * self.resolution - 1e-9
+
+    def __len__(self):
+        return self._size
+
+    def add(self, when, item):
+        with self._lock:
+            # Overdue entries go in the next slot to expire
+            tick = max(int(when // self.resolution), self._tick)
+            if tick >= self._tick + self.slot_count:
+                return False
+            self._slots[tick % self.slot_count].append((when, item))
+            self._size += 1
+            return True
+
+    def advance(self, now):
+        """
+        Remove and return the items due at `now` (in due order).
+        """
+        due = []
+        with self._lock:
+            last = int(now // self.resolution)
+            # Past a full turn every slot has been visited once
+            end = min(last, self._tick + self.slot_count - 1)
+            for tick in range(self._tick, end + 1):
+                slot = self._slots[tick % self.slot_count]
+                if not slot:
+                    continue
+                if tick < last:
+                    due.extend(slot)
+                    slot.clear()
+                else:
+                    # The current slot: only what is due so far
+                    due.extend(entry for entry in slot if entry[0] <= now)
+                    slot[:] = [entry for entry in slot if entry[0] > now]
+            # The current slot stays open until it has fully passed
+            self._tick = max(self._tick, last)
+            self._size -= len(due)
+        due.sort(key=lambda entry: entry[0])
+        return [item for _, item in due]
+
+    def clear(self, start):
+        with self._lock:
+            for slot in self._slots:
+                slot.clear()
+            self._tick = int(start // self.resolution)
+            self._size = 0
@@ -0,0 +1,63 @@
+"""
+Dedicated scheduler/worker process (Procfile `worker:`).
+Run the web service with SCHEDULER_EMBEDDED=false so only workers execute jobs;
+any number of workers is safe, each job row is claimed by exactly one.
+"""
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# This process runs the scheduler itself; don't let app.py start a second one
+os.environ['SCHEDULER_EMBEDDED'] = 'false'
+
+from app import app, startup
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', metrics.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port):
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Serving /metrics on port {port}.")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if app.config['WORKER_METRICS_PORT']:
+        serve_metrics(app.config['WORKER_METRICS_PORT'])
+
+    # app.py already started init_db in the background; jobs need the tables
+    startup.wait()
+    scheduler = startup.scheduler()
+    scheduler.start()
+    logger.info("Worker started.")
+
+    try:
+        while True:
+            time.sleep(60)
+    except (KeyboardInterrupt, SystemExit):
+        scheduler.scheduler.shutdown()
+
+
+if __name__ == "__main__":
+    main()